@@ -1,11 +1,25 @@
+import asyncio
+import copy
 import time
-from threading import Condition, Thread
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from enum import IntEnum
+from functools import partial
+from threading import Condition, Lock, Thread
 
 from configuration import configuration
-from base import RetryStrategy
+from base import RetryStrategy, Runner, AsyncRunner, BatchRunner, TaskType, TaskState
 from do_log import info, exception, error
+from error import ExecutionTimeout
 from base import FailedTask
-from storage_helper import task_interrupted, take_failed_task, next_failed_task, task_failed
+from breaker import CircuitBreaker
+from limiter import TokenBucket
+import metrics
+from process_pool import ProcessPoolRunner, get_executor
+from storage_helper import task_interrupted, take_failed_tasks, next_failed_task, task_failed, mark_failed, save_tasks, \
+    tasks_deferred, load_payload, tasks_success
+from write_behind import WriteBehindBuffer
 
 
 class MetaProcessor:
@@ -29,96 +43,753 @@ class MetaProcessor:
         return MetaProcessor._META_KEY in kwargs
 
 
+class AttemptState(IntEnum):
+    """有执行超时时间的同步执行的状态，用于隔离超时被放弃的执行"""
+    Running = 0     # 执行中
+    Settled = 1     # 被装饰函数已开始记录执行结果
+    Finished = 2    # 执行结束且未记录执行结果
+    Abandoned = 3   # 已超时被放弃，之后不能再写入存储器
+
+
+@dataclass
+class ActuatorStats:
+    """
+    执行器运行统计，用于比较重试任务耗时与调度开销
+    """
+    retries: int = 0    # 已执行的重试次数
+    retry_time: float = 0   # 执行重试任务的总耗时，单位为秒
+    polls: int = 0  # 主循环轮询次数
+    idle_polls: int = 0     # 未取到任务的轮询次数
+    schedule_time: float = 0    # 取任务、分发及查询下一个任务的总耗时，单位为秒
+    throttled: int = 0  # 因重试过于频繁而被推迟到最小重试间隔的次数
+
+
 class DoActuator:
     """
     重试执行器
     """
+    _BUSY_DELAY = 0.05  # 执行器达到并发上限且执行耗时未知时，相邻两个被推迟任务的间隔，单位为秒
 
     def __init__(self):
         self._runner_registry = dict()
         self._strategy_registry = dict()
+        self._concurrency_registry = dict()    # 执行器并发上限
+        self._breaker_registry = dict()     # 执行器熔断器
+        self._limiter_registry = dict()     # 限流器，键为(执行器名, 任务名)，全局限流器的键为(None, None)
+        self._batch_registry = dict()   # 执行器的批量运行器
+        self._batches = dict()  # 收集中的批次：执行器名 -> (提交期限, 任务列表)
+        self._weight_registry = dict()  # 执行器在公平调度中的权重
+        self._timeout_registry = dict()     # 执行器的执行超时时间
+        self._vtime = 0     # 公平调度的虚拟时间
+        self._finish = dict()   # 各执行器上一个被选中任务的虚拟完成时间
         self._cond = Condition()  # 条件量
+        self._wakeups = 0   # 唤醒次数，主循环据此发现轮询期间错过的唤醒
+        self._executor = None   # 重试工作线程池
+        self._attempt_executor = None   # 执行有超时时间的同步任务的线程池
+        self._workers = 1   # 工作线程数
+        self._running = 0   # 执行中的任务数
+        self._runner_running = defaultdict(int)    # 各执行器执行中的任务数
+        self._exec_time = dict()    # 各执行器单个任务执行耗时的指数移动平均
+        self._busy_until = dict()   # 各执行器因达到并发上限而被推迟的任务中最晚的下次执行时间
+        self._listeners = list()    # 新失败任务的监听者
+        self._write_behind = None   # 失败任务写缓冲区
+        self._stats = ActuatorStats()   # 运行统计
+        self._attempts = dict()     # 有执行超时时间的同步执行：id(任务副本) -> 执行状态
+        self._fence = Lock()    # 保护执行状态，使记录执行结果与超时放弃互斥
 
-    def _wait(self, timeout: float = None) -> None:
+    def _wait(self, timeout: float = None, since: int = None) -> None:
+        """等待被唤醒或超时，since为轮询前的唤醒次数，其后已被唤醒过时立即返回"""
         with self._cond:
-            self._cond.wait(timeout)
+            if since is None or since == self._wakeups:
+                self._cond.wait(timeout)
+
+    def _wake(self) -> None:
+        """唤醒等待中的主循环，需持有self._cond"""
+        self._wakeups += 1
+        self._cond.notify_all()
 
     def _notify(self) -> None:
         with self._cond:
-            self._cond.notify()
+            self._wake()
+        for listener in self._listeners:
+            listener()
 
+    def add_listener(self, listener: callable) -> None:
+        """添加新失败任务的监听者，用于唤醒其他执行器
 
-    def _redo(self, task: FailedTask) -> None:
-        """重试执行任务
-        重试时会将元数据放入关键字参数字典中
+        Args:
+            listener (callable): 无参回调函数，可能在任意线程中被调用
+        """
+        self._listeners.append(listener)
+
+    def _wait_for_worker(self) -> int:
+        """等待直到有空闲的工作线程
+
+        Returns:
+            int: 空闲的工作线程数
+        """
+        with self._cond:
+            while self._running >= self._workers:
+                self._cond.wait()
+            return self._workers - self._running
+
+    def _take(self, n: int) -> [FailedTask]:
+        """取出至多n个到期任务，开启公平调度时多取出fair_window倍的任务再从中选出n个"""
+        window = max(configuration.fair_window, 1)
+        task_list = self._fair_select(take_failed_tasks(n * window), n)
+        now = time.time()
+        for task in task_list:
+            metrics.schedule_lag.observe(max(now - task.next_run_time, 0), runner=task.runner_name)
+        return task_list
+
+    def _fair_select(self, task_list: [FailedTask], n: int) -> [FailedTask]:
+        """加权公平排队：从取出的任务中选出n个执行，其余放回存储器
+        优先级高的任务总是先被选出；同一优先级内按执行器分流，每个执行器的任务依次获得间隔为1/权重的虚拟完成时间，
+        每次选择虚拟完成时间最小的任务，因此积压任务多的执行器不会饿死其他执行器
+
+        Args:
+            task_list ([FailedTask]): 按优先级、下次执行时间排序的任务列表
+            n (int): 最大选出任务数
+
+        Returns:
+            [FailedTask]: 选出的任务
+        """
+        if len(task_list) <= n:
+            return task_list
+        flows = dict()
+        for task in task_list:
+            flows.setdefault(task.runner_name, deque()).append(task)
+        tags = {runner_name: max(self._vtime, self._finish.get(runner_name, 0)) + self._cost(runner_name)
+                for runner_name in flows}   # 各执行器队首任务的虚拟完成时间
+        selected = list()
+        while len(selected) < n:
+            priority = max(queue[0].priority for queue in flows.values() if queue)
+            runner_name = min((name for name, queue in flows.items() if queue and queue[0].priority == priority),
+                              key=lambda name: tags[name])
+            self._vtime = self._finish[runner_name] = tags[runner_name]
+            tags[runner_name] += self._cost(runner_name)
+            selected.append(flows[runner_name].popleft())
+        save_tasks([task for queue in flows.values() for task in queue])
+        return selected
+
+    def _cost(self, runner_name: str) -> float:
+        return 1 / self._weight_registry.get(runner_name, 1)
+
+    def _limiters(self, task: FailedTask) -> [TokenBucket]:
+        keys = ((None, None), (task.runner_name, None), (None, task.task_name))
+        return [self._limiter_registry[key] for key in keys if key in self._limiter_registry]
+
+    def _limiter_wait(self) -> float:
+        """
+        Returns:
+            float: 全局限流器距离下一个令牌可用的时间，未注册时为0
+        """
+        limiter = self._limiter_registry.get((None, None))
+        return 0 if limiter is None else limiter.wait_time()
+
+    @staticmethod
+    def _acquire_tokens(limiters: [TokenBucket]) -> (float, TokenBucket):
+        """从所有限流器各获取一个令牌，任一限流器没有令牌时归还已获取的令牌
+
+        Returns:
+            (float, TokenBucket): 需要等待的时间及令牌不足的限流器，获取成功时为(0, None)
+        """
+        for i, limiter in enumerate(limiters):
+            wait_time = limiter.acquire()
+            if wait_time > 0:
+                for acquired in limiters[:i]:
+                    acquired.refund()
+                return wait_time, limiter
+        return 0, None
+
+    def _dispatch_all(self, task_list: [FailedTask]) -> int:
+        """分发一批任务
+        所属执行器已达并发上限的任务依次排在该执行器已推迟任务之后，间隔为执行耗时除以并发上限，
+        即大约在轮到它时才再次到期，不占用工作线程，也不会反复被取出写回，其他执行器的任务不受影响；
+        限流器没有令牌的任务推迟到令牌可用的时间，同一限流器的多个任务按生成速率错开；
+        熔断器未放行的任务推迟到熔断器允许重试的时间，以上合并为一次批量写入
+
+        Args:
+            task_list ([FailedTask]): 失败的任务列表
+
+        Returns:
+            int: 未立即执行的任务数，包括被推迟及加入批次的任务
+        """
+        batched = 0
+        deferred = list()
+        limited = defaultdict(int)  # 各限流器本批次推迟的任务数
+        now = time.time()
+        for task in task_list:
+            if self._busy(task):
+                task.next_run_time = self._busy_slot(task, now)
+                deferred.append(task)
+                continue
+            limiters = self._limiters(task)
+            wait_time, limiter = self._acquire_tokens(limiters)
+            if limiter is not None:
+                task.next_run_time = now + wait_time + limited[limiter] / limiter.rate
+                limited[limiter] += 1
+                deferred.append(task)
+                continue
+            breaker = self._breaker_registry.get(task.runner_name)
+            if breaker is not None and not breaker.allow():
+                for acquired in limiters:
+                    acquired.refund()
+                task.next_run_time = breaker.retry_at()
+                deferred.append(task)
+            elif self._dispatch(task):
+                batched += 1
+        if deferred:
+            info(f'runner busy, rate limited or circuit breaker open, defer {len(deferred)} tasks.')
+            tasks_deferred(deferred)
+        return len(deferred) + batched
+
+    def _record(self, task: FailedTask, success: bool) -> None:
+        metrics.retries.inc(runner=task.runner_name, result='success' if success else 'failure')
+        breaker = self._breaker_registry.get(task.runner_name)
+        if breaker is not None:
+            breaker.record(success)
+
+    def _skip(self, task: FailedTask) -> None:
+        """任务被熔断器放行后未能执行，归还其可能占用的探测名额"""
+        breaker = self._breaker_registry.get(task.runner_name)
+        if breaker is not None:
+            breaker.release()
+
+    def _busy(self, task: FailedTask) -> bool:
+        """
+        Returns:
+            bool: 任务所属执行器是否已达并发上限，注册了批量运行器的执行器不受并发上限约束
+        """
+        limit = self._concurrency_registry.get(task.runner_name, 0)
+        if limit <= 0 or task.runner_name in self._batch_registry:
+            return False
+        with self._cond:
+            return self._runner_running[task.runner_name] >= limit
+
+    def _busy_slot(self, task: FailedTask, now: float) -> float:
+        """
+        Returns:
+            float: 已达并发上限的执行器中被推迟任务的下次执行时间，排在该执行器已推迟的任务之后
+        """
+        limit = self._concurrency_registry[task.runner_name]
+        with self._cond:
+            interval = self._exec_time.get(task.runner_name, self._BUSY_DELAY) / limit
+            slot = max(self._busy_until.get(task.runner_name, now), now) + max(interval, self._BUSY_DELAY / limit)
+            self._busy_until[task.runner_name] = slot
+        return slot
+
+    def _dispatch(self, task: FailedTask) -> bool:
+        """分发任务到工作线程
+        若任务所属执行器注册了批量运行器，则加入该执行器收集中的批次
 
         Args:
             task (FailedTask): 失败的任务
+
+        Returns:
+            bool: 任务是否加入了批次
+        """
+        batch = self._batch_registry.get(task.runner_name)
+        with self._cond:
+            if batch is not None:
+                if task.runner_name not in self._batches:
+                    self._batches[task.runner_name] = (time.time() + batch.max_wait, list())
+                self._batches[task.runner_name][1].append(task)
+                return True
+            self._acquire(task)
+        self._submit(task)
+        return False
+
+    def _flush_batches(self) -> float:
+        """提交已满或已到期的批次，每批至多max_size个任务，每批占用一个工作线程
+
+        Returns:
+            float: 距离下一个收集中的批次到期的时间，没有收集中的批次时为None
+        """
+        now = time.time()
+        ready = list()
+        next_wait = None
+        with self._cond:
+            for runner_name, (deadline, tasks) in list(self._batches.items()):
+                size = self._batch_registry[runner_name].max_size
+                if len(tasks) < size and deadline > now:
+                    next_wait = deadline - now if next_wait is None else min(next_wait, deadline - now)
+                    continue
+                del self._batches[runner_name]
+                for i in range(0, len(tasks), size):
+                    ready.append(tasks[i:i + size])
+                    self._running += 1
+        for tasks in ready:
+            self._submit_batch(tasks)
+        return next_wait
+
+    def _submit_batch(self, tasks: [FailedTask]) -> None:
+        if self._executor is None:
+            self._run_batch(tasks)
+        else:
+            self._executor.submit(self._run_batch, tasks)
+
+    def _run_batch(self, tasks: [FailedTask]) -> None:
+        """在工作线程中执行一批任务，结束后释放工作线程"""
+        start = time.perf_counter()
+        try:
+            self._redo_batch(tasks)
+        except Exception:
+            exception(f'Worker crash on batch of {len(tasks)} tasks!')
+        self._release_batch(tasks, time.perf_counter() - start)
+
+    def _release_batch(self, tasks: [FailedTask], elapsed: float) -> None:
+        metrics.execution.observe(elapsed, runner=tasks[0].runner_name)
+        with self._cond:
+            self._running -= 1
+            self._stats.retries += len(tasks)
+            self._stats.retry_time += elapsed
+            self._wake()
+
+    def _prepare_batch(self, tasks: [FailedTask]) -> [FailedTask]:
+        """加载一批任务的参数，未能执行的任务归还探测名额
+
+        Returns:
+            [FailedTask]: 参数加载成功的任务
+        """
+        try:
+            load_payload(tasks)
+        except Exception:
+            for task in tasks:
+                self._skip(task)
+            raise
+        for task in tasks:
+            if task.task_args is None:
+                error(f'task payload not found, skip {task}.')
+                self._skip(task)
+        return [task for task in tasks if task.task_args is not None]
+
+    def _redo_batch(self, tasks: [FailedTask]) -> None:
+        """调用批量处理函数重试一批任务，协程处理函数在当前线程的新事件循环中执行
+
+        Args:
+            tasks ([FailedTask]): 同一执行器的失败任务列表
+        """
+        runner = self._batch_registry[tasks[0].runner_name]
+        tasks = self._prepare_batch(tasks)
+        if not tasks:
+            return
+        items = [(task.task_args, task.task_kwargs) for task in tasks]
+        try:
+            results = runner.handler(items)
+            if asyncio.iscoroutine(results):
+                results = asyncio.run(results)
+            results = runner.check(items, results)
+        except Exception as e:
+            results = [e] * len(tasks)
+        self._finish_batch(tasks, results)
+
+    def _finish_batch(self, tasks: [FailedTask], results: list) -> None:
+        """将批量处理的结果对应到每个任务：成功的任务一次批量移除，失败的任务按重试策略重新调度后一次批量写回"""
+        succeeded = list()
+        failures = list()
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                if self._record_failure(task, result):
+                    failures.append((task, result))
+            else:
+                self._record(task, True)
+                succeeded.append(task.task_id)
+        if succeeded:
+            tasks_success(succeeded)
+        if failures:
+            self.handle_failed_tasks(failures)
+
+    def _fail(self, task: FailedTask, e: Exception) -> None:
+        """记录任务失败并按重试策略重新调度，用于任务结果不经过被装饰函数记录的情况(批量执行、执行超时)
+
+        Args:
+            task (FailedTask): 失败的任务
+            e (Exception): 导致失败的异常
+        """
+        if self._record_failure(task, e):
+            self.handle_failed_task(task, e)
+
+    def _record_failure(self, task: FailedTask, e: Exception) -> bool:
+        """
+        Returns:
+            bool: 任务是否需要重新调度，非幂等任务不重试
+        """
+        self._record(task, False)
+        error(f'Task failed: {task}, {e.msg if isinstance(e, ExecutionTimeout) else e!r}')
+        if task.task_type == TaskType.Idempotent:
+            return True
+        info(f"task-{task.task_name} is not idempotent.")
+        return False
+
+    def _acquire(self, task: FailedTask) -> None:
+        self._running += 1
+        self._runner_running[task.runner_name] += 1
+
+    def _release(self, task: FailedTask, elapsed: float) -> None:
+        """释放任务占用的并发数
+
+        Args:
+            task (FailedTask): 执行完毕的任务
+            elapsed (float): 任务执行耗时
+        """
+        metrics.execution.observe(elapsed, runner=task.runner_name)
+        with self._cond:
+            self._stats.retries += 1
+            self._stats.retry_time += elapsed
+            self._running -= 1
+            self._runner_running[task.runner_name] -= 1
+            last = self._exec_time.get(task.runner_name)
+            self._exec_time[task.runner_name] = elapsed if last is None else 0.8 * last + 0.2 * elapsed
+            self._wake()
+
+    def _submit(self, task: FailedTask) -> None:
+        if self._executor is None:
+            self._run(task)
+        else:
+            self._executor.submit(self._run, task)
+
+    def _run(self, task: FailedTask) -> None:
+        """在工作线程中执行任务，结束后释放并发数"""
+        start = time.perf_counter()
+        try:
+            self._redo(task)
+        except Exception:
+            exception(f'Worker crash on {task}!')
+        self._release(task, time.perf_counter() - start)
+
+    def _prepare(self, task: FailedTask, timeout: float = 0) -> (Runner, FailedTask):
+        """获取任务运行器，加载任务参数，并将元数据放入关键字参数字典中
+        有执行超时时间时，元数据放入任务的副本，超时被放弃的执行即使之后结束也不会修改原任务，其结果由settle拦截
+
+        Args:
+            task (FailedTask): 失败的任务
+            timeout (float, optional): 执行超时时间
+
+        Returns:
+            (Runner, FailedTask): 任务运行器及本次执行使用的任务，未注册或任务已被删除时运行器为None，并归还探测名额
+        """
+        try:
+            runner = self._load(task)
+        except Exception:
+            self._skip(task)
+            raise
+        if runner is None:
+            self._skip(task)
+            return None, task
+        attempt = task
+        if timeout > 0:
+            attempt = copy.copy(task)
+            attempt.task_kwargs = dict(task.task_kwargs)
+        MetaProcessor.add_meta(attempt, attempt.task_kwargs)
+        return runner, attempt
+
+    def _load(self, task: FailedTask) -> Runner:
+        """
+        Returns:
+            Runner: 任务运行器，未注册或任务已被删除时返回None
         """
         runner = self._runner_registry.get(task.runner_name)
         if runner is None:
             error(f'runner not found, stop retry {task}.')
             task_interrupted(task)
+            return None
+        load_payload([task])
+        if task.task_args is None:
+            error(f'task payload not found, skip {task}.')
+            return None
+        return runner
+
+    def _timeout(self, task: FailedTask) -> float:
+        return self._timeout_registry.get(task.runner_name) or configuration.execution_timeout
+
+    async def _wait_for(self, awaitable, timeout: float, attempt: FailedTask = None) -> object:
+        """等待协程或future执行结束，超时则取消并抛出ExecutionTimeout
+        与asyncio.wait_for不同，被装饰函数自身抛出的TimeoutError不会被当作执行超时；
+        attempt为在线程中执行的同步任务，其已开始记录执行结果时不再放弃，等待执行结束
+        """
+        future = asyncio.ensure_future(awaitable)
+        done, _ = await asyncio.wait({future}, timeout=timeout)
+        if not done and (attempt is None or self._abandon(attempt)):
+            future.cancel()
+            try:
+                await future
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise ExecutionTimeout(f'execution timeout after {timeout}s.')
+        try:
+            return await future
+        finally:
+            if attempt is not None:
+                self._forget(attempt)
+
+    def _call_with_timeout(self, func: callable, timeout: float, attempt: FailedTask) -> object:
+        """在执行线程池中执行同步函数，超时则放弃等待并抛出ExecutionTimeout，已开始的执行继续运行直至函数返回；
+        被放弃的执行占满线程池时新的执行排队等待，排队超时的执行被直接取消"""
+        future = self._attempt_executor.submit(self._fenced(func, attempt))
+        done, _ = wait([future], timeout)
+        if not done:
+            if future.cancel():
+                self._forget(attempt)
+                raise ExecutionTimeout(f'execution timeout after {timeout}s, attempt not started.')
+            if self._abandon(attempt):
+                raise ExecutionTimeout(f'execution timeout after {timeout}s.')
+        try:
+            return future.result()
+        finally:
+            self._forget(attempt)
+
+    def _fenced(self, func: callable, attempt: FailedTask) -> callable:
+        """登记一次在线程中执行的有超时时间的同步执行
+
+        Args:
+            func (callable): 执行函数
+            attempt (FailedTask): 本次执行使用的任务副本
+
+        Returns:
+            callable: 在线程中调用的函数，执行结束后注销未记录执行结果或已被放弃的执行
+        """
+        with self._fence:
+            self._attempts[id(attempt)] = AttemptState.Running
+
+        def _call():
+            try:
+                return func()
+            finally:
+                with self._fence:
+                    if self._attempts.get(id(attempt)) != AttemptState.Settled:
+                        self._attempts.pop(id(attempt), None)
+        return _call
+
+    def _abandon(self, attempt: FailedTask) -> bool:
+        """执行超时时放弃执行，之后该执行的结果不会再写入存储器
+
+        Returns:
+            bool: 是否已放弃，被装饰函数已开始记录执行结果时不能放弃
+        """
+        with self._fence:
+            if self._attempts.get(id(attempt)) == AttemptState.Settled:
+                return False
+            if id(attempt) in self._attempts:
+                self._attempts[id(attempt)] = AttemptState.Abandoned
+            return True
+
+    def _forget(self, attempt: FailedTask) -> None:
+        with self._fence:
+            self._attempts.pop(id(attempt), None)
+
+    def settle(self, task: FailedTask) -> bool:
+        """被装饰函数记录执行结果前调用，与执行超时放弃互斥
+
+        Args:
+            task (FailedTask): 本次执行使用的任务
+
+        Returns:
+            bool: 是否可以记录执行结果，超时被放弃的执行返回False，其失败已由执行器重新调度
+        """
+        with self._fence:
+            state = self._attempts.get(id(task))
+            if state == AttemptState.Abandoned:
+                return False
+            if state is not None:
+                self._attempts[id(task)] = AttemptState.Settled
+            return True
+
+    def _redo(self, task: FailedTask) -> None:
+        """重试执行任务
+        重试时会将元数据放入关键字参数字典中，协程任务在当前线程的新事件循环中执行；
+        超时的协程任务被取消，同步任务被放弃，超时计为一次失败并按重试策略重新调度
+
+        Args:
+            task (FailedTask): 失败的任务
+        """
+        timeout = self._timeout(task)
+        runner, attempt = self._prepare(task, timeout)
+        if runner is None:
             return
 
-        args, kwargs = task.task_args, task.task_kwargs
-        MetaProcessor.add_meta(task, kwargs)
+        args, kwargs = attempt.task_args, attempt.task_kwargs
         try:
-            runner.run(*args, **kwargs)
+            if isinstance(runner, AsyncRunner):
+                coro = runner.run(*args, **kwargs)
+                asyncio.run(self._wait_for(coro, timeout) if timeout > 0 else coro)
+            elif timeout > 0:
+                self._call_with_timeout(partial(runner.run, *args, **kwargs), timeout, attempt)
+            else:
+                runner.run(*args, **kwargs)
+        except ExecutionTimeout as e:
+            self._fail(task, e)
         except Exception:
+            self._record(task, False)
             error(f'Task failed: {task}')
+        else:
+            self._record(task, True)
+
+    def _idle_wait(self, next_task: FailedTask, now: float, empty_polls: int) -> float:
+        """计算未取到任务时的等待时间
+        下一个任务已到期却没有取到任务(如被其他进程租约占用)时，按连续空转次数指数退避，避免空转占满CPU
+
+        Args:
+            next_task (FailedTask): 下一个待重试的任务
+            now (float): 本次轮询的时间
+            empty_polls (int): 连续空转次数
+
+        Returns:
+            float: 等待时间，None表示一直等待到被唤醒
+        """
+        if next_task is None:
+            return None
+        wait_time = next_task.next_run_time - now
+        if wait_time > 0:
+            return wait_time
+        return min(configuration.idle_backoff, 0.001 * 2 ** min(empty_polls, 16))
+
+    def _count_poll(self, elapsed: float, idle: bool) -> None:
+        with self._cond:
+            self._stats.polls += 1
+            self._stats.schedule_time += elapsed
+            if idle:
+                self._stats.idle_polls += 1
+
+    def stats(self) -> ActuatorStats:
+        """
+        Returns:
+            ActuatorStats: 运行统计的快照
+        """
+        with self._cond:
+            return replace(self._stats)
 
     def _main_loop(self) -> None:
         """主循环
         不断重试获取失败任务并执行
         """
+        empty_polls = 0     # 下一个任务已到期却未取到任务的连续次数
         while True:
             try:
+                idle = self._wait_for_worker()
+                wait_time = self._limiter_wait()
+                if wait_time > 0:
+                    self._wait(wait_time)
+                    continue
+                wakeups = self._wakeups
                 now = time.time()
-                task = take_failed_task()
-                if task is not None:
-                    self._redo(task)
-                else:
+                start = time.perf_counter()
+                task_list = self._take(idle)
+                self._dispatch_all(task_list)
+                batch_wait = self._flush_batches()
+                wait_time = None
+                if not task_list:
                     next_task = next_failed_task()
-                    if next_task is not None:
-                        wait_time = next_task.next_run_time - now
-                        self._wait(wait_time)
-                    else:
-                        self._wait()
+                    wait_time = self._idle_wait(next_task, now, empty_polls)
+                    if batch_wait is not None:
+                        wait_time = batch_wait if wait_time is None else min(wait_time, batch_wait)
+                    empty_polls = empty_polls + 1 if next_task is not None and next_task.next_run_time <= now else 0
+                else:
+                    empty_polls = 0
+                self._count_poll(time.perf_counter() - start, not task_list)
+                if not task_list:
+                    start = time.perf_counter()
+                    self._wait(wait_time, wakeups)
+                    metrics.idle.inc(time.perf_counter() - start)
             except Exception:
                 exception("Main loop crash!")
 
 
     def start(self, block: bool=True) -> None:
         """启动do机制
+        主循环负责调度，失败任务交由工作线程池执行，工作线程数由configuration.workers配置；
+        注册了进程池运行器时，在启动线程前预先创建进程池
 
         Args:
             block (bool, optional): 是否阻塞. 默认为True.
         """
+        self._workers = max(configuration.workers, 1)
+        if any(isinstance(runner, ProcessPoolRunner) for runner in self._runner_registry.values()):
+            get_executor()
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='do-worker')
+        # 被放弃的执行在返回前仍占用线程，预留与工作线程数相同的余量
+        self._attempt_executor = ThreadPoolExecutor(max_workers=self._workers * 2, thread_name_prefix='do-attempt')
         if block:
             self._main_loop()
         else:
-            Thread(name='do-worker', target=self._main_loop, daemon=True).start()
+            Thread(name='do-dispatcher', target=self._main_loop, daemon=True).start()
 
-    def _next_run_time(self, task: FailedTask) -> float:
+    def _next_run_time(self, task: FailedTask, error: Exception = None) -> float:
         if task.task_name in self._strategy_registry:
             strategy = self._strategy_registry[task.task_name]
         else:
             strategy = configuration.strategy
-        return strategy.next_run_time(task)
+        return strategy.next_run_time_on_error(task, error)
 
-    def handle_failed_task(self, task: FailedTask):
+    def handle_failed_task(self, task: FailedTask, error: Exception = None):
         """
         失败任务处理
         Args:
             task: 失败的任务
+            error: 导致失败的异常
         """
+        self._reschedule(task, error)
+        if configuration.write_behind:
+            mark_failed(task)
+            self._get_write_behind().append(task)
+        else:
+            task_failed(task)
+            self._notify()
+        if task.state == TaskState.Stopped:
+            metrics.exhausted.inc(runner=task.runner_name)
+
+    def handle_failed_tasks(self, failures: [(FailedTask, Exception)]) -> None:
+        """批量处理失败任务，更新状态后一次写入存储器
+
+        Args:
+            failures ([(FailedTask, Exception)]): 失败的任务及导致失败的异常
+        """
+        for task, error in failures:
+            self._reschedule(task, error)
+            mark_failed(task)
+        tasks = [task for task, _ in failures]
+        if configuration.write_behind:
+            for task in tasks:
+                self._get_write_behind().append(task)
+        else:
+            save_tasks(tasks)
+            self._notify()
+        for task in tasks:
+            if task.state == TaskState.Stopped:
+                metrics.exhausted.inc(runner=task.runner_name)
+
+    def _reschedule(self, task: FailedTask, error: Exception) -> None:
+        """记录失败并按重试策略计算下次执行时间，同一任务两次重试的间隔不小于retry_floor"""
         info(f'New FailedTask: str({task})')
-        next_run_time = self._next_run_time(task)
+        metrics.failures.inc(runner=task.runner_name)
+        next_run_time = self._next_run_time(task, error)
+        if task.retry_count > 0:
+            floor = time.time() + configuration.retry_floor
+            if next_run_time < floor:
+                next_run_time = floor
+                with self._cond:
+                    self._stats.throttled += 1
         task.next_run_time = next_run_time
-        task_failed(task)
+
+    def _get_write_behind(self) -> WriteBehindBuffer:
+        if self._write_behind is None:
+            with self._cond:
+                if self._write_behind is None:
+                    self._write_behind = WriteBehindBuffer(self._save_tasks,
+                                                           buffer_size=configuration.buffer_size,
+                                                           flush_interval=configuration.flush_interval,
+                                                           policy=configuration.overflow_policy)
+        return self._write_behind
+
+    def _save_tasks(self, tasks: [FailedTask]) -> None:
+        save_tasks(tasks)
         self._notify()
 
+    def flush(self) -> None:
+        """将写缓冲区中的失败任务立即写入存储器"""
+        if self._write_behind is not None:
+            self._write_behind.flush()
+
     def register_strategy(self, task_name: str, strategy: RetryStrategy):
         """
         注册重试策略到控制器
@@ -128,18 +799,235 @@ class DoActuator:
         """
         self._strategy_registry[task_name] = strategy
 
-    def register_runner(self, name: str, runner: callable) -> None:
+    def register_runner(self, name: str, runner: callable, concurrency: int = 0, weight: float = 1,
+                        timeout: float = 0) -> None:
         """
         注册任务执行器
 
         Args:
             name (str): 名字
             runner (callable): 任务执行函数
+            concurrency (int, optional): 该执行器同时执行的最大任务数，0表示不限制
+            weight (float, optional): 该执行器在公平调度中的权重，权重越大分到的执行机会越多
+            timeout (float, optional): 该执行器每次重试的执行超时时间，单位为秒，0表示使用全局配置
         """
         self._runner_registry[name] = runner
+        self._concurrency_registry[name] = concurrency
+        self._weight_registry[name] = weight
+        self._timeout_registry[name] = timeout
+
+    def register_breaker(self, name: str, breaker: CircuitBreaker) -> None:
+        """
+        注册执行器的熔断器，熔断器打开时该执行器的待重试任务会被推迟
+
+        Args:
+            name (str): 执行器名字
+            breaker (CircuitBreaker): 熔断器
+        """
+        self._breaker_registry[name] = breaker
+
+    def register_batch(self, name: str, batch: BatchRunner) -> None:
+        """
+        注册执行器的批量运行器，重试时该执行器的到期任务按批次交由批量处理函数执行
+
+        Args:
+            name (str): 执行器名字
+            batch (BatchRunner): 批量运行器
+        """
+        self._batch_registry[name] = batch
+
+    def register_limiter(self, limiter: TokenBucket, runner_name: str = None, task_name: str = None) -> None:
+        """
+        注册限流器，限制任务的重试速率；未指定执行器名和任务名时为全局限流器
+        一个任务需同时从全局、所属执行器及任务名对应的限流器各获取一个令牌才会被执行
+
+        Args:
+            limiter (TokenBucket): 令牌桶限流器
+            runner_name (str, optional): 执行器名字
+            task_name (str, optional): 任务名
+        """
+        if runner_name is not None and task_name is not None:
+            raise ValueError('runner_name and task_name cannot both be specified.')
+        self._limiter_registry[(runner_name, task_name)] = limiter
+
+
+class AsyncDoActuator(DoActuator):
+    """
+    基于asyncio的重试执行器
+    重试任务作为协程任务在事件循环中并发执行，并发数由信号量限制；与同步执行器共享注册表
+    """
+
+    def __init__(self, actuator: DoActuator):
+        super().__init__()
+        self._actuator = actuator   # 同步执行器
+        self._runner_registry = actuator._runner_registry
+        self._strategy_registry = actuator._strategy_registry
+        self._concurrency_registry = actuator._concurrency_registry
+        self._breaker_registry = actuator._breaker_registry
+        self._limiter_registry = actuator._limiter_registry
+        self._batch_registry = actuator._batch_registry
+        self._weight_registry = actuator._weight_registry
+        self._timeout_registry = actuator._timeout_registry
+        self._attempts = actuator._attempts
+        self._fence = actuator._fence
+        self._loop = None   # 事件循环
+        self._event = None  # 唤醒事件
+        self._semaphore = None  # 并发信号量
+        self._tasks = set()     # 执行中的协程任务
+        actuator.add_listener(self._wakeup)
+
+    def _wakeup(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def _notify(self) -> None:
+        """本执行器写回的失败任务也可能由同步执行器执行，经同步执行器唤醒其主循环及所有监听者(包括本执行器)"""
+        self._actuator._notify()
+
+    def _submit(self, task: FailedTask) -> None:
+        future = self._loop.create_task(self._run_async(task))
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+
+    async def _run_async(self, task: FailedTask) -> None:
+        """执行任务，结束后释放并发数并归还信号量"""
+        start = time.perf_counter()
+        try:
+            await self._redo_async(task)
+        except Exception:
+            exception(f'Worker crash on {task}!')
+        self._release(task, time.perf_counter() - start)
+        self._semaphore.release()
+
+    def _submit_batch(self, tasks: [FailedTask]) -> None:
+        future = self._loop.create_task(self._run_batch_async(tasks))
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+
+    async def _run_batch_async(self, tasks: [FailedTask]) -> None:
+        """执行一批任务，批次不占用信号量"""
+        start = time.perf_counter()
+        try:
+            await self._redo_batch_async(tasks)
+        except Exception:
+            exception(f'Worker crash on batch of {len(tasks)} tasks!')
+        self._release_batch(tasks, time.perf_counter() - start)
+
+    async def _redo_batch_async(self, tasks: [FailedTask]) -> None:
+        """调用批量处理函数重试一批任务，同步处理函数在默认线程池中执行
+
+        Args:
+            tasks ([FailedTask]): 同一执行器的失败任务列表
+        """
+        runner = self._batch_registry[tasks[0].runner_name]
+        tasks = self._prepare_batch(tasks)
+        if not tasks:
+            return
+        items = [(task.task_args, task.task_kwargs) for task in tasks]
+        try:
+            if asyncio.iscoroutinefunction(runner.handler):
+                results = await runner.handler(items)
+            else:
+                results = await self._loop.run_in_executor(None, runner.handler, items)
+            results = runner.check(items, results)
+        except Exception as e:
+            results = [e] * len(tasks)
+        self._finish_batch(tasks, results)
+
+    async def _redo_async(self, task: FailedTask) -> None:
+        """重试执行任务，同步任务在默认线程池中执行，超时的协程任务被取消，同步任务被放弃
+
+        Args:
+            task (FailedTask): 失败的任务
+        """
+        timeout = self._timeout(task)
+        runner, attempt = self._prepare(task, timeout)
+        if runner is None:
+            return
+
+        args, kwargs = attempt.task_args, attempt.task_kwargs
+        try:
+            if isinstance(runner, AsyncRunner):
+                awaitable = runner.run(*args, **kwargs)
+                if timeout > 0:
+                    awaitable = self._wait_for(awaitable, timeout)
+            elif timeout > 0:
+                func = self._fenced(partial(runner.run, *args, **kwargs), attempt)
+                awaitable = self._wait_for(self._loop.run_in_executor(None, func), timeout, attempt)
+            else:
+                awaitable = self._loop.run_in_executor(None, partial(runner.run, *args, **kwargs))
+            await awaitable
+        except ExecutionTimeout as e:
+            self._fail(task, e)
+        except Exception:
+            self._record(task, False)
+            error(f'Task failed: {task}')
+        else:
+            self._record(task, True)
+
+    async def _main_loop_async(self) -> None:
+        """主循环
+        获取所有可用的信号量后批量取出失败任务并创建协程任务执行，无任务时等待唤醒或下一个任务到期
+        """
+        empty_polls = 0     # 下一个任务已到期却未取到任务的连续次数
+        while True:
+            try:
+                await self._semaphore.acquire()
+                acquired = 1
+                while not self._semaphore.locked():
+                    await self._semaphore.acquire()
+                    acquired += 1
+                self._event.clear()
+                wait_time = self._limiter_wait()
+                if wait_time > 0:
+                    for _ in range(acquired):
+                        self._semaphore.release()
+                    await asyncio.sleep(wait_time)
+                    continue
+                now = time.time()
+                start = time.perf_counter()
+                task_list = list()
+                try:
+                    task_list = self._take(acquired)
+                finally:
+                    for _ in range(acquired - len(task_list)):
+                        self._semaphore.release()
+                for _ in range(self._dispatch_all(task_list)):
+                    self._semaphore.release()
+                batch_wait = self._flush_batches()
+                if task_list:
+                    empty_polls = 0
+                    self._count_poll(time.perf_counter() - start, False)
+                    continue
+                next_task = next_failed_task()
+                timeout = self._idle_wait(next_task, now, empty_polls)
+                if batch_wait is not None:
+                    timeout = batch_wait if timeout is None else min(timeout, batch_wait)
+                empty_polls = empty_polls + 1 if next_task is not None and next_task.next_run_time <= now else 0
+                self._count_poll(time.perf_counter() - start, True)
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                metrics.idle.inc(time.perf_counter() - start)
+            except Exception:
+                exception("Async main loop crash!")
+
+    async def start(self, concurrency: int = 100) -> None:
+        """在当前事件循环中启动do机制，该协程不会返回
+
+        Args:
+            concurrency (int, optional): 最大并发重试数. 默认为100.
+        """
+        self._event = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self._loop = asyncio.get_running_loop()
+        await self._main_loop_async()
 
 
 actuator = DoActuator()
+async_actuator = AsyncDoActuator(actuator)
 
 
 
@@ -1,15 +1,27 @@
 import copy
+import hashlib
 import inspect
 import logging
+import pickle
 from functools import partial, wraps
+from typing import Union
 
-from actuator import actuator, MetaProcessor
+from actuator import actuator, async_actuator, MetaProcessor
 from configuration import configuration, configure
-from base import FuncType, TaskType, DefaultNamer, RetryStrategy, FailedTask, Runner
-from do_log import info, configure_logger
+from base import FuncType, TaskType, DefaultNamer, RetryStrategy, FailedTask, Runner, AsyncRunner, BatchRunner
+from breaker import CircuitBreaker
+from do_log import info, debug, configure_logger
+from error import ConfigureException
+from limiter import TokenBucket
+import metrics
+from process_pool import ProcessPoolRunner, call_in_process
 import storage_helper
 task_info = storage_helper.task_info
 start = actuator.start
+register_limiter = actuator.register_limiter
+stats = actuator.stats
+metrics_snapshot = metrics.registry.snapshot
+serve_metrics = metrics.registry.serve
 
 
 class TryNext(Exception):
@@ -19,6 +31,9 @@ class TryNext(Exception):
         self.args = args
         self.kwargs = kwargs
 
+    def __reduce__(self):
+        return partial(TryNext, *self.args, **self.kwargs), ()
+
 
 def do(func: callable = None,
        func_type: FuncType = FuncType.AUTO_CHECK,
@@ -26,10 +41,20 @@ def do(func: callable = None,
        runner_name: str = '',
        namer_cls: type = DefaultNamer,
        max_retry: int = 0,
-       retry_strategy: RetryStrategy = None) -> callable:
+       retry_strategy: RetryStrategy = None,
+       concurrency: int = 0,
+       circuit_breaker: CircuitBreaker = None,
+       rate_limit: TokenBucket = None,
+       coalesce: Union[bool, callable] = False,
+       batch: BatchRunner = None,
+       priority: int = 0,
+       weight: float = 1,
+       process: bool = False,
+       execution_timeout: float = 0) -> callable:
     """函数装饰器
     该装饰器所装饰的函数终将执行成功(除非主动放弃)
     如果func是类的方法，不应该直接装饰，应该采用语句更新方法引用。
+    如果func是协程函数，则在await执行失败时记录失败任务。
 
     Args:
         func (callable): 装饰函数
@@ -39,21 +64,57 @@ def do(func: callable = None,
         namer_cls (type, optional): 任务名生成器类型，默认所有DefaultNamer.
         max_retry (int, optional): 最大重试次数
         retry_strategy (RetryStrategy): 重试策略
+        concurrency (int, optional): 重试时该任务运行器的最大并发数，0表示不限制
+        circuit_breaker (CircuitBreaker, optional): 重试时该任务运行器使用的熔断器
+        rate_limit (TokenBucket, optional): 重试时该任务运行器使用的限流器
+        coalesce (Union[bool, callable], optional): 是否合并相同的失败任务。为True时按(运行器名, 参数)的哈希去重，
+            为函数时以其返回值作为去重键，该函数的参数与被装饰函数相同；存在去重键相同的待重试任务时，新的失败不再新增任务
+        batch (BatchRunner, optional): 批量运行器，重试时将该任务运行器的多个到期任务合并为一次批量处理函数调用
+        priority (int, optional): 失败任务的优先级，数值越大越优先
+        weight (float, optional): 该任务运行器在公平调度中的权重
+        process (bool, optional): 重试时是否在进程池中执行，适用于CPU密集的函数；
+            func必须是模块级的同步函数，子进程按模块名和限定名导入该函数
+        execution_timeout (float, optional): 每次重试的执行超时时间，单位为秒，0表示使用全局配置；
+            超时的协程被取消，同步函数被放弃，超时计为一次失败
     """
     if func is None:
         return partial(do, task_type=task_type, runner_name=runner_name,
-                       namer_cls=namer_cls, max_retry=max_retry, retry_strategy=retry_strategy)
+                       namer_cls=namer_cls, max_retry=max_retry, retry_strategy=retry_strategy,
+                       concurrency=concurrency, circuit_breaker=circuit_breaker,
+                       rate_limit=rate_limit, coalesce=coalesce, batch=batch, priority=priority, weight=weight,
+                       process=process, execution_timeout=execution_timeout)
 
     if not runner_name:
         runner_name = func.__name__
+    if process and (inspect.iscoroutinefunction(func) or '<locals>' in func.__qualname__
+                    or '.' in func.__qualname__):
+        raise ConfigureException(f'process mode requires a module-level function: {func.__qualname__}')
 
     if retry_strategy is not None:
         actuator.register_strategy(runner_name, retry_strategy)
+    if circuit_breaker is not None:
+        actuator.register_breaker(runner_name, circuit_breaker)
+    if rate_limit is not None:
+        actuator.register_limiter(rate_limit, runner_name=runner_name)
+    if batch is not None:
+        actuator.register_batch(runner_name, batch)
 
     def _is_pure_function() -> bool:
         module = inspect.getmodule(func)
         return module is not None and hasattr(module, func.__name__)
 
+    def _dedup_key(args: tuple, task_args: tuple, kwargs: dict) -> Union[str, None]:
+        if not coalesce:
+            return None
+        if callable(coalesce):
+            return f'{runner_name}:{coalesce(*args, **kwargs)}'
+        try:
+            content = pickle.dumps((task_args, sorted(kwargs.items())))
+        except Exception:
+            debug(f'arguments of {runner_name} are not picklable, skip coalescing.')
+            return None
+        return f'{runner_name}:{hashlib.sha1(content).hexdigest()}'
+
     def _first_do(args: tuple, kwargs: dict) -> FailedTask:
         nonlocal runner_name, task_type, max_retry
         local_task_type = configuration.task_type if task_type is None else task_type
@@ -63,38 +124,86 @@ def do(func: callable = None,
         if func_type == FuncType.METHOD or (func_type == FuncType.AUTO_CHECK and not _is_pure_function()):
             task_args = task_args[1:]
         task_name = namer.gen(func, args, kwargs)
-        return storage_helper.new_failed_task(task_name, local_task_type, task_args, kwargs, runner_name, local_max_retry)
+        dedup_key = _dedup_key(args, task_args, kwargs)
+        return storage_helper.new_failed_task(task_name, local_task_type, task_args, kwargs, runner_name,
+                                              local_max_retry, dedup_key, priority)
 
-    @wraps(func)
-    def wrapper(*args, **kwargs) -> object:
+    def _take_task(args: tuple, kwargs: dict) -> FailedTask:
         if MetaProcessor.exists_meta(kwargs):
-            task = MetaProcessor.take_task(kwargs)
+            return MetaProcessor.take_task(kwargs)
+        return _first_do(args, kwargs)
+
+    def _settle(task: FailedTask) -> bool:
+        if actuator.settle(task):
+            return True
+        info(f'task-{task.task_name} finished after execution timeout, drop its result.')
+        return False
+
+    def _on_try_next(task: FailedTask, e: TryNext) -> None:
+        if not _settle(task):
+            return
+        task.task_args = e.args
+        task.task_kwargs = e.kwargs
+        info(f'non-idempotent task-{task.task_name} failed for the {task.retry_count+1}th time.')
+        actuator.handle_failed_task(task, e)
+
+    def _on_failed(task: FailedTask, kwargs: dict, e: Exception) -> None:
+        if not _settle(task):
+            return
+        if task.task_type == TaskType.Idempotent:
+            task.task_kwargs = kwargs
+            info(f'idempotent task-{task.task_name} failed for the {task.retry_count + 1}th time.')
+            actuator.handle_failed_task(task, e)
         else:
-            task = _first_do(args, kwargs)
-
-        try:
-            result = func(*args, **kwargs)
-        except TryNext as e:
-            task.task_args = e.args
-            task.task_kwargs = e.kwargs
-            info(f'non-idempotent task-{task.task_name} failed for the {task.retry_count+1}th time.')
-            actuator.handle_failed_task(task)
-            raise
-        except Exception:
-            if task.task_type == TaskType.Idempotent:
-                task.task_kwargs = kwargs
-                info(f'idempotent task-{task.task_name} failed for the {task.retry_count + 1}th time.')
-                actuator.handle_failed_task(task)
+            info(f"task-{task.task_name} is not idempotent.")
+
+    def _on_success(task: FailedTask) -> None:
+        if not _settle(task):
+            return
+        info(f'task-{task.task_name} success.')
+        storage_helper.task_success(task.task_id)
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> object:
+            task = _take_task(args, kwargs)
+            try:
+                result = await func(*args, **kwargs)
+            except TryNext as e:
+                _on_try_next(task, e)
+                raise
+            except Exception as e:
+                _on_failed(task, kwargs, e)
+                raise
             else:
-                info(f"task-{task.task_name} is not idempotent.")
-            raise
+                _on_success(task)
+                return result
+
+        runner = AsyncRunner(wrapper)
+    else:
+        def _sync_wrapper(call: callable) -> callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs) -> object:
+                task = _take_task(args, kwargs)
+                try:
+                    result = call(*args, **kwargs)
+                except TryNext as e:
+                    _on_try_next(task, e)
+                    raise
+                except Exception as e:
+                    _on_failed(task, kwargs, e)
+                    raise
+                else:
+                    _on_success(task)
+                    return result
+            return wrapper
+
+        wrapper = _sync_wrapper(func)
+        if process:
+            runner = ProcessPoolRunner(_sync_wrapper(partial(call_in_process, func)))
         else:
-            info(f'task-{task.task_name} success.')
-            storage_helper.task_success(task.task_id)
-            return result
-
-    runner = Runner(wrapper)
-    actuator.register_runner(runner_name, runner)
+            runner = Runner(wrapper)
+    actuator.register_runner(runner_name, runner, concurrency, weight, execution_timeout)
     return wrapper
 
 
@@ -108,4 +217,17 @@ def start_do(block: bool=False, log_level: int = logging.ERROR, log_file: bool=F
 
     """
     actuator.start(block=block)
-    configure_logger(level=log_level, log_file=log_file)
\ No newline at end of file
+    configure_logger(level=log_level, log_file=log_file)
+
+
+async def start_async_do(concurrency: int = 100, log_level: int = logging.ERROR, log_file: bool = False):
+    """
+    在当前事件循环中启动，该协程不会返回，一般通过asyncio.create_task启动
+    Args:
+        concurrency: 最大并发重试数
+        log_level: 日志等级
+        log_file: 是否开启文件日志
+
+    """
+    configure_logger(level=log_level, log_file=log_file)
+    await async_actuator.start(concurrency=concurrency)
@@ -1,3 +1,4 @@
+import random
 import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
@@ -24,6 +25,16 @@ class FuncType(IntEnum):
     AUTO_CHECK = 3  # 自动识别（但不保证准确）
 
 
+class OverflowPolicy(IntEnum):
+    """缓冲区满时的处理策略"""
+    Block = 1   # 阻塞调用者直到缓冲区有空位
+    DropNewest = 2  # 丢弃新的失败任务
+    DropOldest = 3  # 丢弃缓冲区中最早的失败任务
+    WriteThrough = 4    # 在调用者线程中直接写入存储器
+    DropLowestPriority = 5  # 丢弃优先级最低的失败任务
+    Spill = 6   # 将溢出的失败任务写入磁盘存储器，有空位时再加载回内存
+
+
 ANY_TIME = -1   # 任何时候
 
 
@@ -35,8 +46,8 @@ class FailedTask:
     task_id: int    # 任务唯一标识
     task_type: TaskType  # 任务类型
     task_name: str  # 任务名
-    task_args: list  # 任务变长参数
-    task_kwargs: dict   # 任务关键字参数
+    task_args: list  # 任务变长参数，为None表示尚未从存储器加载
+    task_kwargs: dict   # 任务关键字参数，为None表示尚未从存储器加载
     runner_name: str    # 任务执行器名
     retry_count: int    # 当前重试次数
     max_retry: int  # 最大重试次数
@@ -44,6 +55,9 @@ class FailedTask:
     update_time: float  # 更新时间
     next_run_time: float    # 下次执行时间
     state: TaskState    # 任务状态
+    dedup_key: str = None   # 去重键，存在去重键相同的待重试任务时，新失败任务合并到该任务而不再新增
+    priority: int = 0   # 优先级，数值越大越优先，到期任务中优先级高的先被取出
+    retry_delay: float = 0  # 上次失败时设定的退避时间，因限流、熔断等推迟执行时不变
 
     def __gt__(self, other):
         return self.task_id < other.task_id
@@ -82,6 +96,71 @@ class Storage(ABC):
         """
         pass
 
+    def take_many(self, n: int) -> [FailedTask]:
+        """返回至多n个执行失败的任务，默认逐个调用take，子类可覆盖为批量实现
+        到期任务应按优先级从高到低、再按下次执行时间返回
+
+        Args:
+            n (int): 最大任务数
+
+        Returns:
+            [FailedTask]: 失败任务列表
+        """
+        task_list = list()
+        for _ in range(n):
+            task = self.take()
+            if task is None:
+                break
+            task_list.append(task)
+        return task_list
+
+    def take_ahead(self, horizon: float, n: int) -> [FailedTask]:
+        """提前取出至多n个在horizon秒内到期的任务，用于预取到内存中调度；默认只取出已到期的任务
+
+        Args:
+            horizon (float): 预取的时间范围，单位为秒
+            n (int): 最大任务数
+
+        Returns:
+            [FailedTask]: 失败任务列表
+        """
+        return self.take_many(n)
+
+    def put_many(self, tasks: [FailedTask]) -> None:
+        """批量新增失败任务，默认逐个调用put，子类可覆盖为批量实现
+        新任务带有去重键且已存在去重键相同的待重试任务时，存储器应将其合并到已有任务，并将其ID设置为已有任务的ID
+
+        Args:
+            tasks ([FailedTask]): 失败任务列表
+        """
+        for task in tasks:
+            self.put(task)
+
+    def remove_many(self, task_ids: [int]) -> None:
+        """根据ID批量移除失败任务，默认逐个调用remove，子类可覆盖为批量实现
+
+        Args:
+            task_ids ([int]): 任务ID列表
+        """
+        for task_id in task_ids:
+            self.remove(task_id)
+
+    def load_payload(self, tasks: [FailedTask]) -> None:
+        """加载任务参数
+        存储器可以在take_many、all、get_next中只返回调度所需的字段，任务即将执行时再通过该方法加载参数，
+        参数未加载的任务被put时只更新调度字段；默认任务总是携带参数，无需加载
+
+        Args:
+            tasks ([FailedTask]): 参数未加载的任务列表
+        """
+        pass
+
+    def pending_count(self) -> int:
+        """
+        Returns: 待重试任务数，默认通过all统计，子类可覆盖为高效实现
+        """
+        return sum(1 for task in self.all() if task.state == TaskState.Failed)
+
     @abstractmethod
     def all(self) -> [FailedTask]:
         """
@@ -97,6 +176,56 @@ class Storage(ABC):
         pass
 
 
+class Scheduler(ABC):
+    """调度器，按下次执行时间排列失败任务，由调用者保证互斥"""
+
+    @abstractmethod
+    def push(self, task: FailedTask) -> None:
+        """放入任务，已存在的任务按新的执行时间重新调度
+
+        Args:
+            task (FailedTask): 失败任务
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, task_id: int) -> None:
+        """根据ID移除任务
+
+        Args:
+            task_id (int): 任务ID
+        """
+        pass
+
+    @abstractmethod
+    def peek(self) -> FailedTask:
+        """
+        Returns: 返回最早执行的任务，不移除
+        """
+        pass
+
+    @abstractmethod
+    def pop_due(self, now: float, n: int) -> [FailedTask]:
+        """弹出至多n个已到期的任务
+
+        Args:
+            now (float): 当前时间
+            n (int): 最大任务数
+
+        Returns:
+            [FailedTask]: 到期任务列表
+        """
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __contains__(self, task_id: int) -> bool:
+        pass
+
+
 class Runner:
     """任务运行器"""
 
@@ -117,6 +246,48 @@ class Runner:
         return self.func(*args, **kwargs)
 
 
+class AsyncRunner(Runner):
+    """协程任务运行器"""
+
+    async def run(self, *args, **kwargs) -> object:
+        """执行协程任务
+
+        Returns:
+            object: 任务执行结果
+        """
+        return await self.func(*args, **kwargs)
+
+
+class BatchRunner:
+    """
+    批量任务运行器
+    重试时将同一运行器的多个到期任务合并为一次调用
+    """
+
+    def __init__(self, handler: callable, max_size: int = 100, max_wait: float = 0.05) -> None:
+        """
+        Args:
+            handler (callable): 批量处理函数(可以是协程函数)，参数为[(args, kwargs)]，返回与之等长的结果列表，
+                结果为异常实例表示对应的任务失败，其余为成功；处理函数抛出异常时所有任务失败
+            max_size (int, optional): 每批最大任务数
+            max_wait (float, optional): 收集一批任务的最长等待时间，单位为秒
+        """
+        self.handler = handler
+        self.max_size = max(max_size, 1)
+        self.max_wait = max_wait
+
+    def check(self, items: list, results: list) -> list:
+        """检查处理函数的返回值
+
+        Returns:
+            list: 结果列表
+        """
+        results = list(results)
+        if len(results) != len(items):
+            raise ValueError(f'batch handler returned {len(results)} results for {len(items)} tasks.')
+        return results
+
+
 class BaseNamer(ABC):
     """
     任务名生成器
@@ -164,6 +335,17 @@ class RetryStrategy(ABC):
         """
         pass
 
+    def next_run_time_on_error(self, task: FailedTask, error: Exception = None) -> float:
+        """根据失败任务和导致失败的异常计算下次执行时间，默认忽略异常
+
+        Args:
+            task: 失败任务
+            error: 导致失败的异常，未知时为None
+
+        Returns: 下次执行时间
+        """
+        return self.next_run_time(task)
+
 
 class DefaultStrategy(RetryStrategy):
     """
@@ -187,3 +369,96 @@ class IntervalStrategy(RetryStrategy):
     def next_run_time(self, task: FailedTask) -> float:
         return time.time() + self._interval
 
+
+class Jitter(IntEnum):
+    """退避时间的随机抖动方式"""
+    Off = 0     # 不抖动
+    Full = 1    # 在[0, 退避时间]内随机
+    Equal = 2   # 在[退避时间/2, 退避时间]内随机
+
+
+class ExponentialBackoffStrategy(RetryStrategy):
+    """
+    指数退避重试策略：第n次失败后等待min(cap, base * factor^n)秒，可叠加随机抖动以分散重试
+    """
+    def __init__(self, base: float = 1, factor: float = 2, cap: float = 3600, jitter: Jitter = Jitter.Full):
+        """
+        Args:
+            base: 首次重试的退避时间，单位为秒
+            factor: 退避时间的增长倍数
+            cap: 退避时间上限，单位为秒
+            jitter: 随机抖动方式
+        """
+        self._base = base
+        self._factor = factor
+        self._cap = cap
+        self._jitter = jitter
+
+    def backoff(self, retry_count: int) -> float:
+        """
+        Args:
+            retry_count: 已重试次数
+
+        Returns: 不含抖动的退避时间
+        """
+        try:
+            return min(self._cap, self._base * self._factor ** retry_count)
+        except OverflowError:
+            return self._cap
+
+    def next_run_time(self, task: FailedTask) -> float:
+        delay = self.backoff(task.retry_count)
+        if self._jitter == Jitter.Full:
+            delay = random.uniform(0, delay)
+        elif self._jitter == Jitter.Equal:
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        return time.time() + delay
+
+
+class DecorrelatedJitterStrategy(RetryStrategy):
+    """
+    去相关抖动重试策略：退避时间在[base, 上次退避时间 * 3]内随机，且不超过cap
+    上次退避时间取自任务的retry_delay，任务因限流、熔断等被推迟不影响退避时间的计算
+    """
+    def __init__(self, base: float = 1, cap: float = 3600):
+        """
+        Args:
+            base: 最小退避时间，单位为秒
+            cap: 退避时间上限，单位为秒
+        """
+        self._base = base
+        self._cap = cap
+
+    def next_run_time(self, task: FailedTask) -> float:
+        last_delay = self._base
+        if task.retry_count > 0:
+            last_delay = max(self._base, task.retry_delay)
+        delay = min(self._cap, random.uniform(self._base, last_delay * 3))
+        return time.time() + delay
+
+
+class ErrorStrategy(RetryStrategy):
+    """
+    按异常类型选择重试策略：按注册顺序匹配第一个isinstance成立的异常类型，未匹配时使用默认策略
+    """
+    def __init__(self, default: RetryStrategy, overrides: dict = None):
+        """
+        Args:
+            default: 默认重试策略
+            overrides: 异常类型 -> 重试策略
+        """
+        self._default = default
+        self._overrides = dict() if overrides is None else dict(overrides)
+
+    def _select(self, error: Exception) -> RetryStrategy:
+        if error is not None:
+            for error_cls, strategy in self._overrides.items():
+                if isinstance(error, error_cls):
+                    return strategy
+        return self._default
+
+    def next_run_time(self, task: FailedTask) -> float:
+        return self._default.next_run_time(task)
+
+    def next_run_time_on_error(self, task: FailedTask, error: Exception = None) -> float:
+        return self._select(error).next_run_time_on_error(task, error)
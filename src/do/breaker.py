@@ -0,0 +1,113 @@
+import time
+from collections import deque
+from enum import IntEnum
+from threading import Lock
+
+
+class BreakerState(IntEnum):
+    """熔断器状态"""
+    Closed = 0  # 关闭，正常执行
+    Open = 1    # 打开，拒绝执行
+    HalfOpen = 2    # 半开，只允许少量探测任务执行
+
+
+class CircuitBreaker:
+    """
+    熔断器
+    统计时间窗口内的执行结果，失败率达到阈值时打开；打开一段时间后进入半开状态，
+    放行少量探测任务，探测成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, failure_rate: float = 0.5, window: float = 60, min_calls: int = 10,
+                 open_timeout: float = 30, probes: int = 1) -> None:
+        """
+        Args:
+            failure_rate: 打开熔断器的失败率阈值
+            window: 统计时间窗口，单位为秒
+            min_calls: 窗口内至少执行多少次才计算失败率
+            open_timeout: 打开状态持续时间，单位为秒
+            probes: 半开状态下同时放行的探测任务数
+        """
+        self._failure_rate = failure_rate
+        self._window = window
+        self._min_calls = max(min_calls, 1)
+        self._open_timeout = open_timeout
+        self._probes = max(probes, 1)
+        self._state = BreakerState.Closed
+        self._results = deque()     # 窗口内的执行结果：(时间, 是否成功)
+        self._failures = 0  # 窗口内的失败次数
+        self._opened_at = 0     # 打开时间
+        self._probing = 0   # 执行中的探测任务数
+        self._lock = Lock()
+
+    @property
+    def state(self) -> BreakerState:
+        with self._lock:
+            self._check_timeout(time.time())
+            return self._state
+
+    def _check_timeout(self, now: float) -> None:
+        if self._state == BreakerState.Open and now >= self._opened_at + self._open_timeout:
+            self._state = BreakerState.HalfOpen
+            self._probing = 0
+
+    def _open(self, now: float) -> None:
+        self._state = BreakerState.Open
+        self._opened_at = now
+        self._results.clear()
+        self._failures = 0
+
+    def allow(self) -> bool:
+        """
+        Returns: 是否允许执行任务，半开状态下放行的任务作为探测任务
+        """
+        with self._lock:
+            self._check_timeout(time.time())
+            if self._state == BreakerState.Closed:
+                return True
+            if self._state == BreakerState.HalfOpen and self._probing < self._probes:
+                self._probing += 1
+                return True
+            return False
+
+    def release(self) -> None:
+        """归还被放行但未执行的任务占用的探测名额，不记录执行结果"""
+        with self._lock:
+            if self._state == BreakerState.HalfOpen:
+                self._probing = max(self._probing - 1, 0)
+
+    def retry_at(self) -> float:
+        """
+        Returns: 被拒绝的任务应推迟到的时间
+        """
+        with self._lock:
+            if self._state == BreakerState.Open:
+                return self._opened_at + self._open_timeout
+            return time.time() + self._open_timeout
+
+    def record(self, success: bool) -> None:
+        """记录一次执行结果
+
+        Args:
+            success: 是否执行成功
+        """
+        with self._lock:
+            now = time.time()
+            if self._state == BreakerState.HalfOpen:
+                self._probing = max(self._probing - 1, 0)
+                if success:
+                    self._state = BreakerState.Closed
+                else:
+                    self._open(now)
+                return
+            if self._state == BreakerState.Open:
+                return
+
+            self._results.append((now, success))
+            if not success:
+                self._failures += 1
+            while self._results and self._results[0][0] < now - self._window:
+                if not self._results.popleft()[1]:
+                    self._failures -= 1
+            if len(self._results) >= self._min_calls and self._failures >= self._failure_rate * len(self._results):
+                self._open(now)
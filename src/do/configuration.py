@@ -1,6 +1,6 @@
 from dataclasses import dataclass, field
 
-from base import Storage, RetryStrategy, DefaultStrategy, TaskType
+from base import Storage, RetryStrategy, DefaultStrategy, TaskType, OverflowPolicy
 from error import ConfigureException
 from storage.memory import MemoryStorage
 
@@ -14,11 +14,31 @@ class Configuration:
     max_retry: int = field(default=-1)
     storage: Storage = field(default=MemoryStorage())
     strategy: RetryStrategy = field(default=DefaultStrategy())
+    workers: int = field(default=1)
+    write_behind: bool = field(default=False)
+    flush_interval: float = field(default=0.05)
+    buffer_size: int = field(default=10000)
+    overflow_policy: OverflowPolicy = field(default=OverflowPolicy.Block)
+    retry_floor: float = field(default=0.01)
+    idle_backoff: float = field(default=0.05)
+    fair_window: int = field(default=1)
+    processes: int = field(default=0)
+    execution_timeout: float = field(default=0)
 
     def configure(self, task_type: TaskType = None,
                   storage: Storage = None,
                   max_retry: int = None,
-                  namer_cls: type = None) -> None:
+                  namer_cls: type = None,
+                  workers: int = None,
+                  write_behind: bool = None,
+                  flush_interval: float = None,
+                  buffer_size: int = None,
+                  overflow_policy: OverflowPolicy = None,
+                  retry_floor: float = None,
+                  idle_backoff: float = None,
+                  fair_window: int = None,
+                  processes: int = None,
+                  execution_timeout: float = None) -> None:
         """配置全局参数
 
         Args:
@@ -26,6 +46,17 @@ class Configuration:
             storage (Storage, optional): 存储模式.
             max_retry (int, optional): 最大重试次数.
             namer_cls (type, optional): 命名生成器.
+            workers (int, optional): 重试工作线程数，需在启动前配置.
+            write_behind (bool, optional): 是否先将失败任务写入内存缓冲区，再由后台线程批量写入存储器.
+            flush_interval (float, optional): 缓冲区刷写间隔，单位为秒.
+            buffer_size (int, optional): 缓冲区容量.
+            overflow_policy (OverflowPolicy, optional): 缓冲区满时的处理策略.
+            retry_floor (float, optional): 同一任务两次重试的最小间隔，单位为秒，避免持续失败的任务占满CPU.
+            idle_backoff (float, optional): 主循环空转时的最大退避时间，单位为秒.
+            fair_window (int, optional): 公平调度窗口，每次取出空闲工作线程数fair_window倍的到期任务，按优先级和执行器权重
+                选出要执行的任务，其余放回存储器；1表示只按存储器返回的顺序执行.
+            processes (int, optional): 进程池的进程数，0表示CPU核数，需在启动前配置.
+            execution_timeout (float, optional): 每次重试的执行超时时间，单位为秒，0表示不限制.
         """
         try:
             kwargs = locals().copy()
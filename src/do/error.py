@@ -20,3 +20,10 @@ class DataException(DoException):
 
     def __init__(self, msg, *args: object) -> None:
         super().__init__(msg, *args)
+
+
+class ExecutionTimeout(DoException):
+    """重试执行超时"""
+
+    def __init__(self, msg, *args: object) -> None:
+        super().__init__(msg, *args)
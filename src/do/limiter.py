@@ -0,0 +1,53 @@
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """
+    令牌桶限流器
+    令牌以固定速率生成，最多积攒burst个，每次执行消耗一个令牌
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """
+        Args:
+            rate: 每秒生成的令牌数
+            burst: 令牌桶容量，即允许的最大突发执行数
+        """
+        if rate <= 0:
+            raise ValueError(f'rate must be positive: {rate}')
+        self.rate = rate
+        self._burst = max(burst, 1)
+        self._tokens = float(self._burst)
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self) -> float:
+        """
+        Returns: 距离下一个令牌可用的时间，单位为秒，有令牌时为0
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def acquire(self) -> float:
+        """尝试获取一个令牌
+
+        Returns: 获取成功返回0，否则返回距离下一个令牌可用的时间
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def refund(self) -> None:
+        """归还一个已获取但未使用的令牌"""
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + 1)
@@ -0,0 +1,241 @@
+import bisect
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from do_log import exception
+
+
+class Metric:
+    """
+    指标基类
+    每组标签值对应一个值，更新和快照都只在单个指标的锁内复制少量数据
+    """
+    type = ''   # Prometheus指标类型
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        """
+        Args:
+            name: 指标名
+            documentation: 指标说明
+            labels: 标签名
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = dict()   # 标签值 -> 指标值
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def snapshot(self) -> dict:
+        """
+        Returns: 标签值 -> 指标值的副本
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> [(str, tuple, float)]:
+        """
+        Returns: Prometheus样本列表：(样本名后缀, 标签名值对, 值)
+        """
+        return [('', tuple(zip(self.labels, key)), value) for key, value in self.snapshot().items()]
+
+
+class Counter(Metric):
+    """单调递增的计数器"""
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的瞬时值，设置了func时在快照时调用func取值"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), func: callable = None) -> None:
+        """
+        Args:
+            func: 无参取值函数，只用于无标签的指标
+        """
+        super().__init__(name, documentation, labels)
+        self._func = func
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def snapshot(self) -> dict:
+        if self._func is None:
+            return super().snapshot()
+        try:
+            value = self._func()
+        except Exception:
+            exception(f'failed to collect metric {self.name}.')
+            return dict()
+        return {} if value is None else {(): value}
+
+
+class Histogram(Metric):
+    """直方图，按桶上界统计观测值的分布，同时记录观测值的总和与个数"""
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)     # 默认桶上界，单位为秒
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        """
+        Args:
+            buckets: 从小到大的桶上界，最后隐含一个+Inf桶
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录with语句块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        Returns: 标签值 -> (各桶的计数(非累计), 总和, 个数)
+        """
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def samples(self) -> [(str, tuple, float)]:
+        samples = list()
+        for key, (counts, total, count) in self.snapshot().items():
+            labels = tuple(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append(('_bucket', labels + (('le', le),), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value)) if value == value else 'NaN'
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+    提供所有指标的快照和Prometheus文本格式输出，并可以在后台线程中通过HTTP提供输出
+    """
+
+    def __init__(self) -> None:
+        self._metrics = dict()  # 指标名 -> 指标
+        self._lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """注册指标，同名指标会被替换
+
+        Returns:
+            Metric: 注册的指标
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def _all(self) -> [Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> dict:
+        """
+        Returns: 指标名 -> (标签值 -> 指标值)
+        """
+        return {metric.name: metric.snapshot() for metric in self._all()}
+
+    def exposition(self) -> str:
+        """
+        Returns: Prometheus文本格式的所有指标
+        """
+        lines = list()
+        for metric in self._all():
+            lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                label_text = ','.join(f'{name}="{_escape(str(label))}"' for name, label in labels)
+                label_text = f'{{{label_text}}}' if label_text else ''
+                lines.append(f'{metric.name}{suffix}{label_text} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9464, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """在后台守护线程中启动HTTP服务，GET /metrics返回Prometheus文本格式的指标
+
+        Args:
+            port (int, optional): 端口，0表示由系统分配
+            host (str, optional): 监听地址，默认只监听本机
+
+        Returns:
+            ThreadingHTTPServer: HTTP服务，可通过server_address获取实际端口，通过shutdown停止
+        """
+        registry = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        Thread(name='do-metrics', target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _queue_depth() -> int:
+    from configuration import configuration
+    return configuration.storage.pending_count()
+
+
+registry = MetricsRegistry()    # 默认注册表
+failures = registry.register(Counter('do_failures_total', 'Failed executions recorded for retry.', ('runner',)))
+retries = registry.register(Counter('do_retries_total', 'Retries attempted, by result.', ('runner', 'result')))
+exhausted = registry.register(Counter('do_retries_exhausted_total', 'Tasks stopped after reaching max_retry.',
+                                      ('runner',)))
+queue_depth = registry.register(Gauge('do_queue_depth', 'Tasks waiting to be retried.', func=_queue_depth))
+schedule_lag = registry.register(Histogram('do_schedule_lag_seconds', 'Delay between a task becoming due and being '
+                                           'taken.', ('runner',), buckets=(0.01, 0.1, 1, 10, 60, 600, 3600)))
+execution = registry.register(Histogram('do_execution_seconds', 'Retry execution latency.', ('runner',)))
+storage_latency = registry.register(Histogram('do_storage_seconds', 'Storage operation latency.', ('op',)))
+idle = registry.register(Counter('do_idle_seconds_total', 'Time the dispatch loops spent idle waiting.'))
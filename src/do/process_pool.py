@@ -0,0 +1,56 @@
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from base import Runner
+from configuration import configuration
+
+_executor = None    # 共享的进程池
+_lock = Lock()
+
+
+def _invoke(module: str, qualname: str, args: tuple, kwargs: dict) -> object:
+    """在子进程中按限定名导入模块级函数并执行
+    模块中的名字指向do装饰后的包装函数，需解开一层得到原函数，避免子进程再次记录失败任务
+    """
+    target = importlib.import_module(module)
+    for name in qualname.split('.'):
+        target = getattr(target, name)
+    target = getattr(target, '__wrapped__', target)
+    return target(*args, **kwargs)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """获取共享的进程池，首次获取时创建并预先启动所有子进程
+
+    Returns:
+        ProcessPoolExecutor: 进程数由configuration.processes配置的进程池
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            processes = configuration.processes or os.cpu_count() or 1
+            _executor = ProcessPoolExecutor(max_workers=processes)
+            for future in [_executor.submit(os.getpid) for _ in range(processes)]:
+                future.result()
+        return _executor
+
+
+def call_in_process(func: callable, *args, **kwargs) -> object:
+    """将模块级函数交给进程池执行并等待结果，子进程中抛出的异常会在当前线程重新抛出
+
+    Args:
+        func (callable): 模块级函数
+
+    Returns:
+        object: 函数执行结果
+    """
+    return get_executor().submit(_invoke, func.__module__, func.__qualname__, args, kwargs).result()
+
+
+class ProcessPoolRunner(Runner):
+    """
+    进程池任务运行器
+    func在工作线程中执行，负责记录任务结果，其内部通过call_in_process将原函数交给子进程执行
+    """
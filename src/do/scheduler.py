@@ -0,0 +1,203 @@
+import heapq
+import itertools
+import math
+import time
+
+from base import FailedTask, Scheduler
+
+
+class HeapScheduler(Scheduler):
+    """
+    以任务ID为索引的小顶堆，按下次执行时间排序
+    到期的任务在弹出前先移入就绪堆，就绪堆按优先级从高到低、再按下次执行时间排序，因此到期任务中优先级高的先弹出。
+    删除和重新调度采用惰性删除：旧条目只做失效标记，到达堆顶时丢弃，失效条目过多时重建堆。
+    """
+    _COMPACT_MIN = 64   # 触发重建堆的最少失效条目数
+
+    def __init__(self) -> None:
+        self._heap = list()     # 堆条目：[下次执行时间, 序号, 任务]，任务为None表示已失效
+        self._ready = list()    # 就绪堆条目：[-优先级, 下次执行时间, 序号, 任务]
+        self._entries = dict()  # 任务ID -> 有效的堆条目
+        self._counter = itertools.count()   # 序号，保证相同执行时间时先进先出
+        self._stale = 0     # 失效条目数
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self._entries
+
+    def push(self, task: FailedTask) -> None:
+        """放入任务，已存在的任务按新的执行时间重新调度"""
+        self._invalidate(task.task_id)
+        entry = [task.next_run_time, next(self._counter), task]
+        self._entries[task.task_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, task_id: int) -> None:
+        self._invalidate(task_id)
+
+    def peek(self) -> FailedTask:
+        """返回最早执行的任务，不出堆；就绪堆不为空时返回就绪堆顶的已到期任务"""
+        self._prune()
+        if self._ready:
+            return self._ready[0][-1]
+        return self._heap[0][-1] if self._heap else None
+
+    def pop_due(self, now: float, n: int) -> [FailedTask]:
+        """弹出至多n个执行时间不晚于now的任务，优先级高的先弹出"""
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            next_run_time, seq, task = heapq.heappop(self._heap)
+            entry = [-task.priority, next_run_time, seq, task]
+            self._entries[task.task_id] = entry
+            heapq.heappush(self._ready, entry)
+            self._prune()
+        task_list = list()
+        while self._ready and len(task_list) < n:
+            task = heapq.heappop(self._ready)[-1]
+            del self._entries[task.task_id]
+            task_list.append(task)
+            self._prune()
+        return task_list
+
+    def _invalidate(self, task_id: int) -> None:
+        entry = self._entries.pop(task_id, None)
+        if entry is not None:
+            entry[-1] = None
+            self._stale += 1
+            if self._stale >= self._COMPACT_MIN and self._stale * 2 >= len(self._heap) + len(self._ready):
+                self._compact()
+
+    def _prune(self) -> None:
+        for heap in (self._heap, self._ready):
+            while heap and heap[0][-1] is None:
+                heapq.heappop(heap)
+                self._stale -= 1
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if entry[-1] is not None]
+        self._ready = [entry for entry in self._ready if entry[-1] is not None]
+        heapq.heapify(self._heap)
+        heapq.heapify(self._ready)
+        self._stale = 0
+
+
+class TimingWheelScheduler(Scheduler):
+    """
+    分层时间轮调度器
+    时间被划分为长度为tick的刻度，每层时间轮有wheel_size个槽，第l层每个槽覆盖wheel_size^l个刻度。
+    任务放入与其到期刻度同属一个上层窗口的最低层槽中，时间推进到上层槽边界时将该槽任务下放到低层，
+    到达第0层的任务在所在刻度整体到期。放入和删除为O(1)，到期任务以刻度为单位批量释放，
+    因此任务最多可能提前一个tick到期。
+    """
+
+    def __init__(self, tick: float = 0.01, wheel_size: int = 256, levels: int = 4) -> None:
+        """
+        Args:
+            tick: 刻度长度，单位为秒
+            wheel_size: 每层槽数，必须为2的幂
+            levels: 层数，超出最高层范围的任务暂存在溢出表中
+        """
+        if wheel_size <= 1 or wheel_size & (wheel_size - 1):
+            raise ValueError(f'wheel_size must be a power of 2: {wheel_size}')
+        self._tick = tick
+        self._bits = wheel_size.bit_length() - 1
+        self._mask = wheel_size - 1
+        self._levels = levels
+        self._wheels = [[dict() for _ in range(wheel_size)] for _ in range(levels)]    # 槽：任务ID -> 任务
+        self._counts = [0] * levels     # 各层任务数
+        self._overflow = dict()     # 超出最高层范围的任务
+        self._ready = HeapScheduler()   # 已到期的任务
+        self._slots = dict()    # 任务ID -> 所在的槽
+        self._current = self._to_tick(time.time())  # 当前刻度
+
+    def __len__(self) -> int:
+        return len(self._slots) + len(self._ready)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self._slots or task_id in self._ready
+
+    def _to_tick(self, timestamp: float) -> int:
+        return math.floor(timestamp / self._tick)
+
+    def push(self, task: FailedTask) -> None:
+        self.remove(task.task_id)
+        self._place(task)
+
+    def remove(self, task_id: int) -> None:
+        slot = self._slots.pop(task_id, None)
+        if slot is None:
+            self._ready.remove(task_id)
+            return
+        level, bucket = slot
+        del bucket[task_id]
+        if level < self._levels:
+            self._counts[level] -= 1
+
+    def _place(self, task: FailedTask) -> None:
+        """将任务放入与到期刻度同属一个上层窗口的最低层槽中"""
+        due = self._to_tick(task.next_run_time)
+        if due <= self._current:
+            self._ready.push(task)
+            return
+        level = ((due ^ self._current).bit_length() - 1) // self._bits
+        if level < self._levels:
+            bucket = self._wheels[level][(due >> (self._bits * level)) & self._mask]
+            self._counts[level] += 1
+        else:
+            bucket = self._overflow
+        bucket[task.task_id] = task
+        self._slots[task.task_id] = (level, bucket)
+
+    def _cascade(self, level: int, bucket: dict) -> None:
+        if not bucket:
+            return
+        tasks = list(bucket.values())
+        bucket.clear()
+        if level < self._levels:
+            self._counts[level] -= len(tasks)
+        for task in tasks:
+            del self._slots[task.task_id]
+            self._place(task)
+
+    def _advance(self, target: int) -> None:
+        """推进到目标刻度，低层为空时直接跳到下一个需要下放的上层槽边界"""
+        while self._current < target:
+            lowest = next((level for level in range(self._levels) if self._counts[level]), None)
+            if lowest is None:
+                lowest = self._levels if self._overflow else None
+            if lowest is None:
+                self._current = target
+                return
+            shift = self._bits * lowest
+            self._current = min(target, ((self._current >> shift) + 1) << shift)
+            if self._overflow and self._current % (1 << (self._bits * self._levels)) == 0:
+                self._cascade(self._levels, self._overflow)
+            for level in range(self._levels - 1, -1, -1):
+                shift = self._bits * level
+                if self._current % (1 << shift) == 0:
+                    self._cascade(level, self._wheels[level][(self._current >> shift) & self._mask])
+
+    def pop_due(self, now: float, n: int) -> [FailedTask]:
+        self._advance(self._to_tick(now))
+        return self._ready.pop_due(math.inf, n)
+
+    def peek(self) -> FailedTask:
+        """返回最早执行的任务：每层从当前位置向后第一个非空槽中最早的任务，再取各层的最小值"""
+        candidates = list()
+        ready = self._ready.peek()
+        if ready is not None:
+            candidates.append(ready)
+        for level in range(self._levels):
+            if not self._counts[level]:
+                continue
+            position = (self._current >> (self._bits * level)) & self._mask
+            for index in range(position + 1, self._mask + 1):
+                bucket = self._wheels[level][index]
+                if bucket:
+                    candidates.append(min(bucket.values(), key=lambda task: task.next_run_time))
+                    break
+        if self._overflow:
+            candidates.append(min(self._overflow.values(), key=lambda task: task.next_run_time))
+        return min(candidates, key=lambda task: task.next_run_time, default=None)
@@ -0,0 +1,146 @@
+import json
+import pickle
+import zlib
+from abc import ABC, abstractmethod
+from typing import Union
+
+from error import DataException, ConfigureException
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(ABC):
+    """
+    任务参数编解码器
+    每种编解码器有唯一的codec_id，随数据一起保存，读取时据此选择解码器
+    """
+    codec_id = -1   # 编解码器ID
+
+    @abstractmethod
+    def encode(self, task_args: tuple, task_kwargs: dict) -> (Union[str, bytes], Union[str, bytes]):
+        """
+        Args:
+            task_args: 位置参数
+            task_kwargs: 关键字参数
+
+        Returns:
+            (Union[str, bytes], Union[str, bytes]): 编码后的位置参数和关键字参数
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, args_data: Union[str, bytes], kwargs_data: Union[str, bytes]) -> (tuple, dict):
+        """
+        Args:
+            args_data: 编码后的位置参数
+            kwargs_data: 编码后的关键字参数
+
+        Returns:
+            (tuple, dict): 位置参数和关键字参数
+        """
+        pass
+
+
+class JsonCodec(Codec):
+    """JSON编解码器，兼容引入编解码器之前写入的数据"""
+    codec_id = 0
+
+    def encode(self, task_args: tuple, task_kwargs: dict) -> (str, str):
+        return json.dumps({'task_args': task_args}), json.dumps(task_kwargs)
+
+    def decode(self, args_data: Union[str, bytes], kwargs_data: Union[str, bytes]) -> (list, dict):
+        return json.loads(args_data)['task_args'], json.loads(kwargs_data)
+
+
+class PickleCodec(Codec):
+    """pickle编解码器，支持bytes、datetime、dataclass等任意可pickle的参数"""
+    codec_id = 1
+
+    def __init__(self, protocol: int = pickle.HIGHEST_PROTOCOL) -> None:
+        """
+        Args:
+            protocol: pickle协议版本
+        """
+        self._protocol = protocol
+
+    def encode(self, task_args: tuple, task_kwargs: dict) -> (bytes, bytes):
+        return pickle.dumps(task_args, self._protocol), pickle.dumps(task_kwargs, self._protocol)
+
+    def decode(self, args_data: bytes, kwargs_data: bytes) -> (tuple, dict):
+        return pickle.loads(args_data), pickle.loads(kwargs_data)
+
+
+class MsgpackCodec(Codec):
+    """msgpack编解码器，紧凑的二进制格式，解码时不会执行任意代码；需要安装msgpack"""
+    codec_id = 2
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise ConfigureException('MsgpackCodec requires msgpack, please install it first.')
+
+    def encode(self, task_args: tuple, task_kwargs: dict) -> (bytes, bytes):
+        return msgpack.packb(task_args, use_bin_type=True), msgpack.packb(task_kwargs, use_bin_type=True)
+
+    def decode(self, args_data: bytes, kwargs_data: bytes) -> (list, dict):
+        return msgpack.unpackb(args_data, raw=False), msgpack.unpackb(kwargs_data, raw=False)
+
+
+COMPRESSED = 0x100  # 压缩标志位，与codec_id按位或后保存
+
+_registry = {JsonCodec.codec_id: JsonCodec(), PickleCodec.codec_id: PickleCodec()}
+if msgpack is not None:
+    _registry[MsgpackCodec.codec_id] = MsgpackCodec()
+
+
+def register_codec(codec: Codec) -> None:
+    """注册编解码器，读取数据时按codec_id查找
+
+    Args:
+        codec (Codec): 编解码器
+    """
+    _registry[codec.codec_id] = codec
+
+
+def encode(codec: Codec, task_args: tuple, task_kwargs: dict, compress_threshold: int = 0) -> (int, bytes, bytes):
+    """编码任务参数，编码后的总长度不小于压缩阈值时使用zlib压缩
+
+    Args:
+        codec (Codec): 编解码器
+        task_args (tuple): 位置参数
+        task_kwargs (dict): 关键字参数
+        compress_threshold (int, optional): 压缩阈值，单位为字节，0表示不压缩
+
+    Returns:
+        (int, bytes, bytes): 保存的编解码器标识、位置参数和关键字参数
+    """
+    args_data, kwargs_data = codec.encode(task_args, task_kwargs)
+    if compress_threshold <= 0 or len(args_data) + len(kwargs_data) < compress_threshold:
+        return codec.codec_id, args_data, kwargs_data
+    if isinstance(args_data, str):
+        args_data, kwargs_data = args_data.encode(), kwargs_data.encode()
+    return codec.codec_id | COMPRESSED, zlib.compress(args_data), zlib.compress(kwargs_data)
+
+
+def decode(codec_id: int, args_data: Union[str, bytes], kwargs_data: Union[str, bytes]) -> (tuple, dict):
+    """解码任务参数
+
+    Args:
+        codec_id (int): 保存的编解码器标识，None表示引入编解码器之前写入的JSON数据
+        args_data (Union[str, bytes]): 位置参数
+        kwargs_data (Union[str, bytes]): 关键字参数
+
+    Returns:
+        (tuple, dict): 位置参数和关键字参数
+    """
+    if codec_id is None:
+        codec_id = JsonCodec.codec_id
+    if codec_id & COMPRESSED:
+        codec_id &= ~COMPRESSED
+        args_data, kwargs_data = zlib.decompress(args_data), zlib.decompress(kwargs_data)
+    codec = _registry.get(codec_id)
+    if codec is None:
+        raise DataException(f'unknown codec: {codec_id}')
+    return codec.decode(args_data, kwargs_data)
@@ -0,0 +1,382 @@
+import heapq
+import os
+import pickle
+import re
+import struct
+import time
+import zlib
+from threading import Condition, Lock
+
+from base import Storage, FailedTask, Scheduler, TaskState
+from do_log import debug, error
+from storage.memory import MemoryStorage
+from storage.mmap_index import MmapIndex
+
+
+class JournalStorage(Storage):
+    """基于追加日志的任务存储器
+    任务状态变化(新增、重新调度、中断、移除)以记录的形式顺序追加到分段日志文件中，调度使用内存中的索引(MemoryStorage)。
+    并发写入的线程共用一次fsync(组提交)；日志段达到一定数量时将存活任务的记录复制到快照并删除快照之前的日志，
+    每次切换日志段时将任务的调度字段和记录位置写入mmap索引文件(检查点)。
+    重启时扫描索引文件即可恢复调度，只有检查点之后的日志需要重放；预读窗口之外的待重试任务只记录调度字段，
+    临近到期时才放入内存索引，任务的完整记录在取出时才从日志读取。
+    """
+    _SEGMENT = 'segment-{:08d}.log'    # 日志段文件名
+    _SNAPSHOT = 'snapshot-{:08d}.snap'  # 快照文件名，快照与日志段共用序号，快照包含之前所有日志的存活任务
+    _INDEX = 'index.bin'    # mmap索引文件名
+    _FILE_RE = re.compile(r'^(segment|snapshot)-(\d{8})\.(log|snap)$')
+    _HEADER = struct.Struct('<II')  # 记录头：长度、crc32
+    _PUT = 1    # 写入任务
+    _REMOVE = 2     # 移除任务
+    _STATES = {state.value: state for state in TaskState}   # 避免恢复时逐个构造枚举
+
+    def __init__(self, path: str = 'do.journal', fsync: bool = True, segment_size: int = 64 * 1024 * 1024,
+                 snapshot_segments: int = 4, scheduler: Scheduler = None, preload: float = 60) -> None:
+        """
+        Args:
+            path: 日志目录
+            fsync: 写入后是否等待数据刷盘，为False时只在切换日志段和关闭时刷盘
+            segment_size: 日志段大小，超过后切换到新的日志段，单位为字节
+            snapshot_segments: 自上次快照以来的日志段数超过该值时生成快照并删除旧日志
+            scheduler: 内存索引使用的调度器，默认为HeapScheduler
+            preload: 重启后只将该时长内到期的任务放入内存索引，其余任务临近到期时再放入，单位为秒
+        """
+        super().__init__()
+        self._path = path
+        self._fsync = fsync
+        self._segment_size = segment_size
+        self._snapshot_segments = max(snapshot_segments, 1)
+        self._index = MemoryStorage(scheduler=scheduler)
+        self._locations = dict()    # 任务ID -> 最新记录的位置和调度字段
+        self._unloaded = set()  # 只从索引文件恢复了调度字段、尚未读取完整记录的任务ID
+        self._preload = preload
+        self._cold = set()  # 尚未放入内存索引的待重试任务ID
+        self._cold_heap = list()    # 尚未放入内存索引的任务，元素为(下次执行时间, 任务ID)，惰性删除
+        self._dirty = set()     # 上次检查点之后有变化的任务ID
+        self._kinds = dict()    # 日志文件序号 -> 文件类型(segment或snapshot)
+        self._readers = dict()  # 日志文件序号 -> 读文件句柄
+        self._cond = Condition(Lock())
+        self._file = None   # 当前日志段
+        self._segment = 0   # 当前日志段序号
+        self._snapshot = 0  # 最新快照的序号
+        self._written = 0   # 已写入的总字节数
+        self._synced = 0    # 已刷盘的总字节数
+        self._syncing = False   # 是否有线程正在刷盘
+        os.makedirs(path, exist_ok=True)
+        self._mmap_index = MmapIndex(os.path.join(path, self._INDEX))
+        self._recover()
+
+    def _file_path(self, file_no: int) -> str:
+        template = self._SNAPSHOT if self._kinds.get(file_no) == 'snapshot' else self._SEGMENT
+        return os.path.join(self._path, template.format(file_no))
+
+    def _recover(self) -> None:
+        """从索引文件恢复检查点时的调度状态，重放检查点之后的日志，然后打开新的日志段
+        没有索引文件时从最新的快照开始重放
+        """
+        for name in os.listdir(self._path):
+            match = self._FILE_RE.match(name)
+            if match:
+                self._kinds[int(match.group(2))] = match.group(1)
+        snapshots = [file_no for file_no, kind in self._kinds.items() if kind == 'snapshot']
+        self._snapshot = max(snapshots) if snapshots else 0
+        checkpoint = self._mmap_index.checkpoint
+        if checkpoint is None:
+            checkpoint = (self._snapshot, 0)
+        else:
+            self._load_index()
+        for file_no in sorted(self._kinds):
+            if file_no >= checkpoint[0]:
+                self._replay(file_no, checkpoint[1] if file_no == checkpoint[0] else 0)
+        self._segment = max(self._kinds) + 1 if self._kinds else 0
+        self._open_segment()
+        self._checkpoint()
+
+    def _load_index(self) -> None:
+        """由索引文件中的调度字段恢复调度，带去重键的任务需要恢复去重关系，直接读取完整记录；
+        预读窗口内到期及非待重试状态的任务创建占位任务放入内存索引，其余任务留待临近到期时放入
+        """
+        placeholders = list()
+        horizon = time.time() + self._preload
+        max_id = 0
+        for task_id, next_run_time, priority, state, flags, file_no, offset, length in self._mmap_index.entries():
+            self._locations[task_id] = (file_no, offset, length, next_run_time, priority, state, flags)
+            max_id = max(max_id, task_id)
+            if flags & MmapIndex.FLAG_DEDUP:
+                placeholders.append(self._read(task_id))
+                continue
+            self._unloaded.add(task_id)
+            if next_run_time > horizon and state == TaskState.Failed:
+                self._cold.add(task_id)
+                self._cold_heap.append((next_run_time, task_id))
+                continue
+            placeholders.append(self._placeholder(task_id))
+        heapq.heapify(self._cold_heap)
+        self._index.reserve_id(max_id)
+        self._index.put_many(placeholders)
+
+    def _placeholder(self, task_id: int) -> FailedTask:
+        """由记录位置中的调度字段创建只含调度字段的占位任务"""
+        next_run_time, priority, state = self._locations[task_id][3:6]
+        return FailedTask(task_id, None, None, None, None, None, 0, 0, 0, 0,
+                          next_run_time, self._STATES[state], priority=priority)
+
+    def _page_in(self, until: float = None) -> None:
+        """将预读窗口内或until之前到期、尚未放入内存索引的任务放入内存索引"""
+        horizon = time.time() + self._preload
+        if until is not None:
+            horizon = max(horizon, until)
+        with self._cond:
+            placeholders = list()
+            while self._cold_heap and self._cold_heap[0][0] <= horizon:
+                _, task_id = heapq.heappop(self._cold_heap)
+                if task_id in self._cold:
+                    self._cold.discard(task_id)
+                    placeholders.append(self._placeholder(task_id))
+            if placeholders:
+                self._index.put_many(placeholders)
+
+    def _cold_next(self) -> float:
+        """
+        Returns: 尚未放入内存索引的任务中最早的下次执行时间，没有时返回None
+        """
+        with self._cond:
+            while self._cold_heap and self._cold_heap[0][1] not in self._cold:
+                heapq.heappop(self._cold_heap)
+            return self._cold_heap[0][0] if self._cold_heap else None
+
+    def _replay(self, file_no: int, start: int) -> None:
+        """从偏移start开始重放一个日志文件，遇到不完整或损坏的记录时截断该记录及之后的内容"""
+        file_path = self._file_path(file_no)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        offset = start
+        while offset + self._HEADER.size <= len(data):
+            length, crc = self._HEADER.unpack_from(data, offset)
+            start = offset + self._HEADER.size
+            record = data[start:start + length]
+            if len(record) < length or zlib.crc32(record) != crc:
+                break
+            op, value = pickle.loads(record)
+            if op == self._PUT:
+                self._index.put_many([value])
+                self._locate(value, file_no, offset, self._HEADER.size + length)
+            else:
+                self._index.remove_many(value)
+                self._forget(value)
+            offset = start + length
+        if offset < len(data):
+            error(f'journal {file_path} truncated at {offset}, drop {len(data) - offset} bytes.')
+            with open(file_path, 'r+b') as f:
+                f.truncate(offset)
+
+    def _locate(self, task: FailedTask, file_no: int, offset: int, length: int) -> None:
+        """记录任务最新记录的位置，调度字段取写入记录时的值"""
+        flags = MmapIndex.FLAG_DEDUP if task.dedup_key is not None else 0
+        self._locations[task.task_id] = (file_no, offset, length, task.next_run_time, task.priority, task.state, flags)
+        self._unloaded.discard(task.task_id)
+        self._cold.discard(task.task_id)
+        self._dirty.add(task.task_id)
+
+    def _forget(self, task_ids: [int]) -> None:
+        for task_id in task_ids:
+            self._locations.pop(task_id, None)
+            self._unloaded.discard(task_id)
+            self._cold.discard(task_id)
+            self._dirty.add(task_id)
+
+    def _read_raw(self, file_no: int, offset: int, length: int) -> bytes:
+        """读取一条带记录头的原始记录"""
+        if file_no == self._segment and self._file is not None and not self._file.closed:
+            self._file.flush()
+        reader = self._readers.get(file_no)
+        if reader is None:
+            reader = self._readers[file_no] = open(self._file_path(file_no), 'rb')
+        reader.seek(offset)
+        return reader.read(length)
+
+    def _read(self, task_id: int) -> FailedTask:
+        """读取任务的完整记录"""
+        raw = self._read_raw(*self._locations[task_id][:3])
+        return pickle.loads(raw[self._HEADER.size:])[1]
+
+    def _materialize(self, tasks: [FailedTask]) -> [FailedTask]:
+        """为占位任务读取完整记录并原地填充字段，调度器和内存索引中的引用保持不变"""
+        with self._cond:
+            for task in tasks:
+                if task is not None and task.task_id in self._unloaded:
+                    task.__dict__.update(self._read(task.task_id).__dict__)
+                    self._unloaded.discard(task.task_id)
+        return tasks
+
+    def _open_segment(self) -> None:
+        self._kinds[self._segment] = 'segment'
+        self._file = open(self._file_path(self._segment), 'ab')
+
+    def _write(self, op: int, value: object) -> (int, int):
+        """在持有锁时追加一条记录
+
+        Returns: 记录在当前日志段中的偏移和带记录头的长度
+        """
+        record = pickle.dumps((op, value), pickle.HIGHEST_PROTOCOL)
+        offset = self._file.tell()
+        self._file.write(self._HEADER.pack(len(record), zlib.crc32(record)))
+        self._file.write(record)
+        self._written += self._HEADER.size + len(record)
+        return offset, self._HEADER.size + len(record)
+
+    def _wait_synced(self, target: int) -> None:
+        """开启fsync时等待写入位置target之前的数据刷盘(组提交)
+        第一个等待的线程负责刷盘，刷盘期间不持有锁，其间写入的其他线程等待同一次或下一次刷盘
+        """
+        if not self._fsync:
+            return
+        with self._cond:
+            while self._synced < target:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                self._file.flush()
+                fd, written = self._file.fileno(), self._written
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._synced = max(self._synced, written)
+                    self._cond.notify_all()
+
+    def _sync(self) -> None:
+        """在持有锁时将当前日志段刷盘"""
+        while self._syncing:
+            self._cond.wait()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = self._written
+
+    def _checkpoint(self) -> None:
+        """在持有锁且日志已刷盘时，将有变化的任务写入索引文件，检查点为当前日志段的末尾"""
+        for task_id in self._dirty:
+            location = self._locations.get(task_id)
+            if location is None:
+                self._mmap_index.remove(task_id)
+            else:
+                file_no, offset, length, next_run_time, priority, state, flags = location
+                self._mmap_index.put(task_id, next_run_time, priority, state, flags, file_no, offset, length)
+        self._dirty.clear()
+        self._mmap_index.flush((self._segment, self._file.tell()))
+
+    def _rotate(self) -> None:
+        """切换到新的日志段，自上次快照以来的日志段足够多时生成快照，最后写入检查点"""
+        self._sync()
+        self._file.close()
+        self._segment += 1
+        if self._segment - self._snapshot > self._snapshot_segments:
+            self._compact()
+        else:
+            self._open_segment()
+            self._checkpoint()
+
+    def _compact(self) -> None:
+        """将存活任务的最新记录原样复制到序号为当前序号的快照，打开下一个日志段并写入检查点，最后删除快照之前的日志
+        快照先写入临时文件并刷盘后再改名，检查点在删除旧日志之前写入，任何时刻崩溃都不影响恢复
+        """
+        seq = self._segment
+        file_path = os.path.join(self._path, self._SNAPSHOT.format(seq))
+        with open(f'{file_path}.tmp', 'wb') as f:
+            for task_id, location in self._locations.items():
+                raw = self._read_raw(*location[:3])
+                self._locations[task_id] = (seq, f.tell(), len(raw)) + location[3:]
+                f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{file_path}.tmp', file_path)
+        debug(f'journal snapshot {file_path} written.')
+        self._kinds[seq] = 'snapshot'
+        self._snapshot = seq
+        self._dirty.update(self._locations)
+        self._segment += 1
+        self._open_segment()
+        self._checkpoint()
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
+        for file_no in [file_no for file_no in self._kinds if file_no < seq]:
+            os.remove(self._file_path(file_no))
+            del self._kinds[file_no]
+
+    def compact(self) -> None:
+        """立即切换日志段并生成快照"""
+        with self._cond:
+            self._sync()
+            self._file.close()
+            self._segment += 1
+            self._compact()
+
+    def close(self) -> None:
+        """刷盘并写入检查点，然后关闭所有文件"""
+        with self._cond:
+            if self._file is not None and not self._file.closed:
+                self._sync()
+                self._checkpoint()
+                self._file.close()
+                self._mmap_index.close()
+                for reader in self._readers.values():
+                    reader.close()
+                self._readers.clear()
+
+    def take(self) -> FailedTask:
+        task_list = self.take_many(1)
+        if task_list:
+            return task_list[0]
+        return None
+
+    def take_many(self, n: int) -> [FailedTask]:
+        self._page_in()
+        return self._materialize(self._index.take_many(n))
+
+    def put(self, task: FailedTask) -> None:
+        self.put_many([task])
+
+    def put_many(self, tasks: [FailedTask]) -> None:
+        """先更新内存索引以分配ID，再逐个追加任务记录；与已有任务合并的新任务不再追加"""
+        with self._cond:
+            self._index.put_many(tasks)
+            for task in tasks:
+                if self._index.get(task.task_id) is task:
+                    self._locate(task, self._segment, *self._write(self._PUT, task))
+            target = self._written
+            if self._file.tell() >= self._segment_size:
+                self._rotate()
+        self._wait_synced(target)
+
+    def remove(self, task_id: int) -> None:
+        self.remove_many([task_id])
+
+    def remove_many(self, task_ids: [int]) -> None:
+        with self._cond:
+            self._index.remove_many(task_ids)
+            self._write(self._REMOVE, list(task_ids))
+            self._forget(task_ids)
+            target = self._written
+            if self._file.tell() >= self._segment_size:
+                self._rotate()
+        self._wait_synced(target)
+
+    def pending_count(self) -> int:
+        return self._index.pending_count() + len(self._cold)
+
+    def all(self) -> [FailedTask]:
+        self._page_in(float('inf'))
+        return self._materialize(self._index.all())
+
+    def get_next(self) -> [FailedTask]:
+        self._page_in()
+        task = self._index.get_next()
+        cold_next = self._cold_next()
+        if cold_next is not None and (task is None or cold_next < task.next_run_time):
+            self._page_in(cold_next)
+            task = self._index.get_next()
+        return self._materialize([task])[0]
@@ -1,59 +1,270 @@
+import copy
+import heapq
+import pickle
 import time
-import queue
-from threading import RLock
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from threading import RLock, Condition
 
-from base import FailedTask, Storage, TaskState
-from error import DataException
+from base import FailedTask, Storage, TaskState, Scheduler, OverflowPolicy
+from do_log import error
+from error import DataException, ConfigureException
+from scheduler import HeapScheduler
 
 
-class QueryablePriorityQueue(queue.PriorityQueue):
-    """
-    可查询的优先队列
-    """
-    def peek(self) -> FailedTask:
-        try:
-            task = self.get_nowait()[1]
-            self.put_task(task)
-            return task
-        except queue.Empty:
-            return None
-
-    def put_task(self, task: FailedTask):
-        self.put_nowait((task.next_run_time, task))
-
-    def get_task(self) -> FailedTask:
-        return self.get_nowait()[1]
+@dataclass
+class MemoryStats:
+    """内存存储器的容量统计"""
+    tasks: int = 0  # 待重试任务数
+    bytes: int = 0  # 待重试任务参数的估算字节数，只在设置了max_bytes时统计
+    dropped: int = 0    # 因容量不足被丢弃的任务数
+    spilled: int = 0    # 写入溢出存储器的任务数
+    unspilled: int = 0  # 从溢出存储器加载回内存的任务数
+    blocked: int = 0    # 因容量不足被阻塞的写入次数
+    blocked_time: float = 0     # 写入被阻塞的总时长，单位为秒
 
 
 class MemoryStorage(Storage):
     """基于内存的任务存储器
-    底层数据结构是一个字典+阻塞队列
+    底层数据结构是一个字典+调度器(默认为索引小顶堆)，所有操作共用一把锁；另用一个字典记录待重试任务的去重键，
+    新任务只合并到待重试或执行中(取出后lease_timeout秒内)的同键任务，取出后未写回也未移除的任务的去重键视为失效。
+    可以按待重试任务数和参数估算字节数限制容量，容量只约束新任务，重新调度的任务总是被接受；
+    新任务超出容量时按溢出策略处理：抛出异常(默认)、阻塞调用者、丢弃最新/最早/优先级最低的任务，或写入溢出存储器
     """
     _id = 1     # 自增ID
+    _POLICIES = (OverflowPolicy.Block, OverflowPolicy.DropNewest, OverflowPolicy.DropOldest,
+                 OverflowPolicy.DropLowestPriority, OverflowPolicy.Spill)   # 支持的溢出策略
+    _UNSPILL_BATCH = 100    # 只限制字节数时每次从溢出存储器加载的任务数
 
-    def __init__(self, max_size=0) -> None:
+    def __init__(self, max_size=0, scheduler: Scheduler = None, max_bytes: int = 0, policy: OverflowPolicy = None,
+                 spill: Storage = None, block_timeout: float = None, lease_timeout: float = 600) -> None:
+        """
+        Args:
+            max_size: 最大待重试任务数，0表示不限制
+            scheduler: 调度器，默认为HeapScheduler
+            max_bytes: 待重试任务参数的最大估算字节数(按pickle后的长度估算)，0表示不限制
+            policy: 新任务超出容量时的溢出策略，None表示抛出DataException
+            spill: Spill策略使用的溢出存储器，默认为SqliteStorage('do.spill.db')
+            block_timeout: Block策略的最长阻塞时间，超时抛出DataException，None表示一直阻塞
+            lease_timeout: 取出的任务视为执行中的时长，单位为秒，与SqliteStorage的租约时长含义相同
+        """
         super().__init__()
-        self._queue = QueryablePriorityQueue(maxsize=max_size) # 小顶堆
+        if policy is not None and policy not in self._POLICIES:
+            raise ConfigureException(f'unsupported overflow policy for MemoryStorage: {policy!r}')
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._policy = policy
+        self._block_timeout = block_timeout
+        self._queue = HeapScheduler() if scheduler is None else scheduler
         self._db = dict()
+        self._keys = dict()     # 待重试任务的去重键 -> 任务ID
+        self._taken = dict()    # 已取出、尚未写回或移除的任务ID -> 取出时间
+        self._lease_timeout = lease_timeout
+        self._sizes = dict()    # 待重试任务ID -> 参数估算字节数
+        self._lowest = list()   # DropLowestPriority策略使用的小顶堆，元素为[优先级, 序号, 任务ID]，惰性删除
+        self._seq = 0
+        self._oldest = OrderedDict()    # DropOldest策略使用的待重试任务ID，按入队顺序排列
+        self._stats = MemoryStats()
         self._lock = RLock()
+        self._cond = Condition(self._lock)
+        self._spill = spill
+        self._spill_pending = False     # 溢出存储器中是否可能还有任务
+        if policy == OverflowPolicy.Spill:
+            if spill is None:
+                from storage.sqlite import SqliteStorage
+                self._spill = SqliteStorage(db='do.spill.db')
+            self._spill_pending = True
+
+    def stats(self) -> MemoryStats:
+        """
+        Returns: 容量统计的快照
+        """
+        with self._lock:
+            return replace(self._stats, tasks=len(self._queue))
 
     def take(self) -> FailedTask:
-        try:
-            task = self._queue.peek()
-            if task is not None and task.next_run_time <= time.time():
-                return self._queue.get_task()
-        except queue.Empty:
-            return None
+        task_list = self.take_many(1)
+        if task_list:
+            return task_list[0]
+        return None
+
+    def take_many(self, n: int) -> [FailedTask]:
+        with self._lock:
+            now = time.time()
+            task_list = self._queue.pop_due(now, n)
+            if task_list:
+                for task in task_list:
+                    self._untrack(task.task_id)
+                    self._taken[task.task_id] = now
+                self._freed()
+            return task_list
 
     def put(self, task: FailedTask) -> None:
+        self.put_many([task])
+
+    def put_many(self, tasks: [FailedTask]) -> None:
+        with self._lock:
+            pending = len(self._queue)
+            for task in tasks:
+                self._put(task, True)
+            if len(self._queue) < pending:
+                self._freed()
+
+    def _put(self, task: FailedTask, bounded: bool) -> None:
         if task.task_id == FailedTask.INIT_ID:
+            if task.dedup_key is not None and self._merge(task):
+                return
+            if bounded and task.state == TaskState.Failed and not self._admit(task):
+                return
             task.task_id = self._gen_id()
+        elif task.task_id >= self._id:
+            self._id = task.task_id + 1
+        self._taken.pop(task.task_id, None)
         self._db[task.task_id] = task
+        if task.state == TaskState.Failed:
+            self._queue.push(task)
+            self._track(task)
+            if task.dedup_key is not None:
+                self._keys[task.dedup_key] = task.task_id
+        else:
+            self._queue.remove(task.task_id)
+            self._untrack(task.task_id)
+            self._discard_key(task)
+
+    def _merge(self, task: FailedTask) -> bool:
+        """将新任务合并到去重键相同的待重试或执行中的任务，已失效的去重键被删除
+
+        Returns: 是否已合并
+        """
+        task_id = self._keys.get(task.dedup_key)
+        if task_id is None:
+            return False
+        taken_at = self._taken.get(task_id)
+        if task_id in self._queue or (taken_at is not None and time.time() - taken_at < self._lease_timeout):
+            task.task_id = task_id
+            return True
+        del self._keys[task.dedup_key]
+        self._taken.pop(task_id, None)
+        return False
+
+    def _size_of(self, task: FailedTask) -> int:
+        if self._max_bytes <= 0 or task.task_args is None:
+            return 0
         try:
-            if task.state == TaskState.Failed:
-                self._queue.put_task(task)
-        except queue.Full:
+            return len(pickle.dumps((task.task_args, task.task_kwargs), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return len(repr(task.task_args)) + len(repr(task.task_kwargs))
+
+    def _track(self, task: FailedTask) -> None:
+        size = self._size_of(task)
+        self._stats.bytes += size - self._sizes.get(task.task_id, 0)
+        self._sizes[task.task_id] = size
+        if self._policy == OverflowPolicy.DropLowestPriority:
+            self._seq += 1
+            heapq.heappush(self._lowest, [task.priority, self._seq, task.task_id])
+        elif self._policy == OverflowPolicy.DropOldest:
+            self._oldest.setdefault(task.task_id)
+
+    def _untrack(self, task_id: int) -> None:
+        self._stats.bytes -= self._sizes.pop(task_id, 0)
+        self._oldest.pop(task_id, None)
+
+    def _full(self, size: int) -> bool:
+        """
+        Returns: 再放入一个估算字节数为size的新任务是否会超出容量，队列为空时总是可以放入
+        """
+        if not len(self._queue):
+            return False
+        return ((self._max_size > 0 and len(self._queue) >= self._max_size)
+                or (self._max_bytes > 0 and self._stats.bytes + size > self._max_bytes))
+
+    def _admit(self, task: FailedTask) -> bool:
+        """容量不足时按溢出策略为新任务腾出空间
+
+        Returns: 新任务是否放入内存
+        """
+        size = self._size_of(task)
+        if not self._full(size):
+            return True
+        if self._policy is None:
             raise DataException("queue already full！")
+        if self._policy == OverflowPolicy.Block:
+            start = time.time()
+            self._stats.blocked += 1
+            try:
+                if not self._cond.wait_for(lambda: not self._full(size), self._block_timeout):
+                    raise DataException(f'queue still full after {self._block_timeout}s！')
+            finally:
+                self._stats.blocked_time += time.time() - start
+            return True
+        if self._policy == OverflowPolicy.Spill:
+            self._spill.put(copy.copy(task))
+            self._spill_pending = True
+            self._stats.spilled += 1
+            return False
+        while self._full(size):
+            victim = self._victim(task)
+            if victim is None:
+                self._drop(task)
+                return False
+            self._drop(victim)
+            self._remove(victim.task_id)
+        return True
+
+    def _victim(self, task: FailedTask) -> FailedTask:
+        """
+        Returns: 为新任务腾出空间时被丢弃的待重试任务，None表示丢弃新任务
+        """
+        if self._policy == OverflowPolicy.DropOldest:
+            if self._oldest:
+                return self._db[next(iter(self._oldest))]
+        elif self._policy == OverflowPolicy.DropLowestPriority:
+            if len(self._lowest) > 2 * len(self._queue) + 64:
+                self._lowest = [entry for entry in self._lowest if self._is_lowest_entry(entry)]
+                heapq.heapify(self._lowest)
+            while self._lowest:
+                if self._is_lowest_entry(self._lowest[0]):
+                    victim = self._db[self._lowest[0][2]]
+                    return victim if victim.priority <= task.priority else None
+                heapq.heappop(self._lowest)
+        return None
+
+    def _is_lowest_entry(self, entry: list) -> bool:
+        task = self._db.get(entry[2])
+        return task is not None and entry[2] in self._queue and task.priority == entry[0]
+
+    def _drop(self, task: FailedTask) -> None:
+        self._stats.dropped += 1
+        error(f'memory storage full, drop task-{task.task_name}.')
+
+    def _freed(self) -> None:
+        """待重试任务减少后唤醒阻塞的写入，并从溢出存储器加载任务"""
+        if self._policy == OverflowPolicy.Block:
+            self._cond.notify_all()
+        elif self._spill_pending:
+            self._unspill()
+
+    def _unspill(self) -> None:
+        """按优先级和下次执行时间从溢出存储器加载任务填满空位，先放入内存再从溢出存储器删除"""
+        free = self._max_size - len(self._queue) if self._max_size > 0 else self._UNSPILL_BATCH
+        if free <= 0 or self._full(0):
+            return
+        tasks = self._spill.take_ahead(float('inf'), free)
+        if len(tasks) < free:
+            self._spill_pending = False
+        if not tasks:
+            return
+        self._spill.load_payload(tasks)
+        spill_ids = [task.task_id for task in tasks]
+        for task in tasks:
+            task.task_id = FailedTask.INIT_ID
+            self._put(task, False)
+        self._stats.unspilled += len(tasks)
+        self._spill.remove_many(spill_ids)
+
+    def _discard_key(self, task: FailedTask) -> None:
+        if task is not None and task.dedup_key is not None and self._keys.get(task.dedup_key) == task.task_id:
+            del self._keys[task.dedup_key]
 
     def _gen_id(self) -> int:
         with self._lock:
@@ -61,12 +272,45 @@ class MemoryStorage(Storage):
             self._id += 1
             return take_id
 
+    def reserve_id(self, task_id: int) -> None:
+        """保证之后生成的ID大于task_id，用于存储器外仍有任务占用ID的场景"""
+        with self._lock:
+            self._id = max(self._id, task_id + 1)
+
+    def get(self, task_id: int) -> FailedTask:
+        """
+        Returns: 返回ID对应的任务，不存在时返回None
+        """
+        with self._lock:
+            return self._db.get(task_id)
+
     def remove(self, task_id: int) -> None:
-        if task_id in self._db:
-            self._db.pop(task_id)
+        self.remove_many([task_id])
+
+    def remove_many(self, task_ids: [int]) -> None:
+        with self._lock:
+            for task_id in task_ids:
+                self._remove(task_id)
+            self._freed()
+
+    def _remove(self, task_id: int) -> None:
+        self._taken.pop(task_id, None)
+        self._discard_key(self._db.pop(task_id, None))
+        self._queue.remove(task_id)
+        self._untrack(task_id)
+
+    def pending_count(self) -> int:
+        """
+        Returns: 调度器中的待重试任务数，不含已取出执行中的任务
+        """
+        return len(self._queue)
 
     def all(self) -> [FailedTask]:
-        return [task for task in self._db.values()]
+        with self._lock:
+            return [task for task in self._db.values()]
 
     def get_next(self) -> [FailedTask]:
-        return self._queue.peek()
+        with self._lock:
+            if self._spill_pending and not len(self._queue):
+                self._unspill()
+            return self._queue.peek()
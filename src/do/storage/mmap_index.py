@@ -0,0 +1,113 @@
+import mmap
+import os
+import struct
+
+from error import DataException
+
+
+class MmapIndex:
+    """
+    基于mmap的定长任务索引文件
+    每个槽位保存一个任务的调度字段和完整记录在日志中的位置，重启时只需顺序扫描槽位即可恢复调度，
+    不必解码任务参数。文件头保存检查点，即索引已包含的日志位置，检查点之后的日志需要重放。
+    """
+    _MAGIC = b'DOIX'
+    _VERSION = 1
+    _HEADER = struct.Struct('<4sHiQQ')    # 魔数、版本、检查点日志文件序号(-1表示无)、检查点偏移、已用槽位数
+    _HEADER_SIZE = 64
+    _SLOT = struct.Struct('<qdiBBIQI')  # 任务ID(0表示空槽)、下次执行时间、优先级、状态、标志、日志文件序号、偏移、长度
+    FLAG_DEDUP = 0x1    # 任务带有去重键
+
+    def __init__(self, path: str, capacity: int = 1024) -> None:
+        """
+        Args:
+            path: 索引文件路径
+            capacity: 新建索引文件的初始槽位数，槽位不足时翻倍扩容
+        """
+        self._path = path
+        self._slots = dict()    # 任务ID -> 槽位
+        self._free = list()     # 空闲槽位
+        self._used = 0  # 已用槽位数(含空闲槽位)
+        self._checkpoint = None
+        new = not os.path.exists(path)
+        self._file = open(path, 'w+b' if new else 'r+b')
+        if new:
+            self._file.truncate(self._HEADER_SIZE + self._SLOT.size * capacity)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if new:
+            self._write_header()
+        else:
+            self._read_header()
+
+    def _read_header(self) -> None:
+        magic, version, file_no, offset, used = self._HEADER.unpack_from(self._map, 0)
+        if magic != self._MAGIC or version != self._VERSION:
+            raise DataException(f'invalid task index: {self._path}')
+        self._used = used
+        self._checkpoint = None if file_no < 0 else (file_no, offset)
+
+    def _write_header(self) -> None:
+        file_no, offset = self._checkpoint if self._checkpoint else (-1, 0)
+        self._HEADER.pack_into(self._map, 0, self._MAGIC, self._VERSION, file_no, offset, self._used)
+
+    @property
+    def checkpoint(self) -> (int, int):
+        """
+        Returns: 索引已包含的日志位置(日志文件序号, 偏移)，新建的索引为None
+        """
+        return self._checkpoint
+
+    def entries(self) -> iter:
+        """遍历所有非空槽位，同时建立任务ID到槽位的映射
+
+        Returns:
+            iter: (任务ID, 下次执行时间, 优先级, 状态, 标志, 日志文件序号, 偏移, 长度)
+        """
+        end = self._HEADER_SIZE + self._SLOT.size * self._used
+        for slot, entry in enumerate(self._SLOT.iter_unpack(self._map[self._HEADER_SIZE:end])):
+            if entry[0] == 0:
+                self._free.append(slot)
+                continue
+            self._slots[entry[0]] = slot
+            yield entry
+
+    def put(self, task_id: int, next_run_time: float, priority: int, state: int, flags: int,
+            file_no: int, offset: int, length: int) -> None:
+        slot = self._slots.get(task_id)
+        if slot is None:
+            slot = self._free.pop() if self._free else self._alloc()
+            self._slots[task_id] = slot
+        self._SLOT.pack_into(self._map, self._HEADER_SIZE + self._SLOT.size * slot,
+                             task_id, next_run_time, priority, state, flags, file_no, offset, length)
+
+    def remove(self, task_id: int) -> None:
+        slot = self._slots.pop(task_id, None)
+        if slot is not None:
+            self._SLOT.pack_into(self._map, self._HEADER_SIZE + self._SLOT.size * slot, 0, 0, 0, 0, 0, 0, 0, 0)
+            self._free.append(slot)
+
+    def _alloc(self) -> int:
+        if self._HEADER_SIZE + self._SLOT.size * (self._used + 1) > len(self._map):
+            capacity = (len(self._map) - self._HEADER_SIZE) // self._SLOT.size
+            self._map.close()
+            self._file.truncate(self._HEADER_SIZE + self._SLOT.size * capacity * 2)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used += 1
+        return self._used - 1
+
+    def flush(self, checkpoint: (int, int)) -> None:
+        """先将槽位刷盘，再写入并刷盘新的检查点，保证检查点不会超前于槽位
+
+        Args:
+            checkpoint ((int, int)): 槽位已包含的日志位置(日志文件序号, 偏移)
+        """
+        self._write_header()
+        self._map.flush()
+        self._checkpoint = checkpoint
+        self._write_header()
+        self._map.flush()
+
+    def close(self) -> None:
+        if not self._map.closed:
+            self._map.close()
+            self._file.close()
@@ -1,85 +1,215 @@
-import json
+import os
+import socket
 import sqlite3
 import time
+import uuid
+import weakref
 from contextlib import contextmanager
 from sqlite3 import Cursor
+from threading import RLock, local
 from typing import Union
 
 from base import Storage, FailedTask, TaskState, TaskType
 from do_log import debug
+from error import DataException
+from storage import codec as codecs
+from storage.codec import Codec, PickleCodec
+
+
+class _ConnHolder:
+    """线程本地连接的持有者，线程结束时随线程本地数据一起释放，释放时关闭连接"""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        weakref.finalize(self, conn.close)
 
 
 class SqliteStorage(Storage):
-    """基于sqlite的任务存储器"""
+    """基于sqlite的任务存储器
+    take通过租约认领任务：认领时写入租约持有者和到期时间，回写或删除时清除租约，
+    租约过期的任务可被重新认领，因此多个进程可以共用同一个数据库文件；
+    take、all、get_next只读取调度所需的列，任务参数在执行前通过load_payload加载
+    """
     _TB_NAME = 'failed_task'    # 表名
     _PK = 'task_id' # 主键名
+    _COLUMNS = ['task_type', 'task_name', 'task_args', 'task_kwargs', 'runner_name', 'retry_count',
+                'max_retry', 'create_time', 'update_time', 'next_run_time', 'state', 'codec', 'dedup_key', 'priority', 'retry_delay']   # 除主键外的列名
+    # 只忽略与待重试任务去重键的冲突，冲突目标须与部分唯一索引的条件一致，其他约束冲突照常报错
+    _INSERT_SQL = (f"INSERT INTO `{_TB_NAME}`({', '.join(_COLUMNS)}) "
+                   f"VALUES({', '.join('?' for _ in _COLUMNS)}) "
+                   f"ON CONFLICT(dedup_key) WHERE state = 1 AND dedup_key IS NOT NULL DO NOTHING")
+    _UPSERT_SQL = (f"INSERT INTO `{_TB_NAME}`({_PK}, {', '.join(_COLUMNS)}) "
+                   f"VALUES(?, {', '.join('?' for _ in _COLUMNS)}) "
+                   f"ON CONFLICT({_PK}) DO UPDATE SET "
+                   + ', '.join(f'{k} = excluded.{k}' for k in _COLUMNS)
+                   + ", lease_owner = NULL, lease_expire = NULL")
+    _PAYLOAD_COLUMNS = ['task_args', 'task_kwargs', 'codec']    # 任务参数列
+    _META_COLUMNS = ['task_type', 'task_name', 'runner_name', 'retry_count', 'max_retry', 'create_time',
+                     'update_time', 'next_run_time', 'state', 'dedup_key', 'priority', 'retry_delay']    # 调度所需的列
+    _UPDATE_META_SQL = (f"UPDATE `{_TB_NAME}` SET "
+                        + ', '.join(f'{k} = ?' for k in _META_COLUMNS)
+                        + f", lease_owner = NULL, lease_expire = NULL WHERE {_PK} = ?")
+    _SELECT_SQL = f"SELECT {_PK}, {', '.join(_META_COLUMNS)} FROM `{_TB_NAME}`"
+    _SELECT_LEASED_SQL = f"SELECT {_PK}, {', '.join(_META_COLUMNS)}, lease_expire FROM `{_TB_NAME}`"
+    _SELECT_PAYLOAD_SQL = f"SELECT {_PK}, {', '.join(_PAYLOAD_COLUMNS)} FROM `{_TB_NAME}` WHERE {_PK} IN "
+    # 可认领条件，next_run_time前的一元+使其不能走(state, next_run_time)索引，
+    # 让规划器沿(state, priority, next_run_time)索引按序扫描，避免为ORDER BY建立临时B树
+    _CLAIMABLE = "state = 1 AND +next_run_time <= ? AND (lease_expire IS NULL OR lease_expire <= ?)"
+    _CLAIM_ORDER = "ORDER BY priority DESC, next_run_time LIMIT ?"
+    _CLAIM_SUBQUERY = f"SELECT {_PK} FROM `{_TB_NAME}` WHERE {_CLAIMABLE} {_CLAIM_ORDER}"
+    _CLAIM_SQL = (f"UPDATE `{_TB_NAME}` SET lease_owner = ?, lease_expire = ? "
+                  f"WHERE {_PK} IN ({_CLAIM_SUBQUERY}) "
+                  f"RETURNING {_PK}, {', '.join(_META_COLUMNS)}")
+    _BATCH = 500    # 按ID批量查询时每条语句的最大参数数
+    _SUPPORT_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+    # 数据库结构迁移脚本，第i项将user_version从i升级到i+1
+    _MIGRATIONS = [
+        [f"""
+        CREATE TABLE IF NOT EXISTS `{_TB_NAME}`(
+            task_id INTEGER PRIMARY KEY,
+            task_type INTEGER,
+            task_name TEXT,
+            task_args TEXT,
+            task_kwargs TEXT,
+            runner_name TEXT,
+            retry_count INTEGER,
+            max_retry INTEGER,
+            create_time FLOAT,
+            update_time FLOAT,
+            next_run_time FLOAT,
+            state INTEGER
+        )
+        """],
+        [f"CREATE INDEX IF NOT EXISTS `idx_{_TB_NAME}_state_next_run_time` ON `{_TB_NAME}`(state, next_run_time)"],
+        [f"ALTER TABLE `{_TB_NAME}` ADD COLUMN lease_owner TEXT",
+         f"ALTER TABLE `{_TB_NAME}` ADD COLUMN lease_expire FLOAT",
+         f"CREATE INDEX IF NOT EXISTS `idx_{_TB_NAME}_lease_expire` ON `{_TB_NAME}`(lease_expire) "
+         f"WHERE lease_expire IS NOT NULL"],
+        # 参数改为按codec列记录的编解码器保存为BLOB，codec为NULL的旧数据按JSON读取
+        [f"ALTER TABLE `{_TB_NAME}` ADD COLUMN codec INTEGER"],
+        # 待重试任务的去重键唯一，插入去重键重复的新任务时忽略
+        [f"ALTER TABLE `{_TB_NAME}` ADD COLUMN dedup_key TEXT",
+         f"CREATE UNIQUE INDEX IF NOT EXISTS `idx_{_TB_NAME}_dedup_key` ON `{_TB_NAME}`(dedup_key) "
+         f"WHERE state = 1 AND dedup_key IS NOT NULL"],
+        # 到期任务按优先级从高到低认领
+        [f"ALTER TABLE `{_TB_NAME}` ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+         f"CREATE INDEX IF NOT EXISTS `idx_{_TB_NAME}_state_priority_next_run_time` "
+         f"ON `{_TB_NAME}`(state, priority DESC, next_run_time)"],
+        # 上次失败时设定的退避时间，旧数据为0
+        [f"ALTER TABLE `{_TB_NAME}` ADD COLUMN retry_delay FLOAT NOT NULL DEFAULT 0"],
+    ]
 
-    def __init__(self, db='do.db') -> None:
+    def __init__(self, db='do.db', synchronous: str = 'NORMAL', lease_timeout: float = 600,
+                 codec: Codec = None, compress_threshold: int = 4096) -> None:
+        """
+        Args:
+            db: 数据库文件路径
+            synchronous: sqlite同步模式，WAL模式下NORMAL只在检查点时刷盘，FULL则每次提交都刷盘
+            lease_timeout: 租约时长，单位为秒，应大于任务的最长执行时间
+            codec: 任务参数编解码器，默认为PickleCodec
+            compress_threshold: 编码后的参数不小于该字节数时使用zlib压缩，0表示不压缩
+        """
         super().__init__()
         self._db = db
+        self._codec = PickleCodec() if codec is None else codec
+        self._compress_threshold = compress_threshold
+        codecs.register_codec(self._codec)
+        self._synchronous = synchronous
+        self._lease_timeout = lease_timeout
+        self._owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'    # 租约持有者
+        self._local = local()  # 线程本地连接
+        self._holders = weakref.WeakSet()   # 存活线程的连接持有者
+        self._lock = RLock()
         self._init_db()
 
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的长连接，不存在则新建并开启WAL模式，线程结束后连接随之关闭"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            conn = sqlite3.connect(self._db, check_same_thread=False, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self._synchronous}')
+            holder = self._local.holder = _ConnHolder(conn)
+            with self._lock:
+                self._holders.add(holder)
+        return holder.conn
+
     @contextmanager
     def _new_conn(self):
-        conn = sqlite3.connect(self._db)
+        conn = self._connect()
         try:
             yield conn
             conn.commit()
         except Exception:
-            conn.close()
+            conn.rollback()
             raise
 
+    def close(self) -> None:
+        """关闭所有存活线程的连接"""
+        with self._lock:
+            for holder in list(self._holders):
+                holder.conn.close()
+            self._holders.clear()
+            self._local = local()
+
     def _init_db(self):
+        """按user_version依次执行未执行过的迁移脚本
+        迁移在写事务中进行并在事务内重新读取user_version，多个进程同时打开新数据库时只有一个执行迁移"""
         with self._new_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS `{self._TB_NAME}`(
-                task_id INTEGER PRIMARY KEY,
-                task_type INTEGER,
-                task_name TEXT,
-                task_args TEXT,
-                task_kwargs TEXT,
-                runner_name TEXT,
-                retry_count INTEGER,
-                max_retry INTEGER,
-                create_time FLOAT,
-                update_time FLOAT,
-                next_run_time FLOAT,
-                state INTEGER
-            )
-            """)
+            if cursor.execute('PRAGMA user_version').fetchone()[0] >= len(self._MIGRATIONS):
+                return
+            self._execute_sql(cursor, 'BEGIN IMMEDIATE')
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for i in range(version, len(self._MIGRATIONS)):
+                for sql in self._MIGRATIONS[i]:
+                    self._execute_sql(cursor, sql)
+                self._execute_sql(cursor, f'PRAGMA user_version = {i + 1}')
 
-    @staticmethod
-    def _to_data_dict(task: FailedTask) -> dict:
-        return {
+    def _to_data_dict(self, task: FailedTask) -> dict:
+        """参数未加载的任务只包含调度字段"""
+        data_dict = {
             'task_type': int(task.task_type),
             'task_name': task.task_name,
-            'task_args': json.dumps({'task_args': task.task_args}),
-            'task_kwargs': json.dumps(task.task_kwargs),
             'runner_name': task.runner_name,
             'retry_count': task.retry_count,
             'max_retry': task.max_retry,
             'create_time': task.create_time,
             'update_time': task.update_time,
             'next_run_time': task.next_run_time,
-            'state': int(task.state)
+            'state': int(task.state),
+            'dedup_key': task.dedup_key,
+            'priority': task.priority,
+            'retry_delay': task.retry_delay
         }
+        if task.task_args is not None:
+            codec_id, args_data, kwargs_data = codecs.encode(self._codec, task.task_args, task.task_kwargs,
+                                                             self._compress_threshold)
+            data_dict.update(task_args=args_data, task_kwargs=kwargs_data, codec=codec_id)
+        return data_dict
 
     @staticmethod
     def _to_task(data_dict: dict) -> FailedTask:
+        task_args, task_kwargs = None, None
+        if 'task_args' in data_dict:
+            task_args, task_kwargs = codecs.decode(data_dict.get('codec'), data_dict.get('task_args'),
+                                                   data_dict.get('task_kwargs'))
         return FailedTask(
             task_id=data_dict.get('task_id'),
             task_type=TaskType(data_dict.get('task_type')),
             task_name=data_dict.get('task_name'),
-            task_args=json.loads(data_dict.get('task_args'))['task_args'],
-            task_kwargs=json.loads(data_dict.get('task_kwargs')),
+            task_args=task_args,
+            task_kwargs=task_kwargs,
             runner_name=data_dict.get('runner_name'),
             retry_count=data_dict.get('retry_count'),
             max_retry=data_dict.get('max_retry'),
             create_time=data_dict.get('create_time'),
             update_time=data_dict.get('update_time'),
             next_run_time=data_dict.get('next_run_time'),
-            state=TaskState(data_dict.get('state'))
+            state=TaskState(data_dict.get('state')),
+            dedup_key=data_dict.get('dedup_key'),
+            priority=data_dict.get('priority'),
+            retry_delay=data_dict.get('retry_delay')
         )
 
     @staticmethod
@@ -87,73 +217,113 @@ class SqliteStorage(Storage):
         debug(f'sqlite execute sql: {args}.')
         cursor.execute(*args)
 
-    def _select(self, cursor: Cursor, condition: str = "") -> [FailedTask]:
-        keys = ['task_id', 'task_type', 'task_name', 'task_args', 'task_kwargs', 'runner_name',
-                'retry_count', 'max_retry', 'create_time', 'update_time', 'next_run_time', 'state']
-        select_sql = f"SELECT "
-        for k in keys:
-            select_sql += f"{k}, "
-        select_sql = f'{select_sql.rstrip(", ")} FROM {self._TB_NAME} {condition}'
-        self._execute_sql(cursor, select_sql)
-        values = cursor.fetchall()
-        task_list = list()
-        data_dict = dict()
-        for value in values:
-            for i, k in enumerate(keys):
-                data_dict[k] = value[i]
-            task_list.append(self._to_task(data_dict))
+    def _to_tasks(self, rows: list) -> [FailedTask]:
+        keys = [self._PK] + self._META_COLUMNS
+        return [self._to_task(dict(zip(keys, row))) for row in rows]
+
+    def _select(self, cursor: Cursor, condition: str = "", params: tuple = ()) -> [FailedTask]:
+        select_sql = f'{self._SELECT_SQL} {condition}'
+        self._execute_sql(cursor, select_sql, params)
+        return self._to_tasks(cursor.fetchall())
+
+    def _claim(self, cursor: Cursor, now: float, n: int, until: float = None) -> [FailedTask]:
+        """按优先级从高到低认领至多n个在until之前到期且未被租约占用的任务，until默认为now；
+        旧版本sqlite不支持RETURNING时在写事务中先查询再更新"""
+        lease = (self._owner, now + self._lease_timeout)
+        until = now if until is None else until
+        if self._SUPPORT_RETURNING:
+            self._execute_sql(cursor, self._CLAIM_SQL, lease + (until, now, n))
+            task_list = self._to_tasks(cursor.fetchall())
+        else:
+            self._execute_sql(cursor, 'BEGIN IMMEDIATE')
+            task_list = self._select(cursor, f"WHERE {self._CLAIMABLE} {self._CLAIM_ORDER}",
+                                     (until, now, n))
+            cursor.executemany(f"UPDATE `{self._TB_NAME}` SET lease_owner = ?, lease_expire = ? WHERE {self._PK} = ?",
+                               [lease + (task.task_id,) for task in task_list])
+        task_list.sort(key=lambda task: (-task.priority, task.next_run_time))
         return task_list
 
     def take(self) -> Union[FailedTask, None]:
+        task_list = self.take_many(1)
+        if task_list:
+            return task_list[0]
+        return None
+
+    def take_many(self, n: int) -> [FailedTask]:
         with self._new_conn() as conn:
-            cursor = conn.cursor()
-            task_list = self._select(cursor, f"""
-                WHERE 
-                    state = 1
-                    AND next_run_time <= {time.time()}
-                ORDER BY UPDATE_TIME
-                LIMIT 1
-            """)
-            if task_list:
-                return task_list[0]
-            return None
+            return self._claim(conn.cursor(), time.time(), n)
+
+    def take_ahead(self, horizon: float, n: int) -> [FailedTask]:
+        with self._new_conn() as conn:
+            now = time.time()
+            return self._claim(conn.cursor(), now, n, now + horizon)
 
     def put(self, task: FailedTask) -> None:
+        self.put_many([task])
+
+    def put_many(self, tasks: [FailedTask]) -> None:
+        """在一个事务内写入所有任务，新任务逐条插入以获取自增ID，已有任务批量更新，参数未加载的任务只更新调度字段
+        去重键与待重试任务重复的新任务不会插入，而是合并到该任务
+        """
+        with self._new_conn() as conn:
+            cursor = conn.cursor()
+            upsert_values = list()
+            update_values = list()
+            for task in tasks:
+                data_dict = self._to_data_dict(task)
+                if task.task_args is None:
+                    update_values.append([data_dict[k] for k in self._META_COLUMNS] + [task.task_id])
+                    continue
+                values = [data_dict[k] for k in self._COLUMNS]
+                if task.task_id == FailedTask.INIT_ID:
+                    self._execute_sql(cursor, self._INSERT_SQL, values)
+                    if cursor.rowcount > 0:
+                        task.task_id = cursor.lastrowid
+                    else:
+                        self._execute_sql(cursor, f"SELECT {self._PK} FROM `{self._TB_NAME}` "
+                                                  f"WHERE dedup_key = ? AND state = 1", (task.dedup_key,))
+                        row = cursor.fetchone()
+                        if row is None:
+                            raise DataException(f'task not inserted and no pending task with dedup key '
+                                                f'{task.dedup_key!r}: {task}')
+                        task.task_id = row[0]
+                else:
+                    upsert_values.append([task.task_id] + values)
+            if upsert_values:
+                debug(f'sqlite execute sql: {self._UPSERT_SQL} x {len(upsert_values)}.')
+                cursor.executemany(self._UPSERT_SQL, upsert_values)
+            if update_values:
+                debug(f'sqlite execute sql: {self._UPDATE_META_SQL} x {len(update_values)}.')
+                cursor.executemany(self._UPDATE_META_SQL, update_values)
+
+    def load_payload(self, tasks: [FailedTask]) -> None:
+        """按ID批量读取并解码任务参数，已被删除的任务参数保持为None"""
+        task_map = {task.task_id: task for task in tasks}
+        task_ids = list(task_map)
         with self._new_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(f"""
-            SELECT * FROM `{self._TB_NAME}`
-            WHERE task_id = {task.task_id}
-            """)
-            rows = cursor.fetchall()
-            exists = len(rows) > 0
-            data_dict = self._to_data_dict(task)
-            values = list()
-            if exists:
-                update_sql = f"UPDATE `{self._TB_NAME}` SET "
-                for k in ['task_name', 'task_args', 'task_kwargs', 'retry_count', 'update_time', 'next_run_time', 'state']:
-                    update_sql += f"{k} = ?, "
-                    values.append(data_dict.get(k))
-                update_sql = update_sql.rstrip(", ")
-                self._execute_sql(cursor, update_sql, values)
-            else:
-                insert_sql = f"INSERT INTO `{self._TB_NAME}`("
-                key_counter = 0
-                for k, v in data_dict.items():
-                    if k == self._PK:
-                        continue
-                    insert_sql += f"{k}, "
-                    values.append(data_dict.get(k))
-                    key_counter += 1
-                insert_sql = f"{insert_sql.rstrip(', ')}) VALUES(" \
-                             + (key_counter - 1) * "?, " \
-                             + "?)"
-                self._execute_sql(cursor, insert_sql, values)
+            for i in range(0, len(task_ids), self._BATCH):
+                batch = task_ids[i:i + self._BATCH]
+                self._execute_sql(cursor, f"{self._SELECT_PAYLOAD_SQL}({', '.join('?' for _ in batch)})", batch)
+                for task_id, args_data, kwargs_data, codec_id in cursor.fetchall():
+                    task = task_map[task_id]
+                    task.task_args, task.task_kwargs = codecs.decode(codec_id, args_data, kwargs_data)
 
     def remove(self, task_id: int) -> None:
+        self.remove_many([task_id])
+
+    def remove_many(self, task_ids: [int]) -> None:
         with self._new_conn() as conn:
             cursor = conn.cursor()
-            self._execute_sql(cursor, f"DELETE FROM `{self._TB_NAME}` WHERE {self._PK} = {task_id}")
+            debug(f'sqlite delete tasks: {task_ids}.')
+            cursor.executemany(f"DELETE FROM `{self._TB_NAME}` WHERE {self._PK} = ?",
+                               [(task_id,) for task_id in task_ids])
+
+    def pending_count(self) -> int:
+        with self._new_conn() as conn:
+            cursor = conn.cursor()
+            self._execute_sql(cursor, f"SELECT COUNT(*) FROM `{self._TB_NAME}` WHERE state = 1")
+            return cursor.fetchone()[0]
 
     def all(self) -> [FailedTask]:
         with self._new_conn() as conn:
@@ -161,14 +331,32 @@ class SqliteStorage(Storage):
             return self._select(cursor)
 
     def get_next(self) -> [FailedTask]:
+        """
+        Returns: 返回最近需要执行的任务，被租约占用的任务以租约到期时间作为下次执行时间
+        """
         with self._new_conn() as conn:
             cursor = conn.cursor()
-            task_list = self._select(cursor, f"""
+            now = time.time()
+            task_list = self._select(cursor, """
                 WHERE 
                     state = 1
+                    AND (lease_expire IS NULL OR lease_expire <= ?)
                 ORDER BY next_run_time
                 LIMIT 1
-            """)
+            """, (now,))
+            self._execute_sql(cursor, f"""
+                {self._SELECT_LEASED_SQL}
+                WHERE 
+                    lease_expire > ?
+                    AND state = 1
+                ORDER BY lease_expire
+                LIMIT 1
+            """, (now,))
+            for row in cursor.fetchall():
+                task = self._to_tasks([row[:-1]])[0]
+                task.next_run_time = max(task.next_run_time, row[-1])
+                if not task_list or task.next_run_time < task_list[0].next_run_time:
+                    task_list = [task]
             if task_list:
                 return task_list[0]
             return None
@@ -0,0 +1,116 @@
+import time
+from threading import RLock
+
+from base import FailedTask, Storage, TaskState, Scheduler
+from scheduler import HeapScheduler
+from storage.sqlite import SqliteStorage
+
+
+class TieredStorage(Storage):
+    """分层任务存储器
+    所有任务都写入持久化存储器，horizon秒内到期的任务同时放入内存调度器(热队列)，take和get_next直接在内存中完成；
+    热队列每隔horizon/2秒通过take_ahead从持久化存储器预取一次即将到期的任务，预取的任务被租约占用，不会被其他进程认领。
+    持久化存储器应只由一个TieredStorage消费；进程崩溃时预取的任务在租约到期后才能被重新认领，close时会释放租约。
+    """
+
+    def __init__(self, durable: Storage = None, horizon: float = 5, hot_size: int = 10000,
+                 scheduler: Scheduler = None) -> None:
+        """
+        Args:
+            durable: 持久化存储器，默认为SqliteStorage
+            horizon: 热队列的时间范围，单位为秒，在此时间内到期的任务放入内存
+            hot_size: 热队列最大任务数，超出的任务只保存在持久化存储器中，等待下次预取
+            scheduler: 热队列使用的调度器，默认为HeapScheduler
+        """
+        super().__init__()
+        self._durable = SqliteStorage() if durable is None else durable
+        self._horizon = horizon
+        self._hot_size = hot_size
+        self._hot = HeapScheduler() if scheduler is None else scheduler
+        self._taken = set()     # 已从热队列取出、尚未回写或移除的任务ID
+        self._next_refill = 0   # 下次预取的时间
+        self._lock = RLock()
+
+    def _refill(self, now: float) -> None:
+        """到达预取时间时从持久化存储器预取即将到期的任务，已在热队列中或已取出的任务不再放入"""
+        if now < self._next_refill:
+            return
+        self._next_refill = now + self._horizon / 2
+        free = self._hot_size - len(self._hot)
+        if free <= 0:
+            return
+        for task in self._durable.take_ahead(self._horizon, free):
+            if task.task_id not in self._hot and task.task_id not in self._taken:
+                self._hot.push(task)
+
+    def take(self) -> FailedTask:
+        task_list = self.take_many(1)
+        if task_list:
+            return task_list[0]
+        return None
+
+    def take_many(self, n: int) -> [FailedTask]:
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            task_list = self._hot.pop_due(now, n)
+            self._taken.update(task.task_id for task in task_list)
+            return task_list
+
+    def put(self, task: FailedTask) -> None:
+        self.put_many([task])
+
+    def put_many(self, tasks: [FailedTask]) -> None:
+        """先写入持久化存储器，再将horizon内到期的待重试任务放入热队列
+        带去重键的新任务可能被合并到已有任务，不直接放入热队列，由预取加载
+        """
+        merging = {id(task) for task in tasks if task.task_id == FailedTask.INIT_ID and task.dedup_key is not None}
+        self._durable.put_many(tasks)
+        with self._lock:
+            deadline = time.time() + self._horizon
+            for task in tasks:
+                self._taken.discard(task.task_id)
+                if task.state != TaskState.Failed:
+                    self._hot.remove(task.task_id)
+                elif (id(task) not in merging and task.next_run_time <= deadline
+                      and (task.task_id in self._hot or len(self._hot) < self._hot_size)):
+                    self._hot.push(task)
+
+    def remove(self, task_id: int) -> None:
+        self.remove_many([task_id])
+
+    def remove_many(self, task_ids: [int]) -> None:
+        self._durable.remove_many(task_ids)
+        with self._lock:
+            for task_id in task_ids:
+                self._taken.discard(task_id)
+                self._hot.remove(task_id)
+
+    def load_payload(self, tasks: [FailedTask]) -> None:
+        self._durable.load_payload(tasks)
+
+    def pending_count(self) -> int:
+        return self._durable.pending_count()
+
+    def all(self) -> [FailedTask]:
+        return self._durable.all()
+
+    def get_next(self) -> [FailedTask]:
+        """
+        Returns: 返回热队列中最近需要执行的任务，热队列为空时查询持久化存储器
+        """
+        with self._lock:
+            self._refill(time.time())
+            task = self._hot.peek()
+        if task is not None:
+            return task
+        return self._durable.get_next()
+
+    def close(self) -> None:
+        """将热队列中的任务回写以释放预取时占用的租约，然后关闭持久化存储器"""
+        with self._lock:
+            hot = self._hot.pop_due(float('inf'), len(self._hot))
+        if hot:
+            self._durable.put_many(hot)
+        if hasattr(self._durable, 'close'):
+            self._durable.close()
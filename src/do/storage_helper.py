@@ -3,10 +3,11 @@ import time
 from configuration import configuration
 from base import ANY_TIME, TaskState, FailedTask, TaskType
 from do_log import exception
+from metrics import storage_latency
 
 
 def new_failed_task(task_name: str, task_type: TaskType, task_args: list, task_kwargs: dict,
-                    runner_name: str, max_retry: int) -> FailedTask:
+                    runner_name: str, max_retry: int, dedup_key: str = None, priority: int = 0) -> FailedTask:
     """创建新的失败任务
 
     Args:
@@ -16,6 +17,8 @@ def new_failed_task(task_name: str, task_type: TaskType, task_args: list, task_k
         task_kwargs (dict): 任务关键字参数
         runner_name (str): 任务运行器名
         max_retry (int): 最大重试次数
+        dedup_key (str, optional): 去重键
+        priority (int, optional): 优先级
 
     Returns:
         FailedTask: 失败任务对象
@@ -31,11 +34,13 @@ def new_failed_task(task_name: str, task_type: TaskType, task_args: list, task_k
                       create_time=time.time(),
                       update_time=time.time(),
                       next_run_time=ANY_TIME,
-                      state=TaskState.Failed)
+                      state=TaskState.Failed,
+                      dedup_key=dedup_key,
+                      priority=priority)
 
 
-def task_failed(task: FailedTask) -> None:
-    """任务失败
+def mark_failed(task: FailedTask) -> None:
+    """更新失败任务的状态，不写入存储器
 
     Args:
         task (FailedTask): 失败任务
@@ -43,18 +48,55 @@ def task_failed(task: FailedTask) -> None:
     task.update_time = time.time()
     if task.next_run_time == ANY_TIME:
         task.next_run_time = time.time()
+    task.retry_delay = max(task.next_run_time - task.update_time, 0)
     if task.max_retry != 0 and task.retry_count == task.max_retry:
         task.state = TaskState.Stopped
     else:
         task.retry_count += 1
         task.state = TaskState.Failed
+
+
+def task_failed(task: FailedTask) -> None:
+    """任务失败
+
+    Args:
+        task (FailedTask): 失败任务
+    """
+    mark_failed(task)
     try:
-        configuration.storage.put(task)
+        with storage_latency.time(op='put'):
+            configuration.storage.put(task)
     except Exception:
         exception(f'failed to save task-{task.task_name}.')
         raise
 
 
+def save_tasks(tasks: [FailedTask]) -> None:
+    """批量写入已更新状态的任务
+
+    Args:
+        tasks ([FailedTask]): 任务列表
+    """
+    try:
+        with storage_latency.time(op='put_many'):
+            configuration.storage.put_many(tasks)
+    except Exception:
+        exception(f'failed to save {len(tasks)} tasks.')
+        raise
+
+
+def tasks_deferred(tasks: [FailedTask]) -> None:
+    """批量推迟任务，任务的下次执行时间由调用者设置，不计入重试次数
+
+    Args:
+        tasks ([FailedTask]): 被推迟的任务列表
+    """
+    now = time.time()
+    for task in tasks:
+        task.update_time = now
+    save_tasks(tasks)
+
+
 def task_interrupted(task: FailedTask) -> None:
     """任务中断
 
@@ -63,7 +105,8 @@ def task_interrupted(task: FailedTask) -> None:
     """
     task.update_time = time.time()
     task.state = TaskState.Interrupted
-    configuration.storage.put(task)
+    with storage_latency.time(op='put'):
+        configuration.storage.put(task)
 
 
 def take_failed_task() -> FailedTask:
@@ -72,14 +115,41 @@ def take_failed_task() -> FailedTask:
     Returns:
         FailedTask: 待重试失败任务
     """
-    return configuration.storage.take()
+    with storage_latency.time(op='take'):
+        return configuration.storage.take()
+
+
+def take_failed_tasks(n: int) -> [FailedTask]:
+    """批量获取需要重试的失败任务
+
+    Args:
+        n (int): 最大任务数
+
+    Returns:
+        [FailedTask]: 待重试失败任务列表
+    """
+    with storage_latency.time(op='take_many'):
+        return configuration.storage.take_many(n)
+
+
+def load_payload(tasks: [FailedTask]) -> None:
+    """为参数未加载的任务加载参数
+
+    Args:
+        tasks ([FailedTask]): 任务列表
+    """
+    unloaded = [task for task in tasks if task.task_args is None]
+    if unloaded:
+        with storage_latency.time(op='load_payload'):
+            configuration.storage.load_payload(unloaded)
 
 
 def next_failed_task() -> FailedTask:
     """
     Returns: 返回下一个待执行的任务
     """
-    return configuration.storage.get_next()
+    with storage_latency.time(op='get_next'):
+        return configuration.storage.get_next()
 
 
 def task_success(task_id: int) -> None:
@@ -89,7 +159,20 @@ def task_success(task_id: int) -> None:
         task_id (int): 任务ID
     """
     if task_id != FailedTask.INIT_ID:
-        configuration.storage.remove(task_id)
+        with storage_latency.time(op='remove'):
+            configuration.storage.remove(task_id)
+
+
+def tasks_success(task_ids: [int]) -> None:
+    """多个任务成功，一次从存储器中删除
+
+    Args:
+        task_ids ([int]): 任务ID列表
+    """
+    task_ids = [task_id for task_id in task_ids if task_id != FailedTask.INIT_ID]
+    if task_ids:
+        with storage_latency.time(op='remove_many'):
+            configuration.storage.remove_many(task_ids)
 
 
 def task_info() -> [dict]:
@@ -97,6 +180,8 @@ def task_info() -> [dict]:
     Returns: 返回字典类型的任务信息
     """
     info_list = []
-    for task in configuration.storage.all():
+    tasks = configuration.storage.all()
+    load_payload(tasks)
+    for task in tasks:
         info_list.append(task.__dict__.copy())
     return info_list
\ No newline at end of file
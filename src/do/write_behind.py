@@ -0,0 +1,98 @@
+import atexit
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from base import FailedTask, OverflowPolicy
+from do_log import error, exception
+from error import ConfigureException
+
+
+class WriteBehindBuffer:
+    """
+    失败任务写缓冲区
+    调用者线程只将失败任务放入内存缓冲区，由后台线程按刷写间隔批量写入存储器，进程退出时写入剩余任务
+    """
+
+    _POLICIES = (OverflowPolicy.Block, OverflowPolicy.DropNewest, OverflowPolicy.DropOldest,
+                 OverflowPolicy.WriteThrough)   # 支持的溢出策略
+
+    def __init__(self, save: callable, buffer_size: int = 10000, flush_interval: float = 0.05,
+                 policy: OverflowPolicy = OverflowPolicy.Block) -> None:
+        """
+        Args:
+            save: 批量写入函数，参数为任务列表
+            buffer_size: 缓冲区容量
+            flush_interval: 刷写间隔，单位为秒
+            policy: 缓冲区满时的处理策略
+        """
+        if policy not in self._POLICIES:
+            raise ConfigureException(f'unsupported overflow policy for write-behind buffer: {policy!r}')
+        self._save = save
+        self._buffer_size = max(buffer_size, 1)
+        self._flush_interval = flush_interval
+        self._policy = policy
+        self._buffer = deque()
+        self._cond = Condition()
+        self._dropped = 0   # 被丢弃的任务数
+        self._thread = Thread(name='do-flusher', target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def append(self, task: FailedTask) -> None:
+        """放入失败任务，缓冲区满时按策略处理
+
+        Args:
+            task (FailedTask): 已更新状态的失败任务
+        """
+        with self._cond:
+            full = len(self._buffer) >= self._buffer_size
+            if full and self._policy == OverflowPolicy.Block:
+                self._cond.wait_for(lambda: len(self._buffer) < self._buffer_size)
+            elif full and self._policy == OverflowPolicy.DropNewest:
+                self._dropped += 1
+                error(f'write-behind buffer full, drop task-{task.task_name}.')
+                return
+            elif full and self._policy == OverflowPolicy.DropOldest:
+                dropped = self._buffer.popleft()
+                self._dropped += 1
+                error(f'write-behind buffer full, drop task-{dropped.task_name}.')
+            if not full or self._policy != OverflowPolicy.WriteThrough:
+                self._buffer.append(task)
+                if len(self._buffer) in (1, self._buffer_size):
+                    self._cond.notify_all()
+                return
+        self._save([task])
+
+    def flush(self) -> None:
+        """将缓冲区中的任务全部写入存储器，写入失败时放回缓冲区等待下次刷写"""
+        with self._cond:
+            tasks = list(self._buffer)
+            self._buffer.clear()
+            self._cond.notify_all()
+        if not tasks:
+            return
+        try:
+            self._save(tasks)
+        except Exception:
+            with self._cond:
+                self._buffer.extendleft(reversed(tasks))
+            raise
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) > 0)
+                self._cond.wait_for(lambda: len(self._buffer) >= self._buffer_size, self._flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                exception('write-behind flush failed!')
+                time.sleep(self._flush_interval)
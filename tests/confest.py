@@ -8,14 +8,18 @@ root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(root_dir, 'src', 'do'))
 
 from api import start_do as start
+from configuration import configure
 
 
 @pytest.fixture(scope="session")
-def start_do():
+def start_do(tmp_path_factory):
+    # 切换到临时目录，测试生成的数据库及日志文件不写入工作目录
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('do'))
+    configure(workers=4)
     start(block=False)
-    db_path = os.path.join(os.getcwd(), 'do.db')
-    if os.path.isfile(db_path):
-        os.remove(db_path)
+    yield
+    os.chdir(cwd)
 
 
 def keep_check(condition: callable, max_time: float = 60, interval: float = 0.1):
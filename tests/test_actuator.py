@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+from actuator import DoActuator, AsyncDoActuator
+from base import FailedTask, TaskState, TaskType, AsyncRunner, BatchRunner, Runner
+from breaker import CircuitBreaker, BreakerState
+from configuration import configure
+from confest import keep_check
+from storage.memory import MemoryStorage
+
+
+def _new_task(runner_name: str, priority: int = 0) -> FailedTask:
+    return FailedTask(task_id=FailedTask.INIT_ID,
+                      task_type=TaskType.Idempotent,
+                      task_name=runner_name,
+                      task_args=[],
+                      task_kwargs={},
+                      runner_name=runner_name,
+                      retry_count=0,
+                      max_retry=-1,
+                      create_time=time.time(),
+                      update_time=time.time(),
+                      next_run_time=time.time(),
+                      state=TaskState.Failed,
+                      priority=priority)
+
+
+def test_fair_select():
+    storage = MemoryStorage()
+    configure(storage=storage)
+    actuator = DoActuator()
+    actuator.register_runner('bulk', None)
+    actuator.register_runner('light', None, weight=2)
+
+    task_list = [_new_task('critical', priority=1)] + [_new_task('bulk') for _ in range(20)] \
+        + [_new_task('light') for _ in range(20)] + [_new_task('other') for _ in range(20)]
+    selected = actuator._fair_select(task_list, 21)
+    names = [task.runner_name for task in selected]
+    assert names[0] == 'critical'
+    assert 9 <= names.count('light') <= 11
+    assert 4 <= names.count('bulk') <= 6 and 4 <= names.count('other') <= 6
+    assert len(storage.all()) == len(task_list) - 21
+
+    assert actuator._fair_select(task_list[:3], 5) == task_list[:3]
+
+
+def test_async_concurrency_limit():
+    storage = MemoryStorage()
+    configure(storage=storage)
+    actuator = AsyncDoActuator(DoActuator())
+    runs = list()
+
+    async def _run(**kwargs):
+        runs.append(time.time())
+        await asyncio.sleep(0.05)
+    actuator.register_runner('limited', AsyncRunner(_run), concurrency=1)
+    storage.put_many([_new_task('limited') for _ in range(4)])
+
+    loop = asyncio.new_event_loop()
+    main = loop.create_task(actuator.start(concurrency=4))
+    thread = threading.Thread(target=loop.run_until_complete, args=(asyncio.wait({main}),), daemon=True)
+    thread.start()
+    try:
+        keep_check(lambda: len(runs) == 4, max_time=5)
+        keep_check(lambda: actuator._semaphore._value == 4, max_time=2, interval=0.05)
+        assert all(later - earlier >= 0.04 for earlier, later in zip(runs, runs[1:]))
+    finally:
+        loop.call_soon_threadsafe(main.cancel)
+        thread.join(5)
+
+
+def test_breaker_probe_skipped():
+    configure(storage=MemoryStorage())
+    actuator = DoActuator()
+    breakers = dict()
+    for runner_name in ['missing', 'single', 'batch']:
+        breakers[runner_name] = CircuitBreaker(min_calls=1, open_timeout=0.05)
+        actuator.register_breaker(runner_name, breakers[runner_name])
+        breakers[runner_name].record(False)
+    actuator.register_runner('single', Runner(lambda **kwargs: None))
+    actuator.register_runner('batch', Runner(lambda **kwargs: None))
+    actuator.register_batch('batch', BatchRunner(lambda items: [None] * len(items)))
+    time.sleep(0.1)
+
+    for runner_name, redo in [('missing', actuator._redo), ('single', actuator._redo),
+                              ('batch', lambda task: actuator._redo_batch([task]))]:
+        task = _new_task(runner_name)
+        task.task_args = None
+        assert breakers[runner_name].allow()
+        redo(task)
+        assert breakers[runner_name].state == BreakerState.HalfOpen
+        assert breakers[runner_name].allow()
+
+
+def test_wait_after_missed_wakeup():
+    actuator = DoActuator()
+    wakeups = actuator._wakeups
+    actuator._notify()
+    start = time.time()
+    actuator._wait(5, wakeups)
+    assert time.time() - start < 1
+    start = time.time()
+    actuator._wait(0.1, actuator._wakeups)
+    assert time.time() - start >= 0.09
+
+
+def test_async_failure_wakes_sync():
+    configure(storage=MemoryStorage())
+    sync = DoActuator()
+    actuator = AsyncDoActuator(sync)
+    woken = list()
+    sync.add_listener(lambda: woken.append(True))
+    wakeups = sync._wakeups
+    actuator.handle_failed_task(_new_task('any'))
+    assert sync._wakeups == wakeups + 1 and woken
+
+
+def test_finish_batch_grouped_writes():
+    storage = MemoryStorage()
+    configure(storage=storage)
+    actuator = DoActuator()
+    storage.put_many([_new_task('batched') for _ in range(6)])
+    tasks = storage.take_many(6)
+    calls = list()
+    for name in ('put', 'put_many', 'remove', 'remove_many'):
+        method = getattr(storage, name)
+        setattr(storage, name, lambda *args, _name=name, _method=method: calls.append(_name) or _method(*args))
+
+    actuator._finish_batch(tasks, [None, Exception('bad'), None, Exception('bad'), None, None])
+    assert sorted(calls) == ['put_many', 'remove_many']
+    remaining = storage.all()
+    assert sorted(task.task_id for task in remaining) == [tasks[1].task_id, tasks[3].task_id]
+    assert all(task.retry_count == 1 and task.state == TaskState.Failed for task in remaining)
+
+
+def test_busy_deferral_staggered():
+    storage = MemoryStorage()
+    configure(storage=storage)
+    actuator = DoActuator()
+    actuator.register_runner('capped', None, concurrency=2)
+    actuator._runner_running['capped'] = 2
+    actuator._exec_time['capped'] = 1
+    storage.put_many([_new_task('capped') for _ in range(4)])
+    now = time.time()
+    assert actuator._dispatch_all(storage.take_many(4)) == 4
+    # 被推迟的任务按执行耗时除以并发上限依次错开，不会同时再次到期
+    times = sorted(task.next_run_time for task in storage.all())
+    assert [round(later - earlier, 3) for earlier, later in zip(times, times[1:])] == [0.5] * 3
+    assert now + 0.4 < times[0] < now + 0.6
+    assert storage.take_many(4) == []
@@ -1,15 +1,31 @@
+import asyncio
+import os
+import threading
 import time
+import urllib.request
 
 import pytest
 
-from base import IntervalStrategy, BaseNamer, TaskType
-from api import do, task_info
+from base import IntervalStrategy, BaseNamer, TaskType, BatchRunner
+from breaker import CircuitBreaker
+from api import do, task_info, start_async_do, stats, metrics_snapshot, serve_metrics
 from configuration import configure
+from error import ConfigureException
+from limiter import TokenBucket
 from confest import start_do, keep_check
 from storage.memory import MemoryStorage
 from storage.sqlite import SqliteStorage
 
 
+@do(process=True)
+def do_in_process(path):
+    with open(path, 'a') as f:
+        f.write(f'{os.getpid()}\n')
+    with open(path) as f:
+        if len(f.readlines()) < 3:
+            raise Exception("not yet")
+
+
 class TestDo1:
     """
     测试基于do的自动重试
@@ -261,3 +277,436 @@ class TestDo7:
         assert self.counter_1 > self.counter_2
         assert expect_count + margin >= self.counter_2 >= expect_count - margin
 
+
+
+class TestDo8:
+    """
+    测试重试任务的并发执行与执行器并发上限
+    """
+    data = dict()
+
+    def _slow(self, key: str):
+        with self.lock:
+            self.data[key] += 1
+            self.data[f'{key}-max'] = max(self.data[f'{key}-max'], self.data[key])
+        time.sleep(0.3)
+        with self.lock:
+            self.data[key] -= 1
+        if self.data['failing']:
+            raise Exception("slow failed")
+        with self.lock:
+            self.data[f'{key}-success'] += 1
+
+    def do_slow(self):
+        self._slow('parallel')
+
+    def do_slow_limited(self):
+        self._slow('limited')
+
+    def test_case(self, start_do):
+        self.lock = threading.Lock()
+        configure(storage=MemoryStorage())
+        self.do_slow = do(self.do_slow)
+        self.do_slow_limited = do(self.do_slow_limited, concurrency=1)
+        self.data['failing'] = True
+        for key in ['parallel', 'limited']:
+            self.data.update({key: 0, f'{key}-max': 0, f'{key}-success': 0})
+
+        for _ in range(3):
+            with pytest.raises(Exception):
+                self.do_slow()
+            with pytest.raises(Exception):
+                self.do_slow_limited()
+        with self.lock:
+            self.data['failing'] = False
+            self.data.update({f'{key}-max': self.data[key] for key in ['parallel', 'limited']})
+        keep_check(lambda: self.data['parallel-success'] == 3 and self.data['limited-success'] == 3, max_time=10)
+
+        assert self.data['parallel-max'] > 1
+        assert self.data['limited-max'] == 1
+
+
+class TestDo9:
+    """
+    测试协程函数的失败记录与异步执行器重试
+    """
+    data = dict()
+
+    async def do_async_get_66(self):
+        await asyncio.sleep(0)
+        self.data['counter-do'] += 1
+        if self.data['counter-do'] != 66:
+            raise Exception("not 66")
+        self.data['66-do'] = True
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        threading.Thread(target=asyncio.run, args=(start_async_do(),), daemon=True).start()
+        self.do_async_get_66 = do(self.do_async_get_66)
+        self.data.update({
+            '66-do': False,
+            'counter-do': 0
+        })
+
+        with pytest.raises(Exception):
+            asyncio.run(self.do_async_get_66())
+        assert self.data['counter-do'] >= 1
+        keep_check(lambda: self.data['66-do'] is True, max_time=10)
+        assert self.data['counter-do'] == 66
+
+
+class TestDo10:
+    """
+    测试失败任务的延迟批量写入
+    """
+    data = dict()
+
+    def do_get_3(self):
+        self.data['counter-do'] += 1
+        if self.data['counter-do'] != 3:
+            raise Exception("not 3")
+        self.data['3-do'] = True
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage(), write_behind=True, flush_interval=0.5)
+        self.do_get_3 = do(self.do_get_3)
+        self.data.update({
+            '3-do': False,
+            'counter-do': 0
+        })
+        try:
+            with pytest.raises(Exception):
+                self.do_get_3()
+            assert task_info() == []
+            keep_check(lambda: self.data['3-do'] is True, max_time=10)
+            assert self.data['counter-do'] == 3
+        finally:
+            configure(write_behind=False)
+
+
+class TestDo11:
+    """
+    测试熔断器推迟重试
+    """
+    counter = 0
+    healed = False
+
+    def do_down(self):
+        self.counter += 1
+        if not self.healed:
+            raise Exception("down")
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_down = do(self.do_down, circuit_breaker=CircuitBreaker(min_calls=3, open_timeout=1))
+
+        with pytest.raises(Exception):
+            self.do_down()
+        time.sleep(2.5)
+        assert 4 <= self.counter <= 8
+
+        self.healed = True
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_down'], max_time=5)
+
+
+class TestDo12:
+    """
+    测试限流器控制重试速率
+    """
+    counter = 0
+    healed = False
+
+    def do_limited(self):
+        self.counter += 1
+        if not self.healed:
+            raise Exception("limited")
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_limited = do(self.do_limited, rate_limit=TokenBucket(rate=5, burst=1))
+
+        with pytest.raises(Exception):
+            self.do_limited()
+        time.sleep(2)
+        assert 6 <= self.counter <= 13
+
+        self.healed = True
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_limited'], max_time=5)
+
+
+class TestDo13:
+    """
+    测试持续失败的任务不会空转占满CPU
+    """
+    counter = 0
+    healed = False
+
+    def do_poisoned(self):
+        self.counter += 1
+        if not self.healed:
+            raise Exception("poisoned")
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_poisoned = do(self.do_poisoned)
+
+        with pytest.raises(Exception):
+            self.do_poisoned()
+        time.sleep(1)
+        assert 10 <= self.counter <= 150
+        snapshot = stats()
+        assert snapshot.throttled > 0
+        assert snapshot.retries > 0 and snapshot.retry_time > 0
+        assert snapshot.polls > 0 and snapshot.schedule_time > 0
+
+        self.healed = True
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_poisoned'], max_time=5)
+
+
+class TestDo14:
+    """
+    测试合并相同的失败任务
+    """
+    ok = False
+
+    def do_refresh(self, key):
+        if not self.ok:
+            raise Exception("refresh failed")
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_refresh = do(self.do_refresh, coalesce=True, retry_strategy=IntervalStrategy(0.1))
+
+        for key in ['a', 'a', 'a', 'b', 'a']:
+            with pytest.raises(Exception):
+                self.do_refresh(key=key)
+        tasks = [task for task in task_info() if task.get('runner_name') == 'do_refresh']
+        assert sorted(task.get('task_kwargs')['key'] for task in tasks) == ['a', 'b']
+
+        self.ok = True
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_refresh'], max_time=5)
+
+
+class TestDo15:
+    """
+    测试批量重试
+    """
+    ok = False
+    healed = False
+    calls = []
+
+    def do_upload(self, data):
+        raise Exception("upload failed")
+
+    def upload_many(self, items):
+        self.calls.append(len(items))
+        if not self.ok:
+            raise Exception("upload failed")
+        return [Exception("bad data") if kwargs['data'] == 'bad' and not self.healed else None for _, kwargs in items]
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_upload = do(self.do_upload, retry_strategy=IntervalStrategy(0.1),
+                            batch=BatchRunner(self.upload_many, max_size=20, max_wait=1))
+
+        for i in range(10):
+            with pytest.raises(Exception):
+                self.do_upload(data=str(i))
+        with pytest.raises(Exception):
+            self.do_upload(data='bad')
+        keep_check(lambda: sum(self.calls) >= 11, max_time=5)
+        assert max(self.calls) > 1
+
+        self.ok = True
+        keep_check(lambda: [task.get('task_kwargs')['data'] for task in task_info()
+                            if task.get('runner_name') == 'do_upload'] == ['bad'], max_time=5)
+
+        self.healed = True
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_upload'], max_time=5)
+
+
+class TestDo16:
+    """
+    测试在进程池中重试
+    """
+
+    def test_case(self, start_do, tmp_path):
+        configure(storage=MemoryStorage())
+        path = str(tmp_path / 'pids')
+        with pytest.raises(Exception):
+            do_in_process(path)
+
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_in_process'],
+                   max_time=10)
+        with open(path) as f:
+            pids = {int(line) for line in f}
+        assert os.getpid() in pids and len(pids) > 1
+
+    def test_not_module_level(self):
+        def local_func():
+            pass
+
+        with pytest.raises(ConfigureException):
+            do(local_func, process=True)
+
+
+class TestDo17:
+    """
+    测试重试执行超时
+    """
+    calls = 0
+    cancelled = False
+
+    def do_hang(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise Exception("first call failed")
+        if self.calls == 2:
+            time.sleep(2)
+
+    def do_late_fail(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise Exception("first call failed")
+        if self.calls == 2:
+            time.sleep(0.6)
+            raise Exception("abandoned call failed")
+
+    def do_stuck(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise Exception("first call failed")
+        if self.calls < 12:
+            time.sleep(0.5)
+
+    async def do_hang_async(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise Exception("first call failed")
+        if self.calls == 2:
+            try:
+                await asyncio.sleep(2)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+
+    def test_thread(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_hang = do(self.do_hang, execution_timeout=0.2)
+
+        with pytest.raises(Exception):
+            self.do_hang()
+        start = time.time()
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_hang'], max_time=5)
+        assert self.calls == 3 and time.time() - start < 1.5
+
+    def test_async(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_hang_async = do(self.do_hang_async, execution_timeout=0.2)
+
+        with pytest.raises(Exception):
+            asyncio.run(self.do_hang_async())
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_hang_async'],
+                   max_time=5)
+        assert self.calls == 3 and self.cancelled
+
+    def test_late_failure(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_late_fail = do(self.do_late_fail, execution_timeout=0.1)
+
+        with pytest.raises(Exception):
+            self.do_late_fail()
+        keep_check(lambda: self.calls == 3, max_time=5)
+        time.sleep(1)
+        assert self.calls == 3
+        assert not [task for task in task_info() if task.get('runner_name') == 'do_late_fail']
+
+    def test_attempt_threads_bounded(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_stuck = do(self.do_stuck, execution_timeout=0.05, retry_strategy=IntervalStrategy(0.01))
+
+        peak = 0
+
+        def _done():
+            nonlocal peak
+            peak = max(peak, len([t for t in threading.enumerate() if t.name.startswith('do-attempt')]))
+            return not [task for task in task_info() if task.get('runner_name') == 'do_stuck']
+
+        with pytest.raises(Exception):
+            self.do_stuck()
+        keep_check(_done, max_time=10, interval=0.02)
+        assert self.calls >= 12 and 0 < peak <= 8
+
+class TestDo18:
+    """
+    测试重试指标
+    """
+    calls = 0
+
+    def do_flaky(self):
+        self.calls += 1
+        if self.calls < 3:
+            raise Exception("not yet")
+
+    def test_metrics(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_flaky = do(self.do_flaky, retry_strategy=IntervalStrategy(0.1))
+
+        with pytest.raises(Exception):
+            self.do_flaky()
+        keep_check(lambda: not [task for task in task_info() if task.get('runner_name') == 'do_flaky'], max_time=5)
+        snapshot = metrics_snapshot()
+        assert snapshot['do_failures_total'][('do_flaky',)] == 2
+        assert snapshot['do_retries_total'][('do_flaky', 'failure')] == 1
+        assert snapshot['do_retries_total'][('do_flaky', 'success')] == 1
+        assert snapshot['do_execution_seconds'][('do_flaky',)][2] == 2
+        assert snapshot['do_schedule_lag_seconds'][('do_flaky',)][2] == 2
+        assert snapshot['do_storage_seconds'][('remove',)][2] >= 1
+        assert snapshot['do_idle_seconds_total'][()] > 0
+        assert snapshot['do_queue_depth'][()] >= 0
+
+        server = serve_metrics(port=0)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5) as response:
+                assert 'do_retries_total{runner="do_flaky",result="success"} 1' in response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestDo19:
+    """
+    测试并发受限的执行器积压任务时，其他执行器的任务仍能及时执行
+    """
+    data = dict()
+
+    def do_backlog(self):
+        if self.data['failing']:
+            raise Exception("backlog failed")
+        time.sleep(0.1)
+        self.data['backlog'] += 1
+
+    def do_other(self):
+        if self.data['other'] is None:
+            self.data['other'] = 0
+            raise Exception("other failed")
+        self.data['other'] = time.time()
+
+    def test_case(self, start_do):
+        configure(storage=MemoryStorage())
+        self.do_backlog = do(self.do_backlog, concurrency=1)
+        self.do_other = do(self.do_other)
+        self.data.update({'failing': True, 'backlog': 0, 'other': None})
+
+        for _ in range(20):
+            with pytest.raises(Exception):
+                self.do_backlog()
+        self.data['failing'] = False
+        time.sleep(0.2)
+        start = time.time()
+        with pytest.raises(Exception):
+            self.do_other()
+        keep_check(lambda: self.data['other'], max_time=5, interval=0.01)
+        assert self.data['other'] - start < 0.5
+        assert self.data['backlog'] < 20
+        keep_check(lambda: self.data['backlog'] == 20, max_time=10)
@@ -0,0 +1,53 @@
+import time
+
+from breaker import CircuitBreaker, BreakerState
+
+
+def test_breaker_open_and_recover():
+    breaker = CircuitBreaker(failure_rate=0.5, window=60, min_calls=4, open_timeout=0.2, probes=1)
+    for success in [True, False, True]:
+        assert breaker.allow()
+        breaker.record(success)
+    assert breaker.state == BreakerState.Closed
+    breaker.record(False)
+    assert breaker.state == BreakerState.Open
+    assert not breaker.allow()
+    assert breaker.retry_at() > time.time()
+
+    time.sleep(0.25)
+    assert breaker.state == BreakerState.HalfOpen
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == BreakerState.Open
+
+    time.sleep(0.25)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == BreakerState.Closed
+    assert breaker.allow()
+
+
+def test_breaker_window():
+    breaker = CircuitBreaker(failure_rate=0.5, window=0.2, min_calls=2, open_timeout=10)
+    breaker.record(False)
+    time.sleep(0.25)
+    breaker.record(True)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == BreakerState.Closed
+
+
+def test_breaker_release():
+    breaker = CircuitBreaker(min_calls=1, open_timeout=0.1, probes=1)
+    breaker.record(False)
+    assert breaker.state == BreakerState.Open
+    breaker.release()
+    assert not breaker.allow()
+
+    time.sleep(0.15)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.state == BreakerState.HalfOpen
+    assert breaker.allow()
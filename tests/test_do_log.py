@@ -1,8 +1,8 @@
 from do_log import *
 
 
-def test_set_log_file():
-    file_path = os.path.join(os.getcwd(), 'do.log')
+def test_set_log_file(tmp_path):
+    file_path = os.path.join(tmp_path, 'do.log')
     if os.path.isfile(file_path):
         os.remove(file_path)
 
@@ -0,0 +1,21 @@
+import time
+
+from limiter import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    wait_time = bucket.acquire()
+    assert 0 < wait_time <= 0.1
+    assert bucket.wait_time() > 0
+
+    bucket.refund()
+    assert bucket.wait_time() == 0
+    assert bucket.acquire() == 0
+
+    time.sleep(0.25)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
@@ -0,0 +1,54 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_metrics_snapshot_and_exposition():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter('retries_total', 'Retries.', ('runner', 'result')))
+    gauge = registry.register(Gauge('depth', 'Depth.', func=lambda: 3))
+    histogram = registry.register(Histogram('latency_seconds', 'Latency.', ('runner',), buckets=(0.1, 1)))
+    counter.inc(runner='a', result='success')
+    counter.inc(2, runner='a', result='success')
+    counter.inc(runner='b"\n', result='failure')
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, runner='a')
+
+    snapshot = registry.snapshot()
+    assert snapshot['retries_total'][('a', 'success')] == 3
+    assert snapshot['depth'] == {(): 3}
+    assert snapshot['latency_seconds'][('a',)] == ([1, 1, 1], 5.55, 3)
+    # 快照是副本，之后的更新不影响已取得的快照
+    counter.inc(runner='a', result='success')
+    assert snapshot['retries_total'][('a', 'success')] == 3
+
+    text = registry.exposition()
+    assert '# TYPE retries_total counter' in text
+    assert 'retries_total{runner="a",result="success"} 4' in text
+    assert 'retries_total{runner="b\\"\\n",result="failure"} 1' in text
+    assert 'depth 3' in text
+    assert 'latency_seconds_bucket{runner="a",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{runner="a",le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{runner="a",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{runner="a"} 3' in text
+    gauge.set(1)
+    assert registry.snapshot()['depth'] == {(): 3}
+
+
+def test_metrics_serve():
+    registry = MetricsRegistry()
+    registry.register(Counter('polls_total', 'Polls.')).inc()
+    server = registry.serve(port=0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'polls_total 1' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/other', timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
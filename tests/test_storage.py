@@ -0,0 +1,652 @@
+import datetime
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from base import FailedTask, TaskState, TaskType, OverflowPolicy
+from error import DataException, ConfigureException
+from scheduler import HeapScheduler, TimingWheelScheduler
+from storage.codec import COMPRESSED, JsonCodec, PickleCodec, MsgpackCodec
+from storage.journal import JournalStorage
+from storage.memory import MemoryStorage
+from storage.sqlite import SqliteStorage
+from storage.tiered import TieredStorage
+
+
+def _new_task(task_name: str = 'task', next_run_time: float = 0) -> FailedTask:
+    return FailedTask(task_id=FailedTask.INIT_ID,
+                      task_type=TaskType.Idempotent,
+                      task_name=task_name,
+                      task_args=[1, 'a'],
+                      task_kwargs={'k': 'v'},
+                      runner_name='runner',
+                      retry_count=0,
+                      max_retry=-1,
+                      create_time=time.time(),
+                      update_time=time.time(),
+                      next_run_time=next_run_time,
+                      state=TaskState.Failed)
+
+
+def _new_storage(storage_cls, tmp_path):
+    if storage_cls is SqliteStorage:
+        return SqliteStorage(db=os.path.join(tmp_path, 'do.db'))
+    if storage_cls is JournalStorage:
+        return JournalStorage(path=os.path.join(tmp_path, 'journal'))
+    return storage_cls()
+
+
+def test_sqlite_persistent_conn(tmp_path):
+    storage = SqliteStorage(db=os.path.join(tmp_path, 'do.db'))
+    storage.put(_new_task())
+    with storage._new_conn() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    with storage._new_conn() as conn_again:
+        assert conn_again is conn
+
+    conns = []
+
+    def _in_thread():
+        with storage._new_conn() as thread_conn:
+            conns.append(thread_conn)
+        task = storage.take()
+        storage.load_payload([task])
+        conns.append(task)
+
+    thread = threading.Thread(target=_in_thread)
+    thread.start()
+    thread.join()
+    assert conns[0] is not conn
+    assert conns[1].task_args == [1, 'a'] and conns[1].task_kwargs == {'k': 'v'}
+
+    storage.remove(conns[1].task_id)
+    assert storage.all() == []
+    with pytest.raises(sqlite3.ProgrammingError):
+        conns[0].execute('SELECT 1')
+
+    threads = [threading.Thread(target=storage.get_next) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(storage._holders) == 1
+    storage.close()
+
+
+def test_sqlite_upsert_and_index(tmp_path):
+    storage = SqliteStorage(db=os.path.join(tmp_path, 'do.db'))
+    first, second = _new_task('first', next_run_time=1), _new_task('second', next_run_time=2)
+    storage.put(first)
+    storage.put(second)
+    assert first.task_id != FailedTask.INIT_ID and second.task_id != first.task_id
+
+    first.retry_count = 3
+    first.next_run_time = 3
+    storage.put(first)
+    tasks = {task.task_id: task for task in storage.all()}
+    assert len(tasks) == 2
+    assert tasks[first.task_id].retry_count == 3
+    assert tasks[second.task_id].retry_count == 0
+    assert storage.take().task_id == second.task_id
+
+    with storage._new_conn() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(SqliteStorage._MIGRATIONS)
+        now = time.time()
+        plan = str(conn.execute(f'EXPLAIN QUERY PLAN {SqliteStorage._CLAIM_SUBQUERY}', (now, now, 1)).fetchall())
+        assert 'idx_failed_task_state_priority_next_run_time' in plan
+        assert 'TEMP B-TREE' not in plan
+    storage.close()
+
+
+def test_sqlite_codec(tmp_path):
+    db = os.path.join(tmp_path, 'do.db')
+    storage = SqliteStorage(db=db, compress_threshold=1024)
+    small, large = _new_task('small'), _new_task('large')
+    small.task_args = (b'\x00\xff', datetime.datetime(2024, 1, 1))
+    large.task_kwargs = {'payload': 'x' * 10000}
+    storage.put_many([small, large])
+
+    with storage._new_conn() as conn:
+        codecs = dict(conn.execute('SELECT task_name, codec FROM failed_task').fetchall())
+        assert codecs == {'small': PickleCodec.codec_id, 'large': PickleCodec.codec_id | COMPRESSED}
+        # 引入编解码器之前写入的JSON数据
+        conn.execute(f"INSERT INTO failed_task(task_type, task_name, task_args, task_kwargs, runner_name, retry_count, "
+                     f"max_retry, create_time, update_time, next_run_time, state) "
+                     f"VALUES(1, 'legacy', '{{\"task_args\": [1, \"a\"]}}', '{{\"k\": \"v\"}}', 'runner', 0, "
+                     f"-1, 0, 0, 0, 1)")
+    tasks = {task.task_name: task for task in storage.all()}
+    storage.load_payload(list(tasks.values()))
+    assert tasks['small'].task_args == (b'\x00\xff', datetime.datetime(2024, 1, 1))
+    assert tasks['large'].task_kwargs == {'payload': 'x' * 10000}
+    assert tasks['legacy'].task_args == [1, 'a'] and tasks['legacy'].task_kwargs == {'k': 'v'}
+    storage.close()
+
+    storage = SqliteStorage(db=db, codec=JsonCodec(), compress_threshold=0)
+    storage.put(_new_task('json'))
+    assert {task.task_name for task in storage.all()} == {'small', 'large', 'legacy', 'json'}
+    storage.close()
+
+
+def test_sqlite_lazy_payload(tmp_path):
+    storage = SqliteStorage(db=os.path.join(tmp_path, 'do.db'))
+    first, second = _new_task('first', next_run_time=1), _new_task('second', next_run_time=2)
+    storage.put_many([first, second])
+
+    assert storage.get_next().task_args is None
+    assert all(task.task_args is None and task.task_kwargs is None for task in storage.all())
+    taken = storage.take_many(2)
+    assert [task.task_args for task in taken] == [None, None]
+
+    # 参数未加载的任务被推迟时只更新调度字段
+    taken[0].next_run_time = time.time() + 60
+    taken[0].retry_count = 1
+    storage.put_many(taken[:1])
+    storage.remove(taken[1].task_id)
+    storage.load_payload(taken)
+    assert taken[0].task_args == [1, 'a'] and taken[0].task_kwargs == {'k': 'v'} and taken[0].retry_count == 1
+    assert taken[1].task_args is None
+    assert storage.take() is None
+    storage.close()
+
+
+def test_sqlite_msgpack_codec(tmp_path):
+    pytest.importorskip('msgpack')
+    storage = SqliteStorage(db=os.path.join(tmp_path, 'do.db'), codec=MsgpackCodec())
+    task = _new_task()
+    task.task_args = [b'\x00', 1.5]
+    storage.put(task)
+    task = storage.take()
+    storage.load_payload([task])
+    assert task.task_args == [b'\x00', 1.5]
+    storage.close()
+
+
+def test_sqlite_concurrent_init(tmp_path):
+    for trial in range(5):
+        db = os.path.join(tmp_path, f'do-{trial}.db')
+        barrier = threading.Barrier(6)
+        storages, errors = [], []
+
+        def _open():
+            barrier.wait()
+            try:
+                storages.append(SqliteStorage(db=db))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_open) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        with storages[0]._new_conn() as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == len(SqliteStorage._MIGRATIONS)
+        for storage in storages:
+            storage.close()
+
+
+@pytest.mark.parametrize('support_returning', [True, False])
+def test_sqlite_claim_lease(tmp_path, monkeypatch, support_returning):
+    monkeypatch.setattr(SqliteStorage, '_SUPPORT_RETURNING', support_returning)
+    db = os.path.join(tmp_path, 'do.db')
+    storages = [SqliteStorage(db=db, lease_timeout=0.5) for _ in range(4)]
+    for i in range(40):
+        storages[0].put(_new_task(f'task-{i}'))
+
+    claimed = [[] for _ in storages]
+
+    def _claim_all(i: int):
+        while True:
+            task = storages[i].take()
+            if task is None:
+                return
+            claimed[i].append(task.task_id)
+
+    threads = [threading.Thread(target=_claim_all, args=(i,)) for i in range(len(storages))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed_ids = [task_id for ids in claimed for task_id in ids]
+    assert len(claimed_ids) == 40
+    assert len(set(claimed_ids)) == 40
+
+    assert storages[1].get_next().next_run_time > time.time()
+    time.sleep(0.6)
+    assert storages[1].get_next().next_run_time <= time.time()
+    assert storages[1].take() is not None
+    for storage in storages:
+        storage.close()
+
+
+@pytest.mark.parametrize('storage_cls', [MemoryStorage, SqliteStorage, JournalStorage])
+def test_batch_ops(tmp_path, storage_cls):
+    storage = _new_storage(storage_cls, tmp_path)
+    now = time.time()
+    tasks = [_new_task(f'task-{i}', next_run_time=now - i) for i in range(10)]
+    tasks.append(_new_task('future', next_run_time=now + 60))
+    storage.put_many(tasks)
+    assert len({task.task_id for task in tasks}) == 11
+
+    taken = storage.take_many(4)
+    assert [task.task_name for task in taken] == ['task-9', 'task-8', 'task-7', 'task-6']
+    for task in taken:
+        task.next_run_time = now + 30
+    storage.put_many(taken)
+
+    rest = storage.take_many(100)
+    assert len(rest) == 6 and 'future' not in [task.task_name for task in rest]
+    storage.remove_many([task.task_id for task in rest])
+    assert sorted(task.task_name for task in storage.all()) == sorted(['future'] + [t.task_name for t in taken])
+    assert storage.take_many(100) == []
+
+
+@pytest.mark.parametrize('storage_cls', [MemoryStorage, SqliteStorage, JournalStorage])
+def test_dedup(tmp_path, storage_cls):
+    storage = _new_storage(storage_cls, tmp_path)
+    tasks = [_new_task(f'task-{i}') for i in range(3)]
+    for task in tasks:
+        task.dedup_key = 'key'
+    other = _new_task('other')
+    storage.put_many(tasks[:2] + [other])
+    storage.put(tasks[2])
+    assert len({task.task_id for task in tasks}) == 1 and other.task_id != tasks[0].task_id
+    assert sorted(task.task_name for task in storage.all()) == ['other', 'task-0']
+
+    # 任务结束后相同去重键的失败任务重新新增
+    storage.remove(tasks[0].task_id)
+    again = _new_task('again')
+    again.dedup_key = 'key'
+    storage.put(again)
+    assert again.task_id != tasks[0].task_id
+    assert sorted(task.task_name for task in storage.all()) == ['again', 'other']
+
+
+def test_sqlite_dedup_conflicts(tmp_path):
+    storage = SqliteStorage(db=os.path.join(tmp_path, 'do.db'))
+    stopped = _new_task('stopped')
+    stopped.dedup_key = 'key'
+    stopped.state = TaskState.Stopped
+    storage.put(stopped)
+    # 去重键只在待重试任务间唯一，其他状态的同键任务不影响插入
+    task = _new_task('task')
+    task.dedup_key = 'key'
+    storage.put(task)
+    assert task.task_id != stopped.task_id
+    # 去重键以外的约束冲突不会被忽略
+    invalid = _new_task('invalid')
+    invalid.dedup_key = 'other'
+    invalid.priority = None
+    with pytest.raises(sqlite3.IntegrityError):
+        storage.put(invalid)
+    assert sorted(t.task_name for t in storage.all()) == ['stopped', 'task']
+    storage.close()
+
+
+def test_memory_dedup_stale_key():
+    storage = MemoryStorage(lease_timeout=0.1)
+    first = _new_task('first')
+    first.dedup_key = 'key'
+    storage.put(first)
+    assert storage.take() is first
+
+    # 执行中的任务仍然合并相同去重键的新任务
+    merged = _new_task('merged')
+    merged.dedup_key = 'key'
+    storage.put(merged)
+    assert merged.task_id == first.task_id and storage.get_next() is None
+
+    # 取出后一直未写回的任务，其去重键失效
+    time.sleep(0.15)
+    again = _new_task('again')
+    again.dedup_key = 'key'
+    storage.put(again)
+    assert again.task_id != first.task_id
+    assert storage.take() is again
+
+
+def test_journal_recover(tmp_path):
+    path = os.path.join(tmp_path, 'journal')
+    storage = JournalStorage(path=path)
+    now = time.time()
+    tasks = [_new_task(f'task-{i}', next_run_time=now - i) for i in range(5)]
+    storage.put_many(tasks)
+    taken = storage.take_many(2)
+    taken[0].next_run_time = now + 60
+    taken[0].retry_count = 1
+    storage.put(taken[0])
+    storage.remove(taken[1].task_id)
+    tasks[0].state = TaskState.Interrupted
+    storage.put(tasks[0])
+    storage.close()
+
+    # 模拟写入记录时崩溃，残缺的记录在恢复时被截断
+    segment = os.path.join(path, JournalStorage._SEGMENT.format(0))
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(b'\x10\x00\x00\x00broken')
+
+    recovered = JournalStorage(path=path)
+    assert os.path.getsize(segment) == size
+    assert len(recovered._unloaded) == 4 and recovered.get_next().task_name == 'task-2'
+    by_name = {task.task_name: task for task in recovered.all()}
+    assert sorted(by_name) == ['task-0', 'task-1', 'task-2', 'task-4']
+    assert by_name['task-4'].retry_count == 1 and by_name['task-4'].next_run_time == now + 60
+    assert by_name['task-0'].state == TaskState.Interrupted
+    assert [task.task_name for task in recovered.take_many(10)] == ['task-2', 'task-1']
+    new_task = _new_task('new')
+    recovered.put(new_task)
+    assert new_task.task_id > max(task.task_id for task in tasks)
+    recovered.close()
+
+
+def test_journal_compaction(tmp_path):
+    path = os.path.join(tmp_path, 'journal')
+    storage = JournalStorage(path=path, fsync=False, segment_size=4096, snapshot_segments=2)
+    now = time.time()
+    kept = list()
+    for i in range(200):
+        task = _new_task(f'task-{i}', next_run_time=now + i)
+        storage.put(task)
+        if i % 10:
+            storage.remove(task.task_id)
+        else:
+            kept.append(task.task_name)
+    storage.close()
+
+    names = os.listdir(path)
+    assert len([name for name in names if name.startswith('snapshot')]) == 1
+    assert len([name for name in names if name.startswith('segment')]) <= 2
+    recovered = JournalStorage(path=path)
+    assert sorted(task.task_name for task in recovered.all()) == sorted(kept)
+    recovered.compact()
+    assert sorted(os.listdir(path)) == [JournalStorage._INDEX, JournalStorage._SEGMENT.format(recovered._segment),
+                                        JournalStorage._SNAPSHOT.format(recovered._snapshot)]
+    recovered.close()
+    assert sorted(task.task_name for task in JournalStorage(path=path).all()) == sorted(kept)
+
+    # 索引文件丢失时从快照重放
+    os.remove(os.path.join(path, JournalStorage._INDEX))
+    rebuilt = JournalStorage(path=path)
+    assert not rebuilt._unloaded
+    assert sorted(task.task_name for task in rebuilt.all()) == sorted(kept)
+    rebuilt.close()
+
+
+def test_journal_index_restart(tmp_path):
+    path = os.path.join(tmp_path, 'journal')
+    storage = JournalStorage(path=path, fsync=False)
+    now = time.time()
+    tasks = [_new_task(f'task-{i}', next_run_time=now - i) for i in range(3000)]
+    for i, task in enumerate(tasks):
+        task.priority = i % 3
+    deduped = _new_task('deduped', next_run_time=now + 60)
+    deduped.dedup_key = 'key'
+    storage.put_many(tasks + [deduped])
+    storage.remove_many([task.task_id for task in tasks[1000:]])
+    storage.close()
+
+    recovered = JournalStorage(path=path)
+    assert len(recovered._unloaded) == 1000 and len(recovered._mmap_index._slots) == 1001
+    taken = recovered.take_many(5)
+    assert [task.task_name for task in taken] == ['task-998', 'task-995', 'task-992', 'task-989', 'task-986']
+    assert taken[0].task_args == [1, 'a'] and taken[0].runner_name == 'runner'
+    duplicate = _new_task('duplicate')
+    duplicate.dedup_key = 'key'
+    recovered.put(duplicate)
+    assert duplicate.task_id == deduped.task_id
+    taken[0].retry_count = 1
+    recovered.put(taken[0])
+    recovered.remove_many([task.task_id for task in taken[1:]])
+    recovered.close()
+
+    again = JournalStorage(path=path)
+    assert len(again.all()) == 997
+    assert [task for task in again.all() if task.retry_count == 1][0].task_name == 'task-998'
+    again.close()
+
+
+def test_journal_lazy_restart(tmp_path):
+    path = os.path.join(tmp_path, 'journal')
+    storage = JournalStorage(path=path, fsync=False)
+    now = time.time()
+    due = [_new_task(f'due-{i}', next_run_time=now - i) for i in range(3)]
+    soon = _new_task('soon', next_run_time=now + 0.3)
+    later = [_new_task(f'later-{i}', next_run_time=now + 3600 + i) for i in range(100)]
+    storage.put_many(due + [soon] + later)
+    storage.close()
+
+    # 预读窗口之外的任务不放入内存索引，但计入待重试任务数，新任务的ID不与其冲突
+    recovered = JournalStorage(path=path, preload=0.1)
+    assert len(recovered._cold) == 101 and recovered._index.pending_count() == 3
+    assert recovered.pending_count() == 104
+    new_task = _new_task('new', next_run_time=now + 7200)
+    recovered.put(new_task)
+    assert new_task.task_id > max(task.task_id for task in later)
+    assert [task.task_name for task in recovered.take_many(10)] == ['due-2', 'due-1', 'due-0']
+    assert recovered.get_next().task_name == 'soon' and len(recovered._cold) == 100
+    time.sleep(0.3)
+    assert [task.task_name for task in recovered.take_many(10)] == ['soon']
+    recovered.remove(later[0].task_id)
+    assert recovered.pending_count() == 100
+    assert recovered.get_next().task_name == 'later-1'
+    assert len(recovered.all()) == 104 and not recovered._cold
+    recovered.close()
+
+
+def test_tiered_storage(tmp_path):
+    db = os.path.join(tmp_path, 'do.db')
+    durable = SqliteStorage(db=db)
+    now = time.time()
+    durable.put_many([_new_task('soon', next_run_time=now + 0.2), _new_task('later', next_run_time=now + 60)])
+    storage = TieredStorage(durable=durable, horizon=1)
+    calls = []
+    take_ahead = durable.take_ahead
+    durable.take_ahead = lambda horizon, n: calls.append(n) or take_ahead(horizon, n)
+
+    due = _new_task('due', next_run_time=now - 1)
+    storage.put(due)
+    assert storage.get_next() is due
+    assert storage.take_many(10) == [due] and storage.take_many(10) == []
+    # 预取的任务被租约占用，持久化存储器中不能再被认领
+    assert take_ahead(1, 10) == []
+    assert len(calls) == 1
+
+    due.next_run_time = now + 0.1
+    storage.put(due)
+    deadline = time.time() + 2
+    taken = []
+    while len(taken) < 2 and time.time() < deadline:
+        taken += storage.take_many(10)
+        time.sleep(0.05)
+    assert sorted(task.task_name for task in taken) == ['due', 'soon'] and len(calls) <= 5
+    storage.load_payload([task for task in taken if task.task_args is None])
+    assert all(task.task_args == [1, 'a'] for task in taken)
+    storage.remove_many([task.task_id for task in taken])
+    assert [task.task_name for task in storage.all()] == ['later']
+    storage.close()
+
+    # 关闭时释放热队列中任务的租约，重新打开后可以立即认领
+    storage = TieredStorage(durable=SqliteStorage(db=db), horizon=120)
+    assert [task.task_name for task in storage.take_many(10)] == []
+    assert storage.get_next().task_name == 'later'
+    storage.close()
+    assert [task.task_name for task in SqliteStorage(db=db).take_ahead(120, 10)] == ['later']
+
+
+def test_memory_heap_remove_and_reschedule():
+    storage = MemoryStorage(max_size=200)
+    now = time.time()
+    tasks = [_new_task(f'task-{i}', next_run_time=now + i) for i in range(200)]
+    storage.put_many(tasks)
+    with pytest.raises(DataException):
+        storage.put(_new_task('overflow'))
+
+    storage.remove_many([task.task_id for task in tasks[:150]])
+    assert len(storage._queue._heap) < 200
+    assert storage.get_next() is tasks[150]
+    assert storage.get_next() is tasks[150]
+
+    tasks[199].next_run_time = now - 1
+    storage.put(tasks[199])
+    assert len(storage._queue) == 50
+    assert storage.take_many(10) == [tasks[199]]
+    assert storage.get_next() is tasks[150]
+    storage.put(_new_task('new'))
+
+
+@pytest.mark.parametrize('policy, kept', [
+    (OverflowPolicy.DropNewest, ['p0', 'p1', 'p2']),
+    (OverflowPolicy.DropOldest, ['p2', 'new', 'low']),
+    (OverflowPolicy.DropLowestPriority, ['p1', 'p2', 'new']),
+])
+def test_memory_overflow_drop(policy, kept):
+    storage = MemoryStorage(max_size=3, policy=policy)
+    now = time.time()
+    tasks = [_new_task(f'p{i}', next_run_time=now + i) for i in range(3)]
+    for i, task in enumerate(tasks):
+        task.priority = i
+    storage.put_many(tasks)
+    new = _new_task('new')
+    new.priority = 5
+    storage.put(new)
+    # 优先级比所有待重试任务都低的新任务在DropLowestPriority策略下被丢弃
+    low = _new_task('low')
+    low.priority = -1
+    storage.put(low)
+    assert sorted(task.task_name for task in storage.all()) == sorted(kept)
+    assert storage.stats().dropped == 2 and storage.stats().tasks == 3
+
+    # 重新调度已取出的任务不受容量限制
+    taken = storage.take_many(10)
+    for task in taken:
+        task.next_run_time = now + 60
+    storage.put_many(taken)
+    assert storage.stats().dropped == 2
+
+
+def test_memory_drop_oldest_order():
+    storage = MemoryStorage(max_size=3, policy=OverflowPolicy.DropOldest)
+    now = time.time()
+    storage.put_many([_new_task(f'p{i}', next_run_time=now - 3 + i) for i in range(3)])
+    taken = storage.take_many(1)
+    assert taken[0].task_name == 'p0'
+    # 执行中的任务不会被丢弃，重新入队后排在队尾
+    storage.put(_new_task('new', next_run_time=now + 60))
+    storage.put_many(taken)
+    storage.put(_new_task('last', next_run_time=now + 60))
+    assert sorted(task.task_name for task in storage.all()) == ['last', 'new', 'p0']
+    assert [storage.get(task_id).task_name for task_id in storage._oldest] == ['new', 'p0', 'last']
+
+
+def test_memory_overflow_bytes_and_block():
+    storage = MemoryStorage(max_bytes=1000, policy=OverflowPolicy.Block, block_timeout=0.1)
+    big = _new_task('big')
+    big.task_args = ['x' * 600]
+    storage.put(big)
+    assert 600 < storage.stats().bytes < 1000
+    blocked = _new_task('blocked')
+    blocked.task_args = ['x' * 600]
+    with pytest.raises(DataException):
+        storage.put(blocked)
+    assert storage.stats().blocked == 1 and storage.stats().blocked_time >= 0.1
+
+    storage = MemoryStorage(max_size=1, policy=OverflowPolicy.Block)
+    storage.put(_new_task('first'))
+    waiter = threading.Thread(target=storage.put, args=(_new_task('second'),))
+    waiter.start()
+    time.sleep(0.1)
+    assert waiter.is_alive()
+    assert [task.task_name for task in storage.take_many(10)] == ['first']
+    waiter.join(1)
+    assert not waiter.is_alive() and storage.take().task_name == 'second'
+    assert storage.stats().bytes == 0
+
+
+def test_memory_overflow_spill(tmp_path):
+    spill = SqliteStorage(db=os.path.join(tmp_path, 'spill.db'))
+    storage = MemoryStorage(max_size=2, policy=OverflowPolicy.Spill, spill=spill)
+    now = time.time()
+    tasks = [_new_task(f'task-{i}', next_run_time=now - 10 + i) for i in range(5)]
+    storage.put_many(tasks)
+    assert storage.stats().spilled == 3 and len(spill.all()) == 3
+    assert all(task.task_id == FailedTask.INIT_ID for task in tasks[2:])
+
+    names = []
+    while True:
+        taken = storage.take_many(1)
+        if not taken:
+            break
+        names.append(taken[0].task_name)
+        assert taken[0].task_args == [1, 'a']
+    assert names == [f'task-{i}' for i in range(5)]
+    assert storage.stats().unspilled == 3 and spill.all() == []
+    spill.close()
+
+    with pytest.raises(ConfigureException):
+        MemoryStorage(policy=OverflowPolicy.WriteThrough)
+
+
+@pytest.mark.parametrize('scheduler_cls', [HeapScheduler, TimingWheelScheduler])
+def test_scheduler(scheduler_cls):
+    scheduler = scheduler_cls() if scheduler_cls is HeapScheduler else scheduler_cls(wheel_size=16, levels=3)
+    tick = 0 if scheduler_cls is HeapScheduler else 0.01
+    rand = random.Random(0)
+    now = time.time()
+    pending = dict()
+    for i in range(2000):
+        task = _new_task(f'task-{i}', next_run_time=now + rand.uniform(-1, 1000))
+        task.task_id = i
+        scheduler.push(task)
+        pending[i] = task
+    for task_id in rand.sample(list(pending), 500):
+        scheduler.remove(task_id)
+        pending.pop(task_id)
+    for task_id in rand.sample(list(pending), 500):
+        pending[task_id].next_run_time = now + rand.uniform(-1, 1000)
+        scheduler.push(pending[task_id])
+    assert len(scheduler) == len(pending)
+
+    while pending:
+        expect = min(pending.values(), key=lambda t: t.next_run_time)
+        assert scheduler.peek().next_run_time == expect.next_run_time
+        now += rand.uniform(0, 20)
+        due = {task_id for task_id, task in pending.items()
+               if (task.next_run_time <= now if not tick else
+                   math.floor(task.next_run_time / tick) <= math.floor(now / tick))}
+        popped = scheduler.pop_due(now, len(pending))
+        assert {task.task_id for task in popped} == due
+        assert [task.next_run_time for task in popped] == sorted(task.next_run_time for task in popped)
+        for task_id in due:
+            pending.pop(task_id)
+    assert scheduler.peek() is None and len(scheduler) == 0
+
+
+@pytest.mark.parametrize('storage_cls', [MemoryStorage, SqliteStorage, JournalStorage])
+def test_take_by_priority(tmp_path, storage_cls):
+    storage = _new_storage(storage_cls, tmp_path)
+    now = time.time()
+    tasks = [_new_task(f'bulk-{i}', next_run_time=now - 10 + i) for i in range(5)]
+    critical = _new_task('critical', next_run_time=now - 1)
+    critical.priority = 10
+    future = _new_task('future', next_run_time=now + 60)
+    future.priority = 20
+    storage.put_many(tasks + [critical, future])
+
+    assert [task.task_name for task in storage.take_many(3)] == ['critical', 'bulk-0', 'bulk-1']
+    assert storage.take().priority == 0
+    if storage_cls is not MemoryStorage:
+        storage.close()
+
+
+def test_memory_storage_with_timing_wheel():
+    storage = MemoryStorage(scheduler=TimingWheelScheduler())
+    storage.put_many([_new_task('due', next_run_time=time.time() - 1), _new_task('later', time.time() + 60)])
+    assert [task.task_name for task in storage.take_many(10)] == ['due']
+    assert storage.get_next().task_name == 'later'
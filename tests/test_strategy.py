@@ -0,0 +1,53 @@
+import time
+
+from base import (FailedTask, TaskState, TaskType, Jitter, ExponentialBackoffStrategy, DecorrelatedJitterStrategy,
+                  ErrorStrategy, IntervalStrategy, ANY_TIME)
+from storage_helper import mark_failed
+
+
+def _new_task(retry_count: int = 0) -> FailedTask:
+    return FailedTask(task_id=1, task_type=TaskType.Idempotent, task_name='task', task_args=[], task_kwargs={},
+                      runner_name='runner', retry_count=retry_count, max_retry=-1, create_time=time.time(),
+                      update_time=time.time(), next_run_time=ANY_TIME, state=TaskState.Failed)
+
+
+def test_exponential_backoff():
+    strategy = ExponentialBackoffStrategy(base=1, factor=2, cap=10, jitter=Jitter.Off)
+    assert [strategy.backoff(n) for n in range(6)] == [1, 2, 4, 8, 10, 10]
+    assert strategy.backoff(100000) == 10
+    delay = strategy.next_run_time(_new_task(retry_count=2)) - time.time()
+    assert 3.9 < delay <= 4
+
+    for jitter, low in [(Jitter.Full, 0), (Jitter.Equal, 4)]:
+        strategy = ExponentialBackoffStrategy(base=1, factor=2, cap=10, jitter=jitter)
+        delays = [strategy.next_run_time(_new_task(retry_count=3)) - time.time() for _ in range(200)]
+        assert low - 0.1 <= min(delays) and max(delays) <= 8
+        assert max(delays) - min(delays) > 1
+
+
+def test_decorrelated_jitter():
+    strategy = DecorrelatedJitterStrategy(base=1, cap=20)
+    task = _new_task()
+    for _ in range(50):
+        next_run_time = strategy.next_run_time(task)
+        last_delay = 1 if task.retry_count == 0 else task.retry_delay
+        assert 1 - 0.1 <= next_run_time - time.time() <= min(20, last_delay * 3)
+        task.next_run_time = next_run_time
+        mark_failed(task)
+        assert abs(task.retry_delay - (task.next_run_time - task.update_time)) < 1e-9
+
+    # 被推迟的任务仍按上次设定的退避时间计算，而不是推迟的时间
+    task.retry_delay = 10
+    task.update_time = time.time()
+    task.next_run_time = task.update_time + 0.05
+    delays = [strategy.next_run_time(task) - time.time() for _ in range(200)]
+    assert max(delays) > 3
+
+
+def test_error_strategy():
+    strategy = ErrorStrategy(IntervalStrategy(100), {TimeoutError: IntervalStrategy(1), OSError: IntervalStrategy(10)})
+    task = _new_task()
+    assert strategy.next_run_time_on_error(task, TimeoutError()) - time.time() < 2
+    assert 9 < strategy.next_run_time_on_error(task, ConnectionError()) - time.time() < 11
+    assert strategy.next_run_time_on_error(task, ValueError()) - time.time() > 99
+    assert strategy.next_run_time(task) - time.time() > 99